@@ -1,5 +1,11 @@
+from __future__ import annotations
+
 import os
 import re
+import socket
+import sys
+import argparse
+import itertools
 import json
 import time
 import uuid
@@ -7,23 +13,33 @@ import random
 import sqlite3
 import threading
 import asyncio
+import base64
+import bisect
+import functools
+import hashlib
+import hmac
+import heapq
+import math
+import difflib
+import unicodedata
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
 from pathlib import Path
-from datetime import datetime, timedelta, timezone
+from array import array
+from datetime import date, datetime, timedelta, timezone
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
 import uvicorn
 
-from telegram import Update
-from telegram.constants import ParseMode
-from telegram.ext import (
-    Application,
-    CommandHandler,
-    MessageHandler,
-    ContextTypes,
-    filters
-)
+from typing import TYPE_CHECKING
+
+# telegram импортируется только там, где реально нужен бот: --api-only без него
+if TYPE_CHECKING:
+    from telegram import Bot, Update
+    from telegram.ext import Application, ContextTypes
 
 # =========================
 # CONFIG
@@ -38,17 +54,193 @@ BOT_TOKEN = os.getenv("BOT_TOKEN", "").strip()
 API_HOST = os.getenv("API_HOST", "0.0.0.0")
 API_PORT = int(os.getenv("API_PORT", "1488"))
 
-POLL_SECONDS = float(os.getenv("BOT_POLL_SECONDS", "1.0"))
+# отправитель будят API-ручки; периодический проход — только страховка после падений
+SWEEP_SECONDS = float(os.getenv("BOT_SWEEP_SECONDS", os.getenv("BOT_POLL_SECONDS", "15")))
+# API в отдельном процессе будит отправителя UDP-пакетом сюда; "" — выключить
+SENDER_WAKE_ADDR = os.getenv("BOT_WAKE_ADDR", "127.0.0.1:1489").strip()
+API_WORKERS = int(os.getenv("API_WORKERS", "1"))
+
+# webhook-режим: Telegram шлёт апдейты на TG_WEBHOOK_URL (публичный https → /tg/webhook)
+TG_WEBHOOK_URL = os.getenv("TG_WEBHOOK_URL", "").strip()
+TG_WEBHOOK_SECRET = os.getenv("TG_WEBHOOK_SECRET", "").strip() or uuid.uuid4().hex
+TG_WEBHOOK_PATH = "/tg/webhook"
+# обрабатываем только сообщения (/start, /help, текст) — остальное Telegram пусть не шлёт
+ALLOWED_UPDATES = ["message"]
+
+# лимиты Telegram: ~30 msg/s на бота, ~1 msg/s в один чат
+TG_GLOBAL_RPS = float(os.getenv("TG_GLOBAL_RPS", "30"))
+TG_CHAT_RPS = float(os.getenv("TG_CHAT_RPS", "1"))
+SEND_CONCURRENCY = int(os.getenv("BOT_SEND_CONCURRENCY", "16"))
+SEND_BATCH = int(os.getenv("BOT_SEND_BATCH", "200"))     # строк за один SELECT
+SEND_FLUSH = int(os.getenv("BOT_SEND_FLUSH", "32"))      # статусы пишем пачками по столько
+
+# повторы отправки: 2s, 4s, 8s ... до SEND_BACKOFF_MAX, после SEND_MAX_ATTEMPTS — 'failed'
+SEND_MAX_ATTEMPTS = int(os.getenv("BOT_SEND_MAX_ATTEMPTS", "6"))
+SEND_BACKOFF_BASE = float(os.getenv("BOT_SEND_BACKOFF_BASE", "2"))
+SEND_BACKOFF_MAX = float(os.getenv("BOT_SEND_BACKOFF_MAX", "600"))
+
+# аренда строк очереди: отправителей может быть несколько, упавший отдаёт строки по истечении
+SEND_LEASE_SECONDS = float(os.getenv("BOT_SEND_LEASE_SECONDS", "60"))
+WORKER_ID = os.getenv("BOT_WORKER_ID") or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+# пул соединений: читатели с query_only, писателей мало — SQLite всё равно пишет по одному
+DB_POOL_READERS = int(os.getenv("DB_POOL_READERS", "8"))
+DB_POOL_WRITERS = int(os.getenv("DB_POOL_WRITERS", "2"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_STMT_CACHE = int(os.getenv("DB_STMT_CACHE", "256"))
 
 REQUIRE_USERNAME = True  # /start требует @username
 
+# справочник городов: название -> (IATA, алиасы)
+CITY_DIRECTORY = {
+    "Minsk, BY":     ("MSQ", ("минск", "mensk")),
+    "Warsaw, PL":    ("WAW", ("варшава", "warszawa")),
+    "Berlin, DE":    ("BER", ("берлин",)),
+    "Prague, CZ":    ("PRG", ("прага", "praha")),
+    "Vienna, AT":    ("VIE", ("вена", "wien")),
+    "Riga, LV":      ("RIX", ("рига",)),
+    "Vilnius, LT":   ("VNO", ("вильнюс",)),
+    "Paris, FR":     ("CDG", ("париж",)),
+    "Rome, IT":      ("FCO", ("рим", "roma")),
+    "Madrid, ES":    ("MAD", ("мадрид",)),
+    "London, UK":    ("LHR", ("лондон",)),
+    "Oslo, NO":      ("OSL", ("осло",)),
+    "Stockholm, SE": ("ARN", ("стокгольм",)),
+    "Helsinki, FI":  ("HEL", ("хельсинки",)),
+    "Zurich, CH":    ("ZRH", ("цюрих", "zürich")),
+    "Istanbul, TR":  ("IST", ("стамбул",)),
+    "Athens, GR":    ("ATH", ("афины", "athina")),
+    "Budapest, HU":  ("BUD", ("будапешт",)),
+    "Brussels, BE":  ("BRU", ("брюссель", "bruxelles")),
+    "Dublin, IE":    ("DUB", ("дублин",)),
+}
+
+CITY_FUZZY_CUTOFF = 0.75
+
+# координаты (lat, lon) — длительность перелёта считаем по большому кругу
+CITY_COORDS = {
+    "Minsk, BY":     (53.90, 27.57),
+    "Warsaw, PL":    (52.23, 21.01),
+    "Berlin, DE":    (52.52, 13.40),
+    "Prague, CZ":    (50.08, 14.44),
+    "Vienna, AT":    (48.21, 16.37),
+    "Riga, LV":      (56.95, 24.11),
+    "Vilnius, LT":   (54.69, 25.28),
+    "Paris, FR":     (48.86, 2.35),
+    "Rome, IT":      (41.90, 12.50),
+    "Madrid, ES":    (40.42, -3.70),
+    "London, UK":    (51.51, -0.13),
+    "Oslo, NO":      (59.91, 10.75),
+    "Stockholm, SE": (59.33, 18.07),
+    "Helsinki, FI":  (60.17, 24.94),
+    "Zurich, CH":    (47.37, 8.54),
+    "Istanbul, TR":  (41.01, 28.98),
+    "Athens, GR":    (37.98, 23.73),
+    "Budapest, HU":  (47.50, 19.04),
+    "Brussels, BE":  (50.85, 4.35),
+    "Dublin, IE":    (53.35, -6.26),
+}
+
+# тарифы: база маршрута = FARE_BASE_USD + FARE_USD_PER_MINUTE * блок-тайм
+FARE_BASE_USD = float(os.getenv("FARE_BASE_USD", "40"))
+FARE_USD_PER_MINUTE = float(os.getenv("FARE_USD_PER_MINUTE", "1.1"))
+# множитель по дням до вылета: (меньше скольки дней, множитель); дальше — FARE_DAY_FAR
+FARE_DAY_STEPS = ((3, 1.35), (14, 1.15), (61, 1.0))
+FARE_DAY_FAR = 0.9
+# пропустили больше дней — пересчитываем всё расписание, а не только ступени
+FARE_FULL_GAP_DAYS = 7
+
+# календарь цен: максимум дней за один запрос
+CALENDAR_MAX_DAYS = int(os.getenv("CALENDAR_MAX_DAYS", "92"))
+
+# поиск с пересадками: стыковка (мин/макс, минуты), окно дат вылета, бюджет перебора
+ROUTE_MCT_MINUTES = int(os.getenv("ROUTE_MCT_MINUTES", "45"))
+ROUTE_MAX_LAYOVER_MINUTES = int(os.getenv("ROUTE_MAX_LAYOVER_MINUTES", "720"))
+ROUTE_MAX_DAYS = int(os.getenv("ROUTE_MAX_DAYS", "14"))
+ROUTE_PER_HUB = int(os.getenv("ROUTE_PER_HUB", "3"))  # вариантов последнего плеча на одну стыковку
+ROUTE_MAX_EXPANSIONS = int(os.getenv("ROUTE_MAX_EXPANSIONS", "50000"))
+ROUTE_REBUILD_SECONDS = float(os.getenv("ROUTE_REBUILD_SECONDS", "600"))  # полная пересборка (правки/удаления рейсов)
+
+# удержание места между запросом кода брони и подтверждением
+SEAT_HOLD_SECONDS = float(os.getenv("SEAT_HOLD_SECONDS", "300"))
+BOOKING_MAX_SEATS = int(os.getenv("BOOKING_MAX_SEATS", "9"))  # мест в одной групповой брони
+
+# кэш занятости мест по рейсам (в памяти процесса)
+SEAT_CACHE_SIZE = int(os.getenv("SEAT_CACHE_SIZE", "4096"))
+SEAT_CACHE_TTL = float(os.getenv("SEAT_CACHE_TTL", "30"))  # чужие процессы тоже бронируют
+
+# long-poll статуса запроса кода: максимум ожидания и период сверки с БД (если отправитель в другом процессе)
+REQUEST_WAIT_MAX = float(os.getenv("REQUEST_WAIT_MAX", "30"))
+REQUEST_STATUS_POLL = float(os.getenv("REQUEST_STATUS_POLL", "1"))
+
+# live-обновления карты мест (SSE): раз в столько секунд поток сверяется с кэшем мест
+SEAT_STREAM_POLL = float(os.getenv("SEAT_STREAM_POLL", "5"))
+SEAT_STREAM_MAX = int(os.getenv("SEAT_STREAM_MAX", "2000"))  # подписчиков на процесс
+
+# кэш результатов поиска; версию расписания перечитываем из БД не чаще раза в SEARCH_VERSION_TTL
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "2048"))
+SEARCH_VERSION_TTL = float(os.getenv("SEARCH_VERSION_TTL", "2"))  # чужие брони видны через столько
+
+# сессии: живут SESSION_TTL_DAYS с последней активности, продлеваются не чаще раза в SESSION_RENEW_SECONDS
+SESSION_TTL = float(os.getenv("SESSION_TTL_DAYS", "30")) * 86400
+SESSION_RENEW_SECONDS = float(os.getenv("SESSION_RENEW_SECONDS", "3600"))
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "10000"))
+SESSION_CACHE_TTL = float(os.getenv("SESSION_CACHE_TTL", "60"))  # logout в другом процессе виден через столько
+
+# одноразовые коды: в БД только хэш, живут OTP_TTL_SECONDS, OTP_MAX_ATTEMPTS неверных — код сгорает
+OTP_TTL = float(os.getenv("OTP_TTL_SECONDS", "600"))
+OTP_MAX_ATTEMPTS = int(os.getenv("OTP_MAX_ATTEMPTS", "5"))
+OTP_CACHE_SIZE = int(os.getenv("OTP_CACHE_SIZE", "20000"))
+OTP_CACHE_TTL = float(os.getenv("OTP_CACHE_TTL", "5"))  # новый код из другого процесса виден через столько
+# ключ HMAC для хэшей кодов; общий для бота и API. Без OTP_SECRET — файл рядом с БД (0600)
+OTP_SECRET = os.getenv("OTP_SECRET", "").strip()
+OTP_SECRET_FILE = Path(os.getenv("OTP_SECRET_FILE", str(DB_PATH) + ".otpkey")).resolve()
+
+# фоновое обслуживание БД (GC и пр.): раз в MAINT_SECONDS, удаления пачками по GC_BATCH
+MAINT_SECONDS = float(os.getenv("MAINT_SECONDS", "60"))
+GC_BATCH = int(os.getenv("GC_BATCH", "500"))
+GC_MAX_BATCHES = int(os.getenv("GC_MAX_BATCHES", "50"))
+GC_PAUSE = float(os.getenv("GC_PAUSE", "0.05"))  # пауза между пачками — отдать write-lock API
+
+# схема v2 (PRAGMA user_version): у рейсов нет текстовых колонок — города из словаря
+# cities (dep_city_id/arr_city_id), вылет целым dep_ts; времена очередей — epoch-секунды.
+# Старые flights переезжают онлайн (migrate_schema_v2): копия пачками по MIGRATE_BATCH
+# в flights_v2, правки по ходу зеркалят триггеры, в конце — подмена таблиц
+SCHEMA_VERSION = 2
+MIGRATE_BATCH = int(os.getenv("MIGRATE_BATCH", "20000"))
+
+# ретеншн очередей: завершённые строки старше RETENTION_DAYS — в *_archive или удалить
+RETENTION_DAYS = float(os.getenv("RETENTION_DAYS", "30"))
+RETENTION_MODE = os.getenv("RETENTION_MODE", "archive").strip().lower()
+RETENTION_MODES = ("archive", "delete")
+
 # =========================
 # HELPERS
 # =========================
 
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+def now_ts() -> int:
+    return int(time.time())
+
+def sched_ts(fdate: str, ftime: str = "00:00") -> int:
+    # время расписания -> epoch-секунды, как strftime('%s', date || ' ' || time) в SQLite
+    return (date.fromisoformat(fdate).toordinal() - EPOCH_ORDINAL) * 86400 + int(ftime[:2]) * 3600 + int(ftime[3:5]) * 60
+
 def now_utc_iso() -> str:
     return datetime.now(timezone.utc).replace(microsecond=0).isoformat()
 
+def utc_iso_in(seconds: float) -> str:
+    return (datetime.now(timezone.utc) + timedelta(seconds=seconds)).replace(microsecond=0).isoformat()
+
+def iso_to_ts(s: str | None) -> float:
+    if not s:
+        return 0.0
+    try:
+        return datetime.fromisoformat(s).timestamp()
+    except ValueError:
+        return 0.0
+
 def norm_username(u: str) -> str:
     u = (u or "").strip()
     if not u:
@@ -57,27 +249,467 @@ def norm_username(u: str) -> str:
         u = "@" + u
     return u
 
+def norm_text(s: str) -> str:
+    # "Zürich, CH" -> "zurich ch"
+    s = unicodedata.normalize("NFKD", (s or "").casefold())
+    s = "".join(ch for ch in s if not unicodedata.combining(ch))
+    s = re.sub(r"[^\w]+", " ", s)
+    return " ".join(s.split())
+
+def encode_cursor(*key) -> str:
+    raw = json.dumps(list(key), separators=(",", ":"), ensure_ascii=False).encode()
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def cursor_item_ok(x, t: type) -> bool:
+    # bool — тоже int в Python; целое должно влезть в INTEGER SQLite
+    if isinstance(x, bool) or not isinstance(x, t):
+        return False
+    return t is not int or -2 ** 63 <= x < 2 ** 63
+
+def decode_cursor(cursor: str | None, *types: type) -> list | None:
+    # курсор приходит от клиента: ключ сверяем по длине и типам, подделка — 400, не 500
+    cursor = (cursor or "").strip()
+    if not cursor:
+        return None
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except Exception:
+        key = None
+    if (not isinstance(key, list) or len(key) != len(types)
+            or not all(cursor_item_ok(x, t) for x, t in zip(key, types))):
+        raise HTTPException(400, "Битый cursor")
+    return key
+
 def gen_code() -> str:
-    return f"{random.randint(0, 999999):06d}"
+    return f"{random.SystemRandom().randint(0, 999999):06d}"
 
-def db_connect() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH, timeout=30, check_same_thread=False)
+@functools.cache
+def otp_key() -> bytes:
+    if OTP_SECRET:
+        return OTP_SECRET.encode()
+    # O_EXCL: из нескольких процессов ключ создаёт один, остальные читают его
+    try:
+        fd = os.open(OTP_SECRET_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        for _ in range(50):
+            key = OTP_SECRET_FILE.read_bytes().strip()
+            if key:
+                return key
+            time.sleep(0.01)
+        raise RuntimeError(f"Пустой ключ кодов: {OTP_SECRET_FILE}")
+    key = uuid.uuid4().hex.encode() + uuid.uuid4().hex.encode()
+    with os.fdopen(fd, "wb") as f:
+        f.write(key)
+    return key
+
+def otp_hash(request_id: str, code: str) -> str:
+    # HMAC с серверным ключом: по дампу БД (request_id + 10^6 кодов) код не перебрать.
+    # request_id в сообщении — одинаковые коды разных запросов дают разные хэши
+    return hmac.new(otp_key(), f"{request_id}:{(code or '').strip()}".encode(), hashlib.sha256).hexdigest()
+
+def db_connect(role: str = "write") -> sqlite3.Connection:
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=30,
+        check_same_thread=False,
+        cached_statements=DB_STMT_CACHE,
+    )
     conn.row_factory = sqlite3.Row
     conn.execute("PRAGMA journal_mode=WAL;")
     conn.execute("PRAGMA synchronous=NORMAL;")
     conn.execute("PRAGMA foreign_keys=ON;")
+    if role == "read":
+        conn.execute("PRAGMA query_only=ON;")
     return conn
 
+class PoolTimeout(RuntimeError):
+    pass
+
+class DbPool:
+    # Ограниченный пул долгоживущих соединений одной роли (read/write).
+    # Соединение выдаётся потоку на время with-блока; вложенный checkout
+    # в том же потоке получает то же соединение. В async-коде соединение
+    # нельзя держать через await — иначе соседняя корутина в этом же
+    # потоке получит его же.
+
+    def __init__(self, role: str, size: int, timeout: float = DB_POOL_TIMEOUT):
+        self.role = role
+        self.size = max(1, int(size))
+        self.timeout = timeout
+        self._idle: list[sqlite3.Connection] = []
+        self._opened = 0
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        self._checkouts = 0
+        self._in_use = 0
+        self._waits = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._timeouts = 0
+        self._broken = 0
+
+    def _acquire(self) -> sqlite3.Connection:
+        t0 = time.perf_counter()
+        deadline = t0 + self.timeout
+        conn = None
+        with self._cond:
+            waited = False
+            while True:
+                if self._idle:
+                    conn = self._idle.pop()
+                    break
+                if self._opened < self.size:
+                    self._opened += 1
+                    break
+                left = deadline - time.perf_counter()
+                if left <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeout(f"pool '{self.role}' exhausted ({self.size})")
+                waited = True
+                self._cond.wait(left)
+
+            dt = time.perf_counter() - t0
+            self._checkouts += 1
+            self._in_use += 1
+            if waited:
+                self._waits += 1
+            self._wait_total += dt
+            self._wait_max = max(self._wait_max, dt)
+
+        if conn is None:
+            try:
+                conn = db_connect(self.role)
+            except Exception:
+                with self._cond:
+                    self._opened -= 1
+                    self._in_use -= 1
+                    self._cond.notify()
+                raise
+        return conn
+
+    def _release(self, conn: sqlite3.Connection) -> None:
+        ok = True
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            ok = False
+
+        with self._cond:
+            self._in_use -= 1
+            if ok:
+                self._idle.append(conn)
+            else:
+                self._opened -= 1
+                self._broken += 1
+            self._cond.notify()
+
+        if not ok:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    @contextmanager
+    def connection(self):
+        held = getattr(self._local, "conn", None)
+        if held is not None:
+            self._local.depth += 1
+            try:
+                yield held
+            finally:
+                self._local.depth -= 1
+            return
+
+        conn = self._acquire()
+        self._local.conn = conn
+        self._local.depth = 1
+        try:
+            yield conn
+        finally:
+            self._local.conn = None
+            self._local.depth = 0
+            self._release(conn)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "role": self.role,
+                "size": self.size,
+                "opened": self._opened,
+                "idle": len(self._idle),
+                "in_use": self._in_use,
+                "checkouts": self._checkouts,
+                "waits": self._waits,
+                "wait_ms_total": round(self._wait_total * 1000, 3),
+                "wait_ms_avg": round(self._wait_total * 1000 / self._checkouts, 3) if self._checkouts else 0.0,
+                "wait_ms_max": round(self._wait_max * 1000, 3),
+                "timeouts": self._timeouts,
+                "broken": self._broken,
+            }
+
+    def close_all(self) -> None:
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._opened -= len(idle)
+        for c in idle:
+            try:
+                c.close()
+            except Exception:
+                pass
+
+_POOLS: dict[str, DbPool] = {}
+_POOLS_LOCK = threading.Lock()
+
+def db_pool(role: str) -> DbPool:
+    pool = _POOLS.get(role)
+    if pool is None:
+        with _POOLS_LOCK:
+            pool = _POOLS.get(role)
+            if pool is None:
+                size = DB_POOL_READERS if role == "read" else DB_POOL_WRITERS
+                pool = DbPool(role, size)
+                _POOLS[role] = pool
+    return pool
+
+def db_read():
+    return db_pool("read").connection()
+
+def db_write():
+    return db_pool("write").connection()
+
+def db_pool_stats() -> dict:
+    return {role: p.stats() for role, p in _POOLS.items()}
+
 def table_cols(conn: sqlite3.Connection, table: str) -> set[str]:
     rows = conn.execute(f"PRAGMA table_info({table});").fetchall()
     return {r["name"] for r in rows}
 
-def ensure_column(conn: sqlite3.Connection, table: str, col_def: str) -> None:
-    # col_def like: "purpose TEXT"
+def ensure_column(conn: sqlite3.Connection, table: str, col_def: str) -> bool:
+    # col_def like: "purpose TEXT"; True — если колонку только что добавили
     col_name = col_def.split()[0].strip()
     cols = table_cols(conn, table)
     if col_name not in cols:
         conn.execute(f"ALTER TABLE {table} ADD COLUMN {col_def};")
+        return True
+    return False
+
+def ensure_archive_table(conn: sqlite3.Connection, table: str, archive: str) -> None:
+    # архив — голая копия колонок (без ключей и индексов) + archived_ts
+    conn.execute(f"CREATE TABLE IF NOT EXISTS {archive} AS SELECT * FROM {table} WHERE 0;")
+    have = table_cols(conn, archive)
+    for r in conn.execute(f"PRAGMA table_info({table});").fetchall():
+        if r["name"] not in have:
+            conn.execute(f"ALTER TABLE {archive} ADD COLUMN {r['name']} {r['type']};")
+    ensure_column(conn, archive, "archived_ts INTEGER")
+
+def table_exists(conn: sqlite3.Connection, name: str) -> bool:
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?;", (name,)).fetchone() is not None
+
+def schema_version(conn: sqlite3.Connection) -> int:
+    return int(conn.execute("PRAGMA user_version;").fetchone()[0])
+
+def ts_iso(ts: int | None) -> str | None:
+    # epoch-секунды -> ISO, как now_utc_iso(): наружу API отдаёт прежний формат
+    if ts is None:
+        return None
+    return datetime.fromtimestamp(int(ts), timezone.utc).isoformat()
+
+def epoch_sql(col: str) -> str:
+    # ISO-строка старой схемы -> epoch-секунды (NULL и мусор -> NULL)
+    return f"CAST(strftime('%s', {col}) AS INTEGER)"
+
+def create_flights_v2(conn: sqlite3.Connection, name: str) -> None:
+    # компактная flights: города — id из cities, вылет — epoch-секунды (время
+    # расписания, без поясов). Индексы: маршрут/город/время + dep_ts — выдача
+    # поиска и окна календаря/тарифов идут диапазоном без сортировки
+    conn.execute(f"""
+    CREATE TABLE IF NOT EXISTS {name} (
+        flight_id     INTEGER PRIMARY KEY AUTOINCREMENT,
+        plane_id      INTEGER NOT NULL,
+        flight_number TEXT NOT NULL,
+        dep_city_id   INTEGER NOT NULL,
+        arr_city_id   INTEGER NOT NULL,
+        dep_ts        INTEGER NOT NULL,
+        seats_booked  INTEGER NOT NULL DEFAULT 0,
+        seats_held    INTEGER NOT NULL DEFAULT 0
+    );
+    """)
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_flights_v2_route ON {name}(dep_city_id, arr_city_id, dep_ts);")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_flights_v2_dep ON {name}(dep_city_id, dep_ts);")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_flights_v2_arr ON {name}(arr_city_id, dep_ts);")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_flights_v2_ts ON {name}(dep_ts);")
+
+def create_flights_view(conn: sqlite3.Connection, v2: bool) -> None:
+    # flights_text — рейс с текстовыми городом/датой/временем, как их отдаёт API и
+    # ключуют агрегаты (route_days, itineraries, route_fares). В v2 это JOIN со
+    # словарём городов: планировщик разворачивает вид в запрос, индексы flights работают
+    conn.execute("DROP VIEW IF EXISTS flights_text;")
+    if v2:
+        conn.execute("""
+        CREATE VIEW flights_text AS
+        SELECT f.flight_id, f.plane_id, f.flight_number,
+               dc.name AS departure_city, ac.name AS arrival_city,
+               date(f.dep_ts, 'unixepoch') AS flight_date, strftime('%H:%M', f.dep_ts, 'unixepoch') AS flight_time,
+               f.seats_booked, f.seats_held, f.dep_city_id, f.arr_city_id, f.dep_ts
+        FROM flights f
+        JOIN cities dc ON dc.city_id = f.dep_city_id
+        JOIN cities ac ON ac.city_id = f.arr_city_id;
+        """)
+    else:
+        conn.execute("""
+        CREATE VIEW flights_text AS
+        SELECT flight_id, plane_id, flight_number, departure_city, arrival_city, flight_date, flight_time,
+               seats_booked, seats_held
+        FROM flights;
+        """)
+
+# строка flights_v2 из строки старой flights (копия пачками и триггеры-зеркала);
+# города уже в cities. Нечитаемые дата/время -> 0 (1970): в выдачу такой рейс не попадёт
+FLIGHT_V2_COLS = "flight_id, plane_id, flight_number, dep_city_id, arr_city_id, dep_ts, seats_booked, seats_held"
+FLIGHT_V2_SELECT = f"""
+    SELECT flight_id, plane_id, flight_number,
+           (SELECT city_id FROM cities WHERE name = departure_city),
+           (SELECT city_id FROM cities WHERE name = arrival_city),
+           COALESCE({epoch_sql("flight_date || ' ' || flight_time")}, 0),
+           seats_booked, seats_held
+    FROM flights
+"""
+
+def keep_sequence(conn: sqlite3.Connection, table: str, seq: int) -> None:
+    # после подмены таблицы AUTOINCREMENT продолжает со старого счётчика:
+    # id удалённых строк (архив, ретеншн) не переиспользуются
+    if conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?;", (seq, table)).rowcount == 0:
+        conn.execute("INSERT INTO sqlite_sequence(name, seq) VALUES (?, ?);", (table, seq))
+
+def table_sequence(conn: sqlite3.Connection, table: str) -> int:
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = ?;", (table,)).fetchone()
+    return int(row[0]) if row else 0
+
+# очереди отправки (схема v2): все времена — epoch-секунды
+QUEUE_COLUMNS = {
+    "tg_code_requests": """
+        request_id      TEXT PRIMARY KEY,
+        username        TEXT NOT NULL,
+        purpose         TEXT NOT NULL,     -- 'register' | 'login' | 'booking'
+        status          TEXT NOT NULL,     -- 'pending' | 'sent' | 'used' | 'cancelled' | 'failed'
+        payload         TEXT,              -- JSON
+        code_hash       TEXT,
+        attempts        INTEGER NOT NULL DEFAULT 0,
+        last_error      TEXT,
+        claimed_by      TEXT,
+        created_ts      INTEGER NOT NULL,
+        sent_ts         INTEGER,
+        used_ts         INTEGER,
+        expires_ts      INTEGER,
+        next_attempt_ts INTEGER,
+        lease_until_ts  INTEGER,
+        code_fails      INTEGER NOT NULL DEFAULT 0   -- неверные вводы кода, общий счётчик всех процессов
+    """,
+    "tg_notifications": """
+        notif_id        INTEGER PRIMARY KEY AUTOINCREMENT,
+        username        TEXT NOT NULL,
+        message         TEXT NOT NULL,
+        status          TEXT NOT NULL,     -- 'pending' | 'sent' | 'failed'
+        attempts        INTEGER NOT NULL DEFAULT 0,
+        last_error      TEXT,
+        claimed_by      TEXT,
+        created_ts      INTEGER NOT NULL,
+        sent_ts         INTEGER,
+        next_attempt_ts INTEGER,
+        lease_until_ts  INTEGER
+    """,
+}
+
+# колонки, которые старые версии добавляли по ходу — до копирования их может не быть
+QUEUE_V1_ADDED = {
+    "tg_code_requests": ("purpose TEXT", "payload TEXT", "code_hash TEXT", "expires_at TEXT"),
+    "tg_notifications": (),
+}
+QUEUE_V1_RETRY = ("attempts INTEGER NOT NULL DEFAULT 0", "last_error TEXT", "next_attempt_at TEXT",
+                  "claimed_by TEXT", "lease_until TEXT")
+
+# строка v2 из строки старой схемы (ISO-строки); время попытки нужно только 'pending'
+QUEUE_V1_DUE = f"""CASE WHEN status = 'pending' THEN COALESCE({epoch_sql("next_attempt_at")},
+                   {epoch_sql("created_at")}, 0) END"""
+QUEUE_V1_SELECT = {
+    "tg_code_requests": f"""
+        request_id, username, COALESCE(purpose, ''), status, payload, code_hash, COALESCE(attempts, 0),
+        last_error, claimed_by, COALESCE({epoch_sql("created_at")}, 0), {epoch_sql("sent_at")},
+        {epoch_sql("used_at")}, {epoch_sql("expires_at")}, {QUEUE_V1_DUE}, {epoch_sql("lease_until")}, 0
+    """,
+    "tg_notifications": f"""
+        notif_id, username, message, status, COALESCE(attempts, 0), last_error, claimed_by,
+        COALESCE({epoch_sql("created_at")}, 0), {epoch_sql("sent_at")}, {QUEUE_V1_DUE}, {epoch_sql("lease_until")}
+    """,
+}
+
+def queue_cols(table: str) -> str:
+    return ", ".join(line.split()[0] for line in QUEUE_COLUMNS[table].strip().splitlines())
+
+def migrate_queue_v1(conn: sqlite3.Connection, table: str, archive: str) -> None:
+    # Очередь старой схемы -> v2 одной транзакцией (копия и подмена): живых строк
+    # в очереди немного — завершённые уходят по ретеншну. Архив неограничен —
+    # его строки переносит migrate_schema_v2() пачками из {archive}_v1.
+    for col_def in QUEUE_V1_ADDED[table] + QUEUE_V1_RETRY:
+        ensure_column(conn, table, col_def)
+    if table == "tg_code_requests":
+        # открытые коды совсем старых версий — только хэш
+        legacy = conn.execute("""
+            SELECT request_id, code FROM tg_code_requests
+            WHERE status='sent' AND code IS NOT NULL AND code_hash IS NULL;
+        """).fetchall()
+        conn.executemany(
+            "UPDATE tg_code_requests SET code_hash=?, expires_at=? WHERE request_id=?;",
+            [(otp_hash(r["request_id"], r["code"]), utc_iso_in(OTP_TTL), r["request_id"]) for r in legacy],
+        )
+    if table_exists(conn, archive):
+        ensure_archive_table(conn, table, archive)
+        ensure_column(conn, archive, "archived_at TEXT")
+    conn.commit()
+
+    # legacy_alter_table: RENAME не перепроверяет чужие триггеры и виды посреди подмены
+    conn.execute("PRAGMA legacy_alter_table = ON;")
+    try:
+        conn.execute("BEGIN IMMEDIATE;")
+        seq = table_sequence(conn, table)
+        conn.execute(f"DROP TABLE IF EXISTS {table}_v2;")
+        conn.execute(f"CREATE TABLE {table}_v2 ({QUEUE_COLUMNS[table]});")
+        conn.execute(f"INSERT INTO {table}_v2({queue_cols(table)}) SELECT {QUEUE_V1_SELECT[table]} FROM {table};")
+        conn.execute(f"DROP TABLE {table};")
+        conn.execute(f"ALTER TABLE {table}_v2 RENAME TO {table};")
+        if seq:
+            keep_sequence(conn, table, seq)
+        if table_exists(conn, archive):
+            conn.execute(f"ALTER TABLE {archive} RENAME TO {archive}_v1;")
+        conn.execute("COMMIT;")
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.execute("PRAGMA legacy_alter_table = OFF;")
+
+def city_ids(conn: sqlite3.Connection, names) -> dict[str, int]:
+    # имя -> city_id; новые города заводим (только write-соединение)
+    names = sorted(set(names))
+    conn.executemany("INSERT OR IGNORE INTO cities(name) VALUES (?);", [(x,) for x in names])
+    out = {}
+    for part in chunks(names, 500):
+        out.update((r[0], int(r[1])) for r in conn.execute(
+            f"SELECT name, city_id FROM cities WHERE name IN ({','.join('?' * len(part))});", part
+        ))
+    return out
+
+# строка "моих рейсов": билет + рейс + самолёт (для триггеров и первичного заполнения)
+ITINERARY_COLS = """passenger_id, ticket_id, seat_no, price_usd, flight_id, flight_number,
+    departure_city, arrival_city, flight_date, flight_time, plane_model, seat_capacity"""
+ITINERARY_SELECT = """
+    SELECT t.passenger_id, t.ticket_id, t.seat_no, t.price_usd, f.flight_id, f.flight_number,
+           f.departure_city, f.arrival_city, f.flight_date, f.flight_time, p.model, p.seat_capacity
+    FROM tickets t
+    JOIN flights_text f ON f.flight_id=t.flight_id
+    JOIN planes p ON p.plane_id=f.plane_id
+"""
 
 def excel_letters(i0: int) -> str:
     # 0->A, 25->Z, 26->AA...
@@ -104,11 +736,273 @@ def seats_for_capacity(capacity: int) -> list[str]:
             out.append(f"{row}{c}")
     return out
 
-def stable_price(flight_id: int) -> float:
-    # стабильная цена, чтобы не прыгала
-    base = 120.0 + (flight_id % 37) * 6.5
-    wobble = (flight_id % 9) * 1.1
-    return round(base + wobble, 2)
+def fare_sql() -> str:
+    # тариф рейса одним выражением SQL — считается сразу по всему набору строк
+    # (INSERT ... SELECT), без цикла по рейсам. Алиасы: f — flights_text, p — planes,
+    # r — route_fares. База маршрута x загрузка x близость вылета (ступенями,
+    # чтобы цена менялась при смене ступени, а не каждый день).
+    steps = " ".join(
+        f"WHEN julianday(f.flight_date) - julianday(date('now')) < {days} THEN {k}" for days, k in FARE_DAY_STEPS
+    )
+    return f"""round(
+        COALESCE(r.base_usd, {route_base_fare("", "")})
+        * (0.85 + 0.6 * (f.seats_booked * 1.0 / p.seat_capacity) * (f.seats_booked * 1.0 / p.seat_capacity))
+        * CASE {steps} ELSE {FARE_DAY_FAR} END, 2)"""
+
+FARE_FROM = """
+    FROM flights_text f
+    JOIN planes p ON p.plane_id = f.plane_id
+    LEFT JOIN route_fares r ON r.departure_city = f.departure_city AND r.arrival_city = f.arrival_city
+"""
+
+def route_base_fare(dep: str, arr: str) -> float:
+    # база маршрута от блок-тайма; неизвестные города — как leg_minutes, 120 минут
+    return round(FARE_BASE_USD + FARE_USD_PER_MINUTE * leg_minutes(dep, arr), 2)
+
+def route_day_sql(v2: bool) -> tuple[str, str, str, str]:
+    # куски SQL для пересчёта дней маршрута набором: ключи дня (k.a, k.b, k.d),
+    # условие рейсов дня, группировка и текстовый ключ route_days. В v2 день
+    # маршрута ищется по целым ключам (idx_flights_v2_route), в route_days — текстом
+    if v2:
+        keys = "dep_city_id AS a, arr_city_id AS b, dep_ts / 86400 AS d"
+        match = "f.dep_city_id = k.a AND f.arr_city_id = k.b AND f.dep_ts >= k.d * 86400 AND f.dep_ts < k.d * 86400 + 86400"
+        group = "f.dep_city_id, f.arr_city_id, f.dep_ts / 86400"
+        names = """(SELECT name FROM cities WHERE city_id = f.dep_city_id) AS departure_city,
+                   (SELECT name FROM cities WHERE city_id = f.arr_city_id) AS arrival_city,
+                   date(f.dep_ts, 'unixepoch') AS flight_date"""
+    else:
+        keys = "departure_city AS a, arrival_city AS b, flight_date AS d"
+        match = "f.departure_city = k.a AND f.arrival_city = k.b AND f.flight_date = k.d"
+        group = "f.departure_city, f.arrival_city, f.flight_date"
+        names = "f.departure_city, f.arrival_city, f.flight_date"
+    return keys, match, group, names
+
+def refresh_route_day_prices(conn: sqlite3.Connection, fids: list[int] | None) -> None:
+    # минимальная цена календаря после пересчёта тарифов: дни изменённых рейсов
+    # или (fids=None) весь календарь — одним UPDATE ... FROM
+    keys, match, group, names = route_day_sql(schema_version(conn) >= SCHEMA_VERSION)
+    if fids is None:
+        src, args = "flights f", ()
+    else:
+        src, args = f"""(
+            SELECT DISTINCT {keys} FROM flights
+            WHERE flight_id IN (SELECT value FROM json_each(?))
+        ) k
+        JOIN flights f ON {match}""", (json.dumps(fids),)
+    conn.execute(f"""
+        UPDATE route_days SET min_price = m.min_price
+        FROM (
+            SELECT {names},
+                   MIN(CASE WHEN p.seat_capacity - f.seats_booked - f.seats_held > 0 THEN fa.price_usd END) AS min_price
+            FROM {src}
+            JOIN planes p ON p.plane_id = f.plane_id
+            LEFT JOIN fares fa ON fa.flight_id = f.flight_id
+            GROUP BY {group}
+        ) AS m
+        WHERE route_days.departure_city = m.departure_city AND route_days.arrival_city = m.arrival_city
+          AND route_days.flight_date = m.flight_date AND route_days.min_price IS NOT m.min_price;
+    """, args)
+
+def rebuild_after_bulk(conn: sqlite3.Connection, after_fid: int) -> None:
+    # тарифы и календарь для рейсов с flight_id > after_fid — набором, вместо
+    # построчного trg_flights_ins_route_day (его снимает bulk_generate_flights).
+    # Дни, куда попали новые рейсы, считаются заново целиком: там могут быть и старые
+    keys, match, group, names = route_day_sql(schema_version(conn) >= SCHEMA_VERSION)
+    conn.execute(f"""
+        INSERT OR REPLACE INTO fares(flight_id, price_usd, version)
+        SELECT f.flight_id, {fare_sql()}, (SELECT version FROM fare_version WHERE id = 1)
+        {FARE_FROM}
+        WHERE f.flight_id > ?;
+    """, (after_fid,))
+    conn.execute(f"""
+        INSERT OR REPLACE INTO route_days(departure_city, arrival_city, flight_date, flights, seats_total, seats_free, min_price)
+        SELECT {names}, COUNT(*), SUM(p.seat_capacity),
+               SUM(p.seat_capacity - f.seats_booked - f.seats_held),
+               MIN(CASE WHEN p.seat_capacity - f.seats_booked - f.seats_held > 0 THEN fa.price_usd END)
+        FROM (SELECT DISTINCT {keys} FROM flights WHERE flight_id > ?) k
+        JOIN flights f ON {match}
+        JOIN planes p ON p.plane_id = f.plane_id
+        LEFT JOIN fares fa ON fa.flight_id = f.flight_id
+        GROUP BY {group};
+    """, (after_fid,))
+
+def route_day_key(row: str, v2: bool) -> tuple[str, str, str]:
+    # ключ строки route_days (город, город, день) для NEW/OLD рейса в триггере
+    if v2:
+        return (f"(SELECT name FROM cities WHERE city_id = {row}.dep_city_id)",
+                f"(SELECT name FROM cities WHERE city_id = {row}.arr_city_id)",
+                f"date({row}.dep_ts, 'unixepoch')")
+    return f"{row}.departure_city", f"{row}.arrival_city", f"{row}.flight_date"
+
+def route_day_recalc(row: str, v2: bool) -> str:
+    # пересчитать одну строку route_days с нуля (несколько рейсов по индексу маршрута)
+    dep, arr, day = route_day_key(row, v2)
+    if v2:
+        day0 = f"{row}.dep_ts / 86400 * 86400"
+        match = f"""f.dep_city_id = {row}.dep_city_id AND f.arr_city_id = {row}.arr_city_id
+                AND f.dep_ts >= {day0} AND f.dep_ts < {day0} + 86400"""
+        group = "f.dep_city_id"
+    else:
+        match = f"f.departure_city = {dep} AND f.arrival_city = {arr} AND f.flight_date = {day}"
+        group = "f.departure_city"
+    return f"""
+        DELETE FROM route_days WHERE departure_city = {dep} AND arrival_city = {arr} AND flight_date = {day};
+        INSERT INTO route_days(departure_city, arrival_city, flight_date, flights, seats_total, seats_free, min_price)
+        SELECT {dep}, {arr}, {day}, COUNT(*), SUM(p.seat_capacity),
+               SUM(p.seat_capacity - f.seats_booked - f.seats_held),
+               MIN(CASE WHEN p.seat_capacity - f.seats_booked - f.seats_held > 0 THEN fa.price_usd END)
+        FROM flights f
+        JOIN planes p ON p.plane_id = f.plane_id
+        LEFT JOIN fares fa ON fa.flight_id = f.flight_id
+        WHERE {match}
+        GROUP BY {group};
+    """
+
+FLIGHT_TRIGGERS = (
+    "trg_flights_upd_itinerary", "trg_flights_seats_fare",
+    "trg_flights_ins_route_day", "trg_flights_seats_route_day", "trg_flights_full_route_day",
+    "trg_flights_move_route_day", "trg_flights_del_route_day",
+    "trg_flights_insert_version", "trg_flights_update_version", "trg_flights_delete_version",
+)
+
+def create_flight_triggers(conn: sqlite3.Connection, v2: bool) -> None:
+    # Триггеры на flights пересоздаются при каждом старте и при подмене таблицы
+    # (swap_flights_v2): в v1 ключи — текстовые колонки, в v2 — целые.
+    # Тариф рейса ставят триггеры календаря первым шагом: порядок срабатывания
+    # разных триггеров SQLite не гарантирует.
+    for name in FLIGHT_TRIGGERS:
+        conn.execute(f"DROP TRIGGER IF EXISTS {name};")
+    if v2:
+        place = "dep_city_id, arr_city_id, dep_ts"
+        same_key = """
+            NEW.dep_city_id = OLD.dep_city_id AND NEW.arr_city_id = OLD.arr_city_id
+            AND NEW.dep_ts / 86400 = OLD.dep_ts / 86400 AND NEW.plane_id = OLD.plane_id
+        """
+    else:
+        place = "departure_city, arrival_city, flight_date, flight_time"
+        same_key = """
+            NEW.departure_city = OLD.departure_city AND NEW.arrival_city = OLD.arrival_city
+            AND NEW.flight_date = OLD.flight_date AND NEW.plane_id = OLD.plane_id
+        """
+    dep, arr, day = route_day_key("NEW", v2)
+
+    # seats_booked/seats_held сюда не входят — брони эти триггеры не трогают
+    conn.execute(f"""
+    CREATE TRIGGER trg_flights_upd_itinerary
+    AFTER UPDATE OF flight_number, {place}, plane_id ON flights
+    BEGIN
+        UPDATE itineraries
+        SET (flight_number, departure_city, arrival_city, flight_date, flight_time, plane_model, seat_capacity) = (
+            SELECT f.flight_number, f.departure_city, f.arrival_city, f.flight_date, f.flight_time, p.model, p.seat_capacity
+            FROM flights_text f JOIN planes p ON p.plane_id = f.plane_id
+            WHERE f.flight_id = NEW.flight_id
+        )
+        WHERE flight_id = NEW.flight_id;
+    END;
+    """)
+    conn.execute("""
+    CREATE TRIGGER trg_flights_seats_fare
+    AFTER UPDATE OF seats_booked ON flights
+    BEGIN
+        INSERT OR IGNORE INTO fare_dirty(flight_id) VALUES (NEW.flight_id);
+    END;
+    """)
+
+    # календарь: вставка и бронь — дельтой, удаление/перенос/заполнение рейса — пересчётом строки
+    conn.execute(f"""
+    CREATE TRIGGER trg_flights_ins_route_day
+    AFTER INSERT ON flights
+    BEGIN
+        INSERT OR REPLACE INTO fares(flight_id, price_usd, version)
+        SELECT f.flight_id, {fare_sql()}, (SELECT version FROM fare_version WHERE id = 1)
+        {FARE_FROM}
+        WHERE f.flight_id = NEW.flight_id;
+
+        INSERT INTO route_days(departure_city, arrival_city, flight_date, flights, seats_total, seats_free, min_price)
+        SELECT {dep}, {arr}, {day}, 1, p.seat_capacity,
+               p.seat_capacity - NEW.seats_booked - NEW.seats_held,
+               CASE WHEN p.seat_capacity - NEW.seats_booked - NEW.seats_held > 0
+                    THEN (SELECT price_usd FROM fares WHERE flight_id = NEW.flight_id) END
+        FROM planes p WHERE p.plane_id = NEW.plane_id
+        ON CONFLICT(departure_city, arrival_city, flight_date) DO UPDATE
+        SET flights = flights + 1,
+            seats_total = seats_total + excluded.seats_total,
+            seats_free = seats_free + excluded.seats_free,
+            min_price = CASE
+                WHEN excluded.min_price IS NULL THEN min_price
+                WHEN min_price IS NULL THEN excluded.min_price
+                ELSE MIN(min_price, excluded.min_price)
+            END;
+    END;
+    """)
+    crosses = """
+        ((SELECT seat_capacity FROM planes WHERE plane_id = NEW.plane_id) - OLD.seats_booked - OLD.seats_held > 0)
+        <> ((SELECT seat_capacity FROM planes WHERE plane_id = NEW.plane_id) - NEW.seats_booked - NEW.seats_held > 0)
+    """
+    conn.execute(f"""
+    CREATE TRIGGER trg_flights_seats_route_day
+    AFTER UPDATE OF seats_booked, seats_held ON flights
+    WHEN {same_key} AND NOT {crosses}
+    BEGIN
+        UPDATE route_days
+        SET seats_free = seats_free + (OLD.seats_booked + OLD.seats_held) - (NEW.seats_booked + NEW.seats_held)
+        WHERE departure_city = {dep} AND arrival_city = {arr} AND flight_date = {day};
+    END;
+    """)
+    # рейс заполнился или снова появились места — меняется минимальная цена
+    conn.execute(f"""
+    CREATE TRIGGER trg_flights_full_route_day
+    AFTER UPDATE OF seats_booked, seats_held ON flights
+    WHEN {same_key} AND {crosses}
+    BEGIN
+        {route_day_recalc('NEW', v2)}
+    END;
+    """)
+    conn.execute(f"""
+    CREATE TRIGGER trg_flights_move_route_day
+    AFTER UPDATE OF flight_id, {place}, plane_id ON flights
+    BEGIN
+        DELETE FROM fares WHERE flight_id = OLD.flight_id;
+        INSERT OR REPLACE INTO fares(flight_id, price_usd, version)
+        SELECT f.flight_id, {fare_sql()}, (SELECT version FROM fare_version WHERE id = 1)
+        {FARE_FROM}
+        WHERE f.flight_id = NEW.flight_id;
+        {route_day_recalc('OLD', v2)}
+        {route_day_recalc('NEW', v2)}
+    END;
+    """)
+    conn.execute(f"""
+    CREATE TRIGGER trg_flights_del_route_day
+    AFTER DELETE ON flights
+    BEGIN
+        DELETE FROM fares WHERE flight_id = OLD.flight_id;
+        DELETE FROM fare_dirty WHERE flight_id = OLD.flight_id;
+        {route_day_recalc('OLD', v2)}
+    END;
+    """)
+
+    # версия расписания: триггеры — только на правку и удаление рейсов (редкие,
+    # в т.ч. руками). Вставки, брони и удержания поднимают её сами, раз на
+    # транзакцию (bump_schedule_version): построчный UPDATE одной строки
+    # schedule_version тормозил массовые вставки
+    conn.execute(f"""
+    CREATE TRIGGER trg_flights_update_version
+    AFTER UPDATE OF flight_number, {place}, plane_id ON flights
+    BEGIN
+        UPDATE schedule_version SET version = version + 1 WHERE id = 1;
+    END;
+    """)
+    conn.execute("""
+    CREATE TRIGGER trg_flights_delete_version
+    AFTER DELETE ON flights
+    BEGIN
+        UPDATE schedule_version SET version = version + 1 WHERE id = 1;
+    END;
+    """)
+
+def bump_schedule_version(conn: sqlite3.Connection) -> None:
+    # одна запись на транзакцию: новые рейсы, места (брони, удержания), цены
+    conn.execute("UPDATE schedule_version SET version = version + 1 WHERE id = 1;")
 
 # =========================
 # DB INIT + SEED
@@ -128,42 +1022,13 @@ def db_init() -> None:
         );
         """)
 
-        # requests for codes
-        conn.execute("""
-        CREATE TABLE IF NOT EXISTS tg_code_requests (
-            request_id TEXT PRIMARY KEY,
-            username   TEXT NOT NULL,
-            purpose    TEXT NOT NULL,     -- 'register' | 'login' | 'booking'
-            code       TEXT,
-            status     TEXT NOT NULL,     -- 'pending' | 'sent' | 'used' | 'cancelled'
-            payload    TEXT,              -- JSON
-            created_at TEXT NOT NULL,
-            sent_at    TEXT,
-            used_at    TEXT
-        );
-        """)
+        # requests for codes, notifications: очереди отправки. Старая схема (ISO-времена,
+        # колонка created_at) переезжает на v2 целиком до создания индексов
+        for table, archive, _ in RETENTION_TABLES:
+            if table_exists(conn, table) and "created_at" in table_cols(conn, table):
+                migrate_queue_v1(conn, table, archive)
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {table} ({QUEUE_COLUMNS[table]});")
 
-        conn.execute("""
-        CREATE INDEX IF NOT EXISTS idx_tg_code_pending
-        ON tg_code_requests(status, created_at);
-        """)
-
-        # notifications (optional, but nice)
-        conn.execute("""
-        CREATE TABLE IF NOT EXISTS tg_notifications (
-            notif_id   INTEGER PRIMARY KEY AUTOINCREMENT,
-            username   TEXT NOT NULL,
-            message    TEXT NOT NULL,
-            status     TEXT NOT NULL,     -- 'pending' | 'sent'
-            created_at TEXT NOT NULL,
-            sent_at    TEXT
-        );
-        """)
-
-        conn.execute("""
-        CREATE INDEX IF NOT EXISTS idx_tg_notif_pending
-        ON tg_notifications(status, created_at);
-        """)
 
         # sessions
         conn.execute("""
@@ -177,6 +1042,13 @@ def db_init() -> None:
         CREATE INDEX IF NOT EXISTS idx_sessions_user
         ON sessions(username);
         """)
+        if ensure_column(conn, "sessions", "expires_at TEXT"):
+            # старые бессрочные сессии: отсчитываем TTL от момента миграции
+            conn.execute("UPDATE sessions SET expires_at=? WHERE expires_at IS NULL;", (utc_iso_in(SESSION_TTL),))
+        conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_sessions_expires
+        ON sessions(expires_at);
+        """)
 
         # core airline tables
         conn.execute("""
@@ -200,27 +1072,47 @@ def db_init() -> None:
         );
         """)
 
+        # словарь городов: в схеме v2 рейс хранит только их id
         conn.execute("""
-        CREATE TABLE IF NOT EXISTS flights (
-            flight_id      INTEGER PRIMARY KEY AUTOINCREMENT,
-            plane_id       INTEGER NOT NULL,
-            flight_number  TEXT NOT NULL,
-            departure_city TEXT NOT NULL,
-            arrival_city   TEXT NOT NULL,
-            flight_date    TEXT NOT NULL,   -- YYYY-MM-DD
-            flight_time    TEXT NOT NULL    -- HH:MM
+        CREATE TABLE IF NOT EXISTS cities (
+            city_id INTEGER PRIMARY KEY,
+            name    TEXT NOT NULL UNIQUE
         );
         """)
+        conn.executemany("INSERT OR IGNORE INTO cities(name) VALUES (?);", [(x,) for x in CITY_DIRECTORY])
+
+        # flights: новая база — сразу v2 (create_flights_v2). Старую (текстовые город,
+        # дата, время) онлайн переносит migrate_schema_v2(), до подмены работаем по v1
+        if not table_exists(conn, "flights"):
+            create_flights_v2(conn, "flights")
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION};")
+        v2 = schema_version(conn) >= SCHEMA_VERSION
+
+        if not v2:
+            # сортировка выдачи идёт по (date, time) — индекс отдаёт её без temp b-tree
+            conn.execute("DROP INDEX IF EXISTS idx_flights_date;")
+            conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_flights_date_time
+            ON flights(flight_date, flight_time);
+            """)
 
-        conn.execute("""
-        CREATE INDEX IF NOT EXISTS idx_flights_date
-        ON flights(flight_date);
-        """)
+            # маршрут + (date, time, rowid) — keyset-страницы поиска без сортировки
+            conn.execute("DROP INDEX IF EXISTS idx_flights_route_date;")
+            conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_flights_route_date_time
+            ON flights(departure_city, arrival_city, flight_date, flight_time);
+            """)
 
-        conn.execute("""
-        CREATE INDEX IF NOT EXISTS idx_flights_route_date
-        ON flights(departure_city, arrival_city, flight_date);
-        """)
+            # поиск только по одному из городов: (город, date, time) отдаёт готовый порядок
+            conn.execute("DROP INDEX IF EXISTS idx_flights_arr_date;")
+            conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_flights_dep_date
+            ON flights(departure_city, flight_date, flight_time);
+            """)
+            conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_flights_arr_date_time
+            ON flights(arrival_city, flight_date, flight_time);
+            """)
 
         conn.execute("""
         CREATE TABLE IF NOT EXISTS ticket_statuses (
@@ -245,11 +1137,300 @@ def db_init() -> None:
         ON tickets(flight_id, seat_no);
         """)
 
+        # "мои рейсы" постранично по ticket_id
+        conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_tickets_passenger
+        ON tickets(passenger_id, ticket_id);
+        """)
+
+        # удержания мест: одно на место, истёкшее можно перехватить, GC чистит
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS seat_holds (
+            flight_id   INTEGER NOT NULL,
+            seat_no     TEXT NOT NULL,
+            username    TEXT NOT NULL,
+            request_id  TEXT NOT NULL,
+            expires_at  TEXT NOT NULL,
+            PRIMARY KEY (flight_id, seat_no)
+        );
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_seat_holds_user ON seat_holds(username);")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_seat_holds_expires ON seat_holds(expires_at);")
+
+        # счётчик занятых мест на рейсе — ведут триггеры на tickets
+        if ensure_column(conn, "flights", "seats_booked INTEGER NOT NULL DEFAULT 0"):
+            conn.execute("""
+                UPDATE flights
+                SET seats_booked = (SELECT COUNT(*) FROM tickets t WHERE t.flight_id = flights.flight_id);
+            """)
+        # счётчик удержаний на рейсе — для seats_free в поиске (до GC считает и истёкшие)
+        if ensure_column(conn, "flights", "seats_held INTEGER NOT NULL DEFAULT 0"):
+            conn.execute("""
+                UPDATE flights
+                SET seats_held = (SELECT COUNT(*) FROM seat_holds h WHERE h.flight_id = flights.flight_id);
+            """)
+        # рейс с текстовыми полями — для агрегатов и выдачи в обеих схемах
+        create_flights_view(conn, v2)
+
+        # "мои рейсы" готовыми строками: ключ (passenger_id, ticket_id) — страница
+        # это один диапазон по первичному ключу, без JOIN. Ведут триггеры, т.е.
+        # строка появляется в той же транзакции, что и билет.
+        fresh = not conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='itineraries';"
+        ).fetchone()
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS itineraries (
+            passenger_id   TEXT NOT NULL,
+            ticket_id      INTEGER NOT NULL,
+            seat_no        TEXT NOT NULL,
+            price_usd      REAL NOT NULL,
+            flight_id      INTEGER NOT NULL,
+            flight_number  TEXT NOT NULL,
+            departure_city TEXT NOT NULL,
+            arrival_city   TEXT NOT NULL,
+            flight_date    TEXT NOT NULL,
+            flight_time    TEXT NOT NULL,
+            plane_model    TEXT NOT NULL,
+            seat_capacity  INTEGER NOT NULL,
+            PRIMARY KEY (passenger_id, ticket_id)
+        ) WITHOUT ROWID;
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_itineraries_flight ON itineraries(flight_id);")
+        # строка берётся из flights_text — пересоздаём: вид раньше был таблицей flights
+        conn.execute("DROP TRIGGER IF EXISTS trg_tickets_ins_itinerary;")
+        conn.execute("DROP TRIGGER IF EXISTS trg_tickets_upd_itinerary;")
+        conn.execute(f"""
+        CREATE TRIGGER trg_tickets_ins_itinerary
+        AFTER INSERT ON tickets
+        BEGIN
+            INSERT OR REPLACE INTO itineraries({ITINERARY_COLS})
+            {ITINERARY_SELECT} WHERE t.ticket_id = NEW.ticket_id;
+        END;
+        """)
+        conn.execute(f"""
+        CREATE TRIGGER trg_tickets_upd_itinerary
+        AFTER UPDATE ON tickets
+        BEGIN
+            DELETE FROM itineraries WHERE passenger_id = OLD.passenger_id AND ticket_id = OLD.ticket_id;
+            INSERT OR REPLACE INTO itineraries({ITINERARY_COLS})
+            {ITINERARY_SELECT} WHERE t.ticket_id = NEW.ticket_id;
+        END;
+        """)
+        conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_tickets_del_itinerary
+        AFTER DELETE ON tickets
+        BEGIN
+            DELETE FROM itineraries WHERE passenger_id = OLD.passenger_id AND ticket_id = OLD.ticket_id;
+        END;
+        """)
+        conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_planes_upd_itinerary
+        AFTER UPDATE OF model, seat_capacity ON planes
+        BEGIN
+            UPDATE itineraries
+            SET plane_model = NEW.model, seat_capacity = NEW.seat_capacity
+            WHERE flight_id IN (SELECT flight_id FROM flights WHERE plane_id = NEW.plane_id);
+        END;
+        """)
+        if fresh:
+            conn.execute(f"INSERT OR REPLACE INTO itineraries({ITINERARY_COLS}) {ITINERARY_SELECT};")
+
         # --- migrations (на случай старых версий) ---
-        ensure_column(conn, "tg_code_requests", "purpose TEXT")
-        ensure_column(conn, "tg_code_requests", "payload TEXT")
         ensure_column(conn, "tg_users", "created_at TEXT")
         ensure_column(conn, "tg_users", "updated_at TEXT")
+        ensure_column(conn, "tg_code_requests", "code_fails INTEGER NOT NULL DEFAULT 0")
+
+        # вставка без next_attempt_ts (руками, старый код) — сразу в очередь
+        for table, _, _ in RETENTION_TABLES:
+            conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_due_ts
+            AFTER INSERT ON {table}
+            WHEN NEW.next_attempt_ts IS NULL
+            BEGIN
+                UPDATE {table} SET next_attempt_ts = NEW.created_ts WHERE rowid = NEW.rowid;
+            END;
+            """)
+
+        # скан очереди идёт только по тем, кому уже пора; индекс частичный —
+        # в нём только 'pending', завершённые строки его не раздувают
+        conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_tg_code_pending_due_ts
+        ON tg_code_requests(next_attempt_ts)
+        WHERE status='pending';
+        """)
+        conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_tg_notif_pending_due_ts
+        ON tg_notifications(next_attempt_ts)
+        WHERE status='pending';
+        """)
+
+        # одноразовые коды: хэш + срок; активный запрос на (username, purpose) — один
+        conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_tg_code_active
+        ON tg_code_requests(username, purpose, created_ts)
+        WHERE status IN ('pending', 'sent', 'failed');
+        """)
+
+        # ретеншн выбирает старые строки по created_ts
+        conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_tg_code_created_ts
+        ON tg_code_requests(created_ts);
+        """)
+        conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_tg_notif_created_ts
+        ON tg_notifications(created_ts);
+        """)
+
+        conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_tickets_ins_seats
+        AFTER INSERT ON tickets
+        BEGIN
+            UPDATE flights SET seats_booked = seats_booked + 1 WHERE flight_id = NEW.flight_id;
+        END;
+        """)
+        conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_tickets_del_seats
+        AFTER DELETE ON tickets
+        BEGIN
+            UPDATE flights SET seats_booked = seats_booked - 1 WHERE flight_id = OLD.flight_id;
+        END;
+        """)
+        conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_tickets_move_seats
+        AFTER UPDATE OF flight_id ON tickets
+        WHEN NEW.flight_id <> OLD.flight_id
+        BEGIN
+            UPDATE flights SET seats_booked = seats_booked - 1 WHERE flight_id = OLD.flight_id;
+            UPDATE flights SET seats_booked = seats_booked + 1 WHERE flight_id = NEW.flight_id;
+        END;
+        """)
+
+        conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_seat_holds_ins
+        AFTER INSERT ON seat_holds
+        BEGIN
+            UPDATE flights SET seats_held = seats_held + 1 WHERE flight_id = NEW.flight_id;
+        END;
+        """)
+        conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_seat_holds_del
+        AFTER DELETE ON seat_holds
+        BEGIN
+            UPDATE flights SET seats_held = seats_held - 1 WHERE flight_id = OLD.flight_id;
+        END;
+        """)
+
+        # тарифы: цена каждого рейса лежит в fares с номером прогона (version),
+        # в котором она последний раз менялась. Пересчёт — reprice_fares(),
+        # одним INSERT ... SELECT; fare_dirty — рейсы, где менялась загрузка.
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS route_fares (
+            departure_city TEXT NOT NULL,
+            arrival_city   TEXT NOT NULL,
+            base_usd       REAL NOT NULL,
+            PRIMARY KEY (departure_city, arrival_city)
+        ) WITHOUT ROWID;
+        """)
+        before = conn.total_changes
+        conn.executemany("""
+            INSERT INTO route_fares(departure_city, arrival_city, base_usd) VALUES (?, ?, ?)
+            ON CONFLICT(departure_city, arrival_city) DO UPDATE SET base_usd = excluded.base_usd
+            WHERE base_usd <> excluded.base_usd;
+        """, [(a, b, route_base_fare(a, b)) for a in CITY_COORDS for b in CITY_COORDS if a != b])
+        bases_changed = conn.total_changes != before
+
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS fare_version (
+            id        INTEGER PRIMARY KEY CHECK (id = 1),
+            version   INTEGER NOT NULL,
+            priced_on TEXT,                -- день (UTC), на который цены актуальны
+            priced_at TEXT
+        );
+        """)
+        conn.execute("INSERT OR IGNORE INTO fare_version(id, version) VALUES (1, 0);")
+        if bases_changed:
+            # база поменялась — следующий прогон будет полным
+            conn.execute("UPDATE fare_version SET priced_on = NULL WHERE id = 1;")
+
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS fare_dirty (
+            flight_id INTEGER PRIMARY KEY
+        );
+        """)
+        fresh_fares = not conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='fares';"
+        ).fetchone()
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS fares (
+            flight_id INTEGER PRIMARY KEY,
+            price_usd REAL NOT NULL,
+            version   INTEGER NOT NULL
+        );
+        """)
+        if fresh_fares:
+            conn.execute(f"""
+                INSERT INTO fares(flight_id, price_usd, version)
+                SELECT f.flight_id, {fare_sql()}, 0
+                {FARE_FROM};
+            """)
+
+        # календарь: маршрут x день -> число рейсов, места, минимальная цена среди
+        # рейсов со свободными местами. Ведут триггеры на flights (create_flight_triggers).
+        fresh = not conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='route_days';"
+        ).fetchone()
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS route_days (
+            departure_city TEXT NOT NULL,
+            arrival_city   TEXT NOT NULL,
+            flight_date    TEXT NOT NULL,
+            flights        INTEGER NOT NULL,
+            seats_total    INTEGER NOT NULL,
+            seats_free     INTEGER NOT NULL,
+            min_price      REAL,
+            PRIMARY KEY (departure_city, arrival_city, flight_date)
+        ) WITHOUT ROWID;
+        """)
+        if fresh:
+            conn.execute("""
+                INSERT INTO route_days(departure_city, arrival_city, flight_date, flights, seats_total, seats_free, min_price)
+                SELECT f.departure_city, f.arrival_city, f.flight_date, COUNT(*), SUM(p.seat_capacity),
+                       SUM(p.seat_capacity - f.seats_booked - f.seats_held),
+                       MIN(CASE WHEN p.seat_capacity - f.seats_booked - f.seats_held > 0 THEN fa.price_usd END)
+                FROM flights_text f
+                JOIN planes p ON p.plane_id = f.plane_id
+                LEFT JOIN fares fa ON fa.flight_id = f.flight_id
+                GROUP BY f.departure_city, f.arrival_city, f.flight_date;
+            """)
+
+        if fresh_fares and not fresh:
+            # календарь уже был — минимальные цены переводим на тарифы
+            refresh_route_day_prices(conn, None)
+
+        # версия расписания — по ней инвалидируется кэш поиска
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS schedule_version (
+            id      INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL
+        );
+        """)
+        conn.execute("INSERT OR IGNORE INTO schedule_version(id, version) VALUES (1, 0);")
+
+        # состояние онлайн-миграций (migrate_schema_v2): докуда дошла копия
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migration (
+            name TEXT PRIMARY KEY,
+            top  INTEGER NOT NULL,
+            done INTEGER NOT NULL
+        );
+        """)
+
+        # все триггеры flights (календарь, тарифы, itineraries, версия) — под текущую схему
+        create_flight_triggers(conn, v2)
+
+        # архивы — после всех миграций колонок, чтобы совпадал набор полей
+        ensure_archive_table(conn, "tg_code_requests", "tg_code_requests_archive")
+        ensure_archive_table(conn, "tg_notifications", "tg_notifications_archive")
 
         conn.commit()
 
@@ -286,17 +1467,30 @@ def seed_planes(conn: sqlite3.Connection) -> None:
         planes
     )
 
+FLIGHT_HOURS = [6, 8, 10, 12, 14, 16, 18, 20, 22]
+FLIGHT_MINUTES = [0, 15, 30, 45]
+
+def flight_number(k: int) -> str:
+    # AB123 style; уникален для k < 152100 (CRT по 676 и 900)
+    letters = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    a = letters[(k // 26) % 26]
+    b = letters[k % 26]
+    num = 100 + (k * 7) % 900
+    return f"{a}{b}{num}"
+
+def line_number(k: int) -> str:
+    # номер регулярной линии для bulk: AB1000..ZZ9999, уникален для k < 6 084 000
+    letters = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    hi, lo = divmod(k, 9000)
+    return f"{letters[(hi // 26) % 26]}{letters[hi % 26]}{1000 + lo}"
+
 def seed_flights_if_needed(conn: sqlite3.Connection, target: int = 300) -> None:
+    # только для db_init: COUNT(*) здесь один раз на старте, не на каждый запрос
     cnt = int(conn.execute("SELECT COUNT(*) AS c FROM flights;").fetchone()["c"])
     if cnt >= target:
         return
 
-    cities = [
-        "Minsk, BY", "Warsaw, PL", "Berlin, DE", "Prague, CZ", "Vienna, AT",
-        "Riga, LV", "Vilnius, LT", "Paris, FR", "Rome, IT", "Madrid, ES",
-        "London, UK", "Oslo, NO", "Stockholm, SE", "Helsinki, FI", "Zurich, CH",
-        "Istanbul, TR", "Athens, GR", "Budapest, HU", "Brussels, BE", "Dublin, IE",
-    ]
+    cities = list(CITY_DIRECTORY)
 
     plane_ids = [int(r["plane_id"]) for r in conn.execute("SELECT plane_id FROM planes;").fetchall()]
     rnd = random.Random(1337)
@@ -305,17 +1499,10 @@ def seed_flights_if_needed(conn: sqlite3.Connection, target: int = 300) -> None:
 
     to_add = target - cnt
     rows = []
-    used_numbers = {r["flight_number"] for r in conn.execute("SELECT flight_number FROM flights;").fetchall()}
-
-    def gen_number(k: int) -> str:
-        # AB123 style
-        letters = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
-        a = letters[(k // 26) % 26]
-        b = letters[k % 26]
-        num = 100 + (k * 7) % 900
-        return f"{a}{b}{num}"
 
-    k = cnt + 1
+    # номера идут от max(flight_id), flight_number() на этом диапазоне не повторяется —
+    # читать все существующие номера не нужно
+    k = int(conn.execute("SELECT COALESCE(MAX(flight_id), 0) AS m FROM flights;").fetchone()["m"]) + 1
     while len(rows) < to_add:
         dep = rnd.choice(cities)
         arr = rnd.choice(cities)
@@ -324,28 +1511,706 @@ def seed_flights_if_needed(conn: sqlite3.Connection, target: int = 300) -> None:
         plane_id = rnd.choice(plane_ids)
 
         d = start_date + timedelta(days=rnd.randint(0, 365))
-        t_h = rnd.choice([6, 8, 10, 12, 14, 16, 18, 20, 22])
-        t_m = rnd.choice([0, 15, 30, 45])
+        t_h = rnd.choice(FLIGHT_HOURS)
+        t_m = rnd.choice(FLIGHT_MINUTES)
         fdate = d.isoformat()
         ftime = f"{t_h:02d}:{t_m:02d}"
 
-        fn = gen_number(k)
+        rows.append((plane_id, flight_number(k), dep, arr, fdate, ftime))
         k += 1
-        if fn in used_numbers:
+
+    insert_flights(conn, rows)
+
+def insert_flights(conn: sqlite3.Connection, rows: list[tuple]) -> None:
+    # (plane_id, flight_number, dep, arr, date, time); в v2 — id городов и epoch вылета.
+    # До подмены таблицы пишем текст: копию в flights_v2 ведут триггеры миграции
+    if schema_version(conn) < SCHEMA_VERSION:
+        conn.executemany("""
+            INSERT INTO flights(plane_id, flight_number, departure_city, arrival_city, flight_date, flight_time)
+            VALUES (?, ?, ?, ?, ?, ?);
+        """, rows)
+    else:
+        ids = city_ids(conn, [x for r in rows for x in (r[2], r[3])])
+        conn.executemany("""
+            INSERT INTO flights(plane_id, flight_number, dep_city_id, arr_city_id, dep_ts)
+            VALUES (?, ?, ?, ?, ?);
+        """, [(r[0], r[1], ids[r[2]], ids[r[3]], sched_ts(r[4], r[5])) for r in rows])
+    bump_schedule_version(conn)
+
+def iter_schedule(total: int, seed: int, plane_ids: list[int], days: int, start_date):
+    # Регулярное расписание: набор линий (маршрут + номер + время + борт),
+    # каждая летает ежедневно. Строки идут по дням — вставка ложится в индексы
+    # почти последовательно. Один seed -> одно и то же расписание.
+    rnd = random.Random(seed)
+    cities = list(CITY_DIRECTORY)
+    pairs = [(a, b) for a in cities for b in cities if a != b]
+    rnd.shuffle(pairs)
+
+    n_lines = max(1, -(-total // max(1, days)))
+    lines = []
+    for k in range(n_lines):
+        dep, arr = pairs[k % len(pairs)]
+        ftime = f"{rnd.choice(FLIGHT_HOURS):02d}:{rnd.choice(FLIGHT_MINUTES):02d}"
+        lines.append((rnd.choice(plane_ids), line_number(k), dep, arr, ftime))
+
+    produced = 0
+    for day in range(days):
+        fdate = (start_date + timedelta(days=day)).isoformat()
+        for plane_id, fn, dep, arr, ftime in lines:
+            if produced >= total:
+                return
+            yield (plane_id, fn, dep, arr, fdate, ftime)
+            produced += 1
+
+def bulk_generate_flights(
+    conn: sqlite3.Connection,
+    total: int,
+    seed: int = 1337,
+    days: int = 365,
+    chunk: int = 50_000,
+    progress=None,
+) -> int:
+    plane_ids = [int(r["plane_id"]) for r in conn.execute("SELECT plane_id FROM planes ORDER BY plane_id;").fetchall()]
+    if not plane_ids:
+        raise RuntimeError("planes пустая — сначала db_init()")
+
+    start_date = datetime.now().date() + timedelta(days=1)
+    rows = iter_schedule(total, seed, plane_ids, days, start_date)
+
+    done = 0
+    while True:
+        batch = list(itertools.islice(rows, chunk))
+        if not batch:
+            break
+        # построчный триггер тарифа и календаря снимаем на время пачки и
+        # досчитываем набором; всё в одной транзакции — другие соединения
+        # триггер без себя не увидят
+        with conn:
+            top = conn.execute("SELECT COALESCE(MAX(flight_id), 0) FROM flights;").fetchone()[0]
+            conn.execute("DROP TRIGGER IF EXISTS trg_flights_ins_route_day;")
+            insert_flights(conn, batch)
+            rebuild_after_bulk(conn, top)
+            create_flight_triggers(conn, schema_version(conn) >= SCHEMA_VERSION)
+        done += len(batch)
+        if progress:
+            progress(done, total)
+    return done
+
+# =========================
+# CITY INDEX
+# =========================
+
+class CityIndex:
+    # Нормализованный словарь городов: полное имя, слова имени, IATA и алиасы
+    # лежат в отсортированном списке ключей — префикс ищется bisect'ом.
+    # Fuzzy (difflib) — только если ни точного, ни префиксного совпадения нет.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cities: set[str] = set()
+        self._exact: dict[str, set[str]] = {}
+        self._keys: list[str] = []
+        self.version = -1       # версия расписания, на которую словарь дочитан
+        self.last_city_id = 0   # докуда дочитан словарь cities (v2)
+        self.last_flight_id = 0  # докуда дочитаны города рейсов (v1)
+
+    def __len__(self) -> int:
+        return len(self._cities)
+
+    def _city_keys(self, city: str) -> set[str]:
+        full = norm_text(city)
+        keys = {full, *full.split()}
+        iata, aliases = CITY_DIRECTORY.get(city, ("", ()))
+        if iata:
+            keys.add(norm_text(iata))
+        keys.update(norm_text(a) for a in aliases)
+        keys.discard("")
+        return keys
+
+    def add(self, city: str) -> None:
+        city = (city or "").strip()
+        if not city or city in self._cities:
+            return
+        with self._lock:
+            if city in self._cities:
+                return
+            self._cities.add(city)
+            for k in self._city_keys(city):
+                have = self._exact.get(k)
+                if have is None:
+                    self._exact[k] = {city}
+                    bisect.insort(self._keys, k)
+                else:
+                    have.add(city)
+
+    def add_many(self, cities) -> None:
+        for c in cities:
+            self.add(c)
+
+    def _prefix(self, q: str) -> set[str]:
+        out: set[str] = set()
+        i = bisect.bisect_left(self._keys, q)
+        while i < len(self._keys) and self._keys[i].startswith(q):
+            out |= self._exact[self._keys[i]]
+            i += 1
+        return out
+
+    def resolve(self, q: str) -> list[str]:
+        qn = norm_text(q)
+        if not qn:
+            return []
+        hit = self._exact.get(qn)
+        if hit:
+            return sorted(hit)
+        hit = self._prefix(qn)
+        if hit:
+            return sorted(hit)
+        out: set[str] = set()
+        for k in difflib.get_close_matches(qn, self._keys, n=5, cutoff=CITY_FUZZY_CUTOFF):
+            out |= self._exact[k]
+        return sorted(out)
+
+    def all(self) -> list[str]:
+        return sorted(self._cities)
+
+_CITY_INDEX: CityIndex | None = None
+_CITY_INDEX_LOCK = threading.Lock()
+
+def load_city_names(idx: CityIndex) -> None:
+    # дочитываем только новое — диапазоном первичного ключа, без скана flights
+    with db_read() as conn:
+        if schema_version(conn) >= SCHEMA_VERSION:
+            # v2: все города рейсов уже в словаре
+            rows = conn.execute(
+                "SELECT city_id, name FROM cities WHERE city_id > ? ORDER BY city_id;", (idx.last_city_id,)
+            ).fetchall()
+            idx.add_many(r[1] for r in rows)
+            if rows:
+                idx.last_city_id = int(rows[-1][0])
+        else:
+            top = int(conn.execute("SELECT COALESCE(MAX(flight_id), 0) FROM flights;").fetchone()[0])
+            if not idx.last_flight_id:
+                # первый раз — оба запроса идут по индексам (route_date / arr_date), без скана таблицы
+                idx.add_many(r[0] for r in conn.execute("SELECT DISTINCT departure_city FROM flights;"))
+                idx.add_many(r[0] for r in conn.execute("SELECT DISTINCT arrival_city FROM flights;"))
+            elif top > idx.last_flight_id:
+                idx.add_many(c for r in conn.execute("""
+                    SELECT departure_city, arrival_city FROM flights WHERE flight_id > ? AND flight_id <= ?;
+                """, (idx.last_flight_id, top)) for c in r)
+            idx.last_flight_id = top
+
+def city_index() -> CityIndex:
+    # Дополняется, когда сменилась версия расписания: рейсы с новыми городами
+    # мог вставить seed/bulk из CLI, другой процесс или миграция. Пока один поток
+    # дочитывает, остальные ищут по тому, что есть (add потокобезопасен)
+    global _CITY_INDEX
+    v = SEARCH_CACHE.version()
+    idx = _CITY_INDEX
+    if idx is not None and idx.version == v:
+        return idx
+    if not _CITY_INDEX_LOCK.acquire(blocking=idx is None):
+        return idx
+    try:
+        if _CITY_INDEX is None:
+            idx = CityIndex()
+            idx.add_many(CITY_DIRECTORY)
+            load_city_names(idx)
+            idx.version = v
+            _CITY_INDEX = idx
+        elif _CITY_INDEX.version != v:
+            load_city_names(_CITY_INDEX)
+            _CITY_INDEX.version = v
+    finally:
+        _CITY_INDEX_LOCK.release()
+    return _CITY_INDEX
+
+# =========================
+# SEAT INVENTORY
+# =========================
+
+class SeatLayout:
+    # раскладка салона: порядок мест фиксирован, бит i битмапа = seats[i]
+    __slots__ = ("layout_id", "capacity", "row_size", "seats", "index")
+
+    def __init__(self, capacity: int):
+        self.seats = tuple(seats_for_capacity(capacity))
+        self.capacity = len(self.seats)
+        self.row_size = 6
+        self.layout_id = f"{self.capacity // self.row_size}x{self.row_size}"
+        self.index = {s: i for i, s in enumerate(self.seats)}
+
+@functools.lru_cache(maxsize=None)
+def seat_layout(capacity: int) -> SeatLayout:
+    return SeatLayout(int(capacity))
+
+def bitmap_encode(bits: bytes | bytearray) -> str:
+    return base64.b64encode(bytes(bits)).decode("ascii")
+
+class SeatInventory:
+    # flight_id -> [layout, booked, loaded_at, held]; LRU + TTL.
+    # booked/held — битмапы продано/удержано. Своё бронирование и удержание
+    # отмечается сразу (mark/hold), чужое процесс увидит после TTL.
+    # Бит: байт i >> 3, маска 0x80 >> (i & 7).
+
+    def __init__(self, size: int = SEAT_CACHE_SIZE, ttl: float = SEAT_CACHE_TTL):
+        self.size = max(1, int(size))
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._items: OrderedDict[int, list] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _load(self, flight_id: int) -> list | None:
+        with db_read() as conn:
+            row = conn.execute("""
+                SELECT p.seat_capacity
+                FROM flights f
+                JOIN planes p ON p.plane_id=f.plane_id
+                WHERE f.flight_id=?;
+            """, (flight_id,)).fetchone()
+            if not row:
+                return None
+            layout = seat_layout(int(row["seat_capacity"]))
+            bits = bytearray((layout.capacity + 7) // 8)
+            held = bytearray(len(bits))
+            for r in conn.execute("SELECT seat_no FROM tickets WHERE flight_id=?;", (flight_id,)):
+                i = layout.index.get(r["seat_no"])
+                if i is not None:
+                    bits[i >> 3] |= 0x80 >> (i & 7)
+            for r in conn.execute("""
+                SELECT seat_no FROM seat_holds WHERE flight_id=? AND expires_at > ?;
+            """, (flight_id, now_utc_iso())):
+                i = layout.index.get(r["seat_no"])
+                if i is not None:
+                    held[i >> 3] |= 0x80 >> (i & 7)
+        return [layout, bits, time.monotonic(), held]
+
+    def get(self, flight_id: int) -> tuple[SeatLayout, bytes, bytes] | None:
+        flight_id = int(flight_id)
+        now = time.monotonic()
+        with self._lock:
+            item = self._items.get(flight_id)
+            if item is not None and now - item[2] < self.ttl:
+                self._items.move_to_end(flight_id)
+                self.hits += 1
+                return item[0], bytes(item[1]), bytes(item[3])
+
+        item = self._load(flight_id)
+        if item is None:
+            return None
+        with self._lock:
+            self.misses += 1
+            self._items[flight_id] = item
+            self._items.move_to_end(flight_id)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+            return item[0], bytes(item[1]), bytes(item[3])
+
+    def is_booked(self, flight_id: int, seat_no: str) -> bool:
+        got = self.get(flight_id)
+        if got is None:
+            return False
+        layout, bits, _ = got
+        i = layout.index.get(seat_no)
+        return i is not None and bool(bits[i >> 3] & (0x80 >> (i & 7)))
+
+    def _set(self, flight_id: int, seats, slot: int, on: bool) -> None:
+        with self._lock:
+            item = self._items.get(int(flight_id))
+            if item is None:
+                return
+            for seat_no in seats:
+                i = item[0].index.get(seat_no)
+                if i is None:
+                    continue
+                if on:
+                    item[slot][i >> 3] |= 0x80 >> (i & 7)
+                else:
+                    item[slot][i >> 3] &= ~(0x80 >> (i & 7)) & 0xFF
+
+    def mark(self, flight_id: int, seats) -> None:
+        self._set(flight_id, seats, 1, True)
+
+    def hold(self, flight_id: int, seats, on: bool = True) -> None:
+        self._set(flight_id, seats, 3, on)
+
+    def invalidate(self, flight_id: int) -> None:
+        with self._lock:
+            self._items.pop(int(flight_id), None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._items), "hits": self.hits, "misses": self.misses}
+
+SEATS = SeatInventory()
+
+def seat_delta(layout: SeatLayout, old: bytes, new: bytes) -> tuple[list[str], list[str]]:
+    booked, freed = [], []
+    for b, (x, y) in enumerate(zip(old, new)):
+        if x == y:
+            continue
+        for i in range(b << 3, min((b + 1) << 3, layout.capacity)):
+            m = 0x80 >> (i & 7)
+            if y & m and not x & m:
+                booked.append(layout.seats[i])
+            elif x & m and not y & m:
+                freed.append(layout.seats[i])
+    return booked, freed
+
+def seat_apply(layout: SeatLayout, bits: bytes, booked=(), freed=()) -> bytes:
+    out = bytearray(bits)
+    for seat, on in itertools.chain(((x, True) for x in booked), ((x, False) for x in freed)):
+        i = layout.index.get(seat)
+        if i is None:
             continue
-        used_numbers.add(fn)
+        if on:
+            out[i >> 3] |= 0x80 >> (i & 7)
+        else:
+            out[i >> 3] &= ~(0x80 >> (i & 7)) & 0xFF
+    return bytes(out)
+
+class SeatFeed:
+    # flight_id -> {queue: loop}; подписчики — SSE-потоки в цикле uvicorn.
+    # publish зовут из sync-эндпоинтов (тред-пул), отсюда call_soon_threadsafe.
+    # Брони других процессов поток увидит сам — сверкой с SEATS раз в SEAT_STREAM_POLL.
+
+    def __init__(self, limit: int = SEAT_STREAM_MAX):
+        self.limit = max(1, int(limit))
+        self._lock = threading.Lock()
+        self._subs: dict[int, dict[asyncio.Queue, asyncio.AbstractEventLoop]] = {}
+        self._count = 0
+        self.published = 0
+        self.dropped = 0
+
+    def subscribe(self, flight_id: int) -> asyncio.Queue | None:
+        q: asyncio.Queue = asyncio.Queue(maxsize=64)
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._count >= self.limit:
+                return None
+            self._subs.setdefault(int(flight_id), {})[q] = loop
+            self._count += 1
+        return q
+
+    def full(self) -> bool:
+        with self._lock:
+            return self._count >= self.limit
+
+    def unsubscribe(self, flight_id: int, q: asyncio.Queue) -> None:
+        with self._lock:
+            subs = self._subs.get(int(flight_id))
+            if subs is None or subs.pop(q, None) is None:
+                return
+            self._count -= 1
+            if not subs:
+                del self._subs[int(flight_id)]
+
+    def publish(self, flight_id: int, booked=(), freed=(), held=(), released=()) -> None:
+        event = {"booked": list(booked), "freed": list(freed), "held": list(held), "released": list(released)}
+        with self._lock:
+            subs = list(self._subs.get(int(flight_id), {}).items())
+            self.published += 1
+        for q, loop in subs:
+            try:
+                loop.call_soon_threadsafe(self._put, q, event)
+            except RuntimeError:
+                pass  # цикл уже закрыт
 
-        rows.append((plane_id, fn, dep, arr, fdate, ftime))
+    def _put(self, q: asyncio.Queue, event: dict) -> None:
+        try:
+            q.put_nowait(event)
+        except asyncio.QueueFull:
+            self.dropped += 1  # не страшно: догонит сверкой с кэшем
 
-    conn.executemany("""
-        INSERT INTO flights(plane_id, flight_number, departure_city, arrival_city, flight_date, flight_time)
-        VALUES (?, ?, ?, ?, ?, ?);
-    """, rows)
+    def stats(self) -> dict:
+        with self._lock:
+            return {"subscribers": self._count, "flights": len(self._subs),
+                    "published": self.published, "dropped": self.dropped}
+
+SEAT_FEED = SeatFeed()
+
+# =========================
+# ROUTE GRAPH
+# =========================
+
+@functools.lru_cache(maxsize=None)
+def leg_minutes(dep: str, arr: str) -> int:
+    # блок-тайм: большой круг на 780 км/ч + 30 минут на руление/набор, кратно 5
+    a, b = CITY_COORDS.get(dep), CITY_COORDS.get(arr)
+    if a is None or b is None:
+        return 120
+    la1, lo1, la2, lo2 = map(math.radians, (*a, *b))
+    h = math.sin((la2 - la1) / 2) ** 2 + math.cos(la1) * math.cos(la2) * math.sin((lo2 - lo1) / 2) ** 2
+    km = 2 * 6371 * math.asin(math.sqrt(h))
+    return int(round((km / 780 * 60 + 30) / 5)) * 5
+
+def schedule_minutes(fdate: str, ftime: str) -> int:
+    # минуты от 0001-01-01 — время расписания без часовых поясов
+    return date.fromisoformat(fdate).toordinal() * 1440 + int(ftime[:2]) * 60 + int(ftime[3:5])
+
+def minutes_text(t: int) -> str:
+    d, m = divmod(int(t), 1440)
+    return f"{date.fromordinal(d).isoformat()} {m // 60:02d}:{m % 60:02d}"
+
+class ScheduleGraph:
+    # Рейс = слот в параллельных массивах. Индексы по городу вылета и по паре
+    # городов: отсортированные минуты вылета + слоты (бинпоиск по окну стыковки).
+    # Граф, отданный поискам, не меняется: догрузка идёт в копию (fork), индексы
+    # в ней копируются, только когда их трогает extend.
+
+    def __init__(self):
+        self.cities: list[str] = []
+        self.city_id: dict[str, int] = {}
+        self.fid = array("q")
+        self.dst = array("i")
+        self.dep = array("q")
+        self.arr = array("q")
+        self.by_src: dict[int, tuple[array, array]] = {}
+        self.by_pair: dict[tuple[int, int], tuple[array, array]] = {}
+        self.max_fid = 0
+
+    def fork(self) -> "ScheduleGraph":
+        g = ScheduleGraph()
+        g.cities, g.city_id = list(self.cities), dict(self.city_id)
+        g.fid, g.dst = array("q", self.fid), array("i", self.dst)
+        g.dep, g.arr = array("q", self.dep), array("q", self.arr)
+        g.by_src, g.by_pair = dict(self.by_src), dict(self.by_pair)
+        g.max_fid = self.max_fid
+        return g
+
+    def cid(self, name: str) -> int:
+        i = self.city_id.get(name)
+        if i is None:
+            i = self.city_id[name] = len(self.cities)
+            self.cities.append(name)
+        return i
+
+    def extend(self, rows, ordered: bool) -> int:
+        # rows: (flight_id, откуда, куда, минуты вылета). ordered — строки уже по
+        # времени вылета: индексы просто дописываются, иначе вставка бинпоиском
+        pairs: dict[tuple[str, str], tuple] = {}
+        own_src: dict[int, tuple[array, array]] = {}
+        own_pair: dict[tuple[int, int], tuple[array, array]] = {}
+
+        def own(table: dict, mine: dict, key) -> tuple[array, array]:
+            # свой экземпляр индекса на вызов: прежний мог достаться от fork
+            idx = mine.get(key)
+            if idx is None:
+                old = table.get(key)
+                idx = (array("q", old[0]), array("i", old[1])) if old else (array("q"), array("i"))
+                mine[key] = table[key] = idx
+            return idx
+
+        n = 0
+        for fid, src, dst, t in rows:
+            p = pairs.get((src, dst))
+            if p is None:
+                s, d = self.cid(src), self.cid(dst)
+                p = pairs[(src, dst)] = (
+                    d, leg_minutes(src, dst),
+                    own(self.by_src, own_src, s),
+                    own(self.by_pair, own_pair, (s, d)),
+                )
+            d, dur, si, pi = p
+            slot = len(self.fid)
+            self.fid.append(fid)
+            self.dst.append(d)
+            self.dep.append(t)
+            self.arr.append(t + dur)
+            if ordered:
+                si[0].append(t)
+                si[1].append(slot)
+                pi[0].append(t)
+                pi[1].append(slot)
+            else:
+                for idx in (si, pi):
+                    i = bisect.bisect_right(idx[0], t)
+                    idx[0].insert(i, t)
+                    idx[1].insert(i, slot)
+            n += 1
+        if n:
+            self.max_fid = max(self.max_fid, max(self.fid[-n:]))
+        return n
+
+    def window(self, idx: tuple[array, array] | None, t0: int, t1: int):
+        if idx is None:
+            return range(0)
+        return range(bisect.bisect_left(idx[0], t0), bisect.bisect_right(idx[0], t1))
+
+def schedule_rows(conn: sqlite3.Connection, after_fid: int) -> sqlite3.Cursor:
+    # прошедшие дни в граф не берём; минуты вылета (как schedule_minutes) считает SQLite:
+    # julianday('0001-01-01') = 1721425.5, это ordinal 1.
+    # Полная загрузка — по индексу времени вылета (ordered), догрузка новых рейсов —
+    # диапазон первичного ключа: "+" у колонки не даёт планировщику взять индекс
+    # времени и просканировать все будущие рейсы ради пары новых
+    today = datetime.now(timezone.utc).date().isoformat()
+    if schema_version(conn) >= SCHEMA_VERSION:
+        # v2: минуты — прямо из dep_ts, порядок — по целому индексу idx_flights_v2_ts
+        cols = "flight_id, departure_city, arrival_city, dep_ts / 60 + ?"
+        base, since = EPOCH_ORDINAL * 1440, sched_ts(today)
+        if after_fid:
+            sql = f"SELECT {cols} FROM flights_text WHERE flight_id > ? AND +dep_ts >= ? ORDER BY flight_id;"
+            args = (base, after_fid, since)
+        else:
+            sql = f"SELECT {cols} FROM flights_text WHERE dep_ts >= ? ORDER BY dep_ts;"
+            args = (base, since)
+    else:
+        cols = """flight_id, departure_city, arrival_city,
+               CAST(julianday(flight_date) - 1721424.5 AS INTEGER) * 1440
+               + CAST(substr(flight_time, 1, 2) AS INTEGER) * 60
+               + CAST(substr(flight_time, 4, 2) AS INTEGER)"""
+        if after_fid:
+            sql = f"SELECT {cols} FROM flights WHERE flight_id > ? AND +flight_date >= ? ORDER BY flight_id;"
+            args = (after_fid, today)
+        else:
+            sql = f"SELECT {cols} FROM flights WHERE flight_date >= ? ORDER BY flight_date, flight_time;"
+            args = (today,)
+    return conn.execute(sql, args)
+
+def load_schedule(g: ScheduleGraph, after_fid: int) -> int:
+    with db_read() as conn:
+        return g.extend(schedule_rows(conn, after_fid), ordered=after_fid == 0)
+
+class RouteGraph:
+    # Расписание в памяти для поиска с пересадками. Новые рейсы докладываются
+    # по flight_id > max_fid, когда сменилась версия расписания. Полная
+    # пересборка (правки, удаления, ушедшие дни) — фоном из обслуживания
+    # (rebuild_routes). И то и другое строится в стороне и подменяется целиком
+    # под _lock; поиск берёт ссылку на текущий граф и обходит его без блокировки.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self.g: ScheduleGraph | None = None
+        self.version = -1
+        self.built_at = 0.0
+        self.searches = 0
+
+    def rebuild(self, missing_only: bool = False) -> int:
+        with self._build_lock:
+            if missing_only and self.g is not None:
+                return 0
+            v = SEARCH_CACHE.version()
+            g = ScheduleGraph()
+            n = load_schedule(g, 0)
+            with self._lock:
+                # пока строили, могли добавиться рейсы — доложатся на следующем refresh
+                self.g, self.version, self.built_at = g, v, time.monotonic()
+            return n
+
+    def refresh(self) -> None:
+        if self.g is None:
+            self.rebuild(missing_only=True)
+            return
+        v = SEARCH_CACHE.version()
+        if v == self.version:
+            return
+        # граф уже кто-то строит или догружает — ищем по текущему, не ждём
+        if not self._build_lock.acquire(blocking=False):
+            return
+        try:
+            if v == self.version:
+                return
+            g = self.g
+            with db_read() as conn:
+                rows = schedule_rows(conn, g.max_fid).fetchall()
+            if rows:
+                g = g.fork()
+                g.extend(rows, ordered=False)
+            with self._lock:
+                self.g, self.version = g, v
+        finally:
+            self._build_lock.release()
+
+    def search(self, dep_cities: list[str], arr_cities: list[str], t0: int, t1: int,
+               max_stops: int, keep: int) -> list[tuple]:
+        # -> [(минуты в пути, (flight_id, ...))], лучшие keep по времени в пути.
+        # Последнее плечо — бинпоиск по паре (хаб, пункт назначения); средние плечи —
+        # только в города с прямым рейсом в пункт назначения, и только пока путь
+        # ещё может обогнать keep-й лучший вариант из прямых и с одной пересадкой.
+        self.refresh()
+        with self._lock:
+            g = self.g
+            self.searches += 1
+
+        src = {g.city_id[c] for c in dep_cities if c in g.city_id}
+        dst = {g.city_id[c] for c in arr_cities if c in g.city_id}
+        feeders = {s for (s, d) in g.by_pair if d in dst}
+        mct, lay = ROUTE_MCT_MINUTES, ROUTE_MAX_LAYOVER_MINUTES
+        dep, arr = g.dep, g.arr
+
+        def last_legs(x: int, t: int):
+            for d in dst:
+                idx = g.by_pair.get((x, d))
+                for j in itertools.islice(g.window(idx, t + mct, t + lay), ROUTE_PER_HUB):
+                    yield idx[1][j]
+
+        # прямые и с одной пересадкой
+        paths = []
+        hubs = []
+        for s in src:
+            idx = g.by_src.get(s)
+            for i in g.window(idx, t0, t1 - 1):
+                a = idx[1][i]
+                x = g.dst[a]
+                if x in dst:
+                    paths.append((arr[a] - dep[a], (a,)))
+                elif max_stops >= 1 and x not in src:
+                    for b in last_legs(x, arr[a]):
+                        paths.append((arr[b] - dep[a], (a, b)))
+                    hubs.append(a)
+
+        # две пересадки: граница — keep-й лучший результат
+        if max_stops >= 2:
+            bound = heapq.nsmallest(keep, paths)[-1][0] if len(paths) >= keep else 1 << 62
+            budget = ROUTE_MAX_EXPANSIONS
+            for a in hubs:
+                x = g.dst[a]
+                xi = g.by_src.get(x)
+                for k in g.window(xi, arr[a] + mct, arr[a] + lay):
+                    b = xi[1][k]
+                    if dep[b] - dep[a] >= bound:
+                        break
+                    budget -= 1
+                    y = g.dst[b]
+                    if y in dst or y in src or y == x or y not in feeders:
+                        continue
+                    for c in last_legs(y, arr[b]):
+                        total = arr[c] - dep[a]
+                        if total < bound:
+                            paths.append((total, (a, b, c)))
+                if budget <= 0:
+                    break
+
+        # цены — в БД (fares), их проставит вызывающий
+        return [(m, tuple(g.fid[x] for x in p)) for m, p in heapq.nsmallest(keep, paths)]
+
+    def stats(self) -> dict:
+        with self._lock:
+            g = self.g
+            return {"flights": len(g.fid) if g else 0, "cities": len(g.cities) if g else 0,
+                    "version": self.version, "searches": self.searches}
+
+ROUTES = RouteGraph()
 
 # =========================
 # TELEGRAM BOT
 # =========================
 
+def bind_chat(username: str, chat_id: int) -> None:
+    with db_write() as conn:
+        ts = now_utc_iso()
+        conn.execute("""
+            INSERT INTO tg_users(username, chat_id, created_at, updated_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(username) DO UPDATE SET
+                chat_id=excluded.chat_id,
+                updated_at=excluded.updated_at;
+        """, (username, chat_id, ts, ts))
+        conn.commit()
+
+# Всё, что трогает БД из корутин бота, — через asyncio.to_thread: в webhook-режиме
+# бот живёт в цикле uvicorn, и ожидание пула/write-lock SQLite встало бы весь API
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     u = update.effective_user
     chat = update.effective_chat
@@ -359,19 +2224,7 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         )
         return
 
-    conn = db_connect()
-    try:
-        ts = now_utc_iso()
-        conn.execute("""
-            INSERT INTO tg_users(username, chat_id, created_at, updated_at)
-            VALUES (?, ?, ?, ?)
-            ON CONFLICT(username) DO UPDATE SET
-                chat_id=excluded.chat_id,
-                updated_at=excluded.updated_at;
-        """, (username, int(chat.id), ts, ts))
-        conn.commit()
-    finally:
-        conn.close()
+    await asyncio.to_thread(bind_chat, username, int(chat.id))
 
     await update.message.reply_text(
         "Ок. Я тебя привязала.\n"
@@ -388,118 +2241,477 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
     await update.message.reply_text("Я бот кодов. Жми /start, если ещё нет привязки.")
 
-async def process_pending_codes(app: Application) -> None:
-    conn = db_connect()
-    try:
-        rows = conn.execute("""
-            SELECT request_id, username, purpose
-            FROM tg_code_requests
-            WHERE status='pending'
-            ORDER BY created_at
-            LIMIT 30;
-        """).fetchall()
+def parse_hostport(v: str) -> tuple[str, int] | None:
+    host, _, port = (v or "").rpartition(":")
+    if not host or not port.isdigit():
+        return None
+    return host, int(port)
+
+class SenderWake:
+    # Будильник отправителя. notify() можно звать из любого потока
+    # (sync-ручки FastAPI крутятся в threadpool), ждёт — цикл бота.
+    # Если отправитель в этом же процессе — будим через loop, иначе шлём
+    # UDP-пакет на SENDER_WAKE_ADDR (--api-only и бот отдельно).
+
+    def __init__(self, addr: str = SENDER_WAKE_ADDR):
+        self.addr = parse_hostport(addr)
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._event: asyncio.Event | None = None
+        self._udp: socket.socket | None = None
+        self._transport = None
+        self.wakeups = 0
+
+    def bind(self, loop: asyncio.AbstractEventLoop) -> None:
+        self._loop = loop
+        self._event = asyncio.Event()
+
+    async def listen(self) -> None:
+        if self.addr is None or self._loop is None or self._transport is not None:
+            return
+        wake = self
+
+        class WakeProtocol(asyncio.DatagramProtocol):
+            def datagram_received(self, data, addr):
+                if wake._event is not None:
+                    wake._event.set()
 
-        for r in rows:
-            req_id = r["request_id"]
-            username = norm_username(r["username"])
-            purpose = (r["purpose"] or "").strip()
-
-            user = conn.execute(
-                "SELECT chat_id FROM tg_users WHERE username=?;",
-                (username,)
-            ).fetchone()
-            if not user:
-                continue
-
-            code = gen_code()
-            title = {
-                "register": "Регистрация",
-                "login": "Вход",
-                "booking": "Бронирование"
-            }.get(purpose, purpose)
-
-            msg = (
-                f"Код подтверждения: <b>{code}</b>\n"
-                f"Тип: <b>{title}</b>\n\n"
-                "Введи этот код в веб-приложении."
+        try:
+            self._transport, _ = await self._loop.create_datagram_endpoint(
+                WakeProtocol,
+                local_addr=self.addr,
+                reuse_port=hasattr(socket, "SO_REUSEPORT"),
             )
+        except (OSError, ValueError):
+            # порт занят (второй воркер без SO_REUSEPORT) — живём на sweep
+            self._transport = None
+
+    def notify(self) -> None:
+        self.wakeups += 1
+        loop, ev = self._loop, self._event
+        if loop is not None and ev is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(ev.set)
+            return
+        if self.addr is None:
+            return
+        try:
+            if self._udp is None:
+                self._udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                self._udp.setblocking(False)
+            self._udp.sendto(b"w", self.addr)
+        except OSError:
+            pass
 
+    async def wait(self, timeout: float) -> bool:
+        ev = self._event
+        if ev is None:
+            await asyncio.sleep(timeout)
+            return False
+        try:
+            await asyncio.wait_for(ev.wait(), timeout)
+            woke = True
+        except asyncio.TimeoutError:
+            woke = False
+        # сбрасываем до прохода: всё, что придёт во время отправки, разбудит снова
+        ev.clear()
+        return woke
+
+SENDER_WAKE = SenderWake()
+
+class RequestWatch:
+    # request_id -> {future: loop}; ждут long-poll'ы статуса кода.
+    # Отправитель будит их после commit; отправителя в другом процессе
+    # long-poll увидит сам, перечитывая статус раз в REQUEST_STATUS_POLL.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters: dict[str, dict[asyncio.Future, asyncio.AbstractEventLoop]] = {}
+
+    def add(self, request_id: str) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        with self._lock:
+            self._waiters.setdefault(request_id, {})[fut] = loop
+        return fut
+
+    def discard(self, request_id: str, fut: asyncio.Future) -> None:
+        with self._lock:
+            w = self._waiters.get(request_id)
+            if w is None:
+                return
+            w.pop(fut, None)
+            if not w:
+                del self._waiters[request_id]
+
+    def notify(self, request_ids) -> None:
+        with self._lock:
+            woken = [(f, l) for rid in request_ids for f, l in self._waiters.pop(rid, {}).items()]
+        for fut, loop in woken:
             try:
-                await app.bot.send_message(
-                    chat_id=int(user["chat_id"]),
-                    text=msg,
-                    parse_mode=ParseMode.HTML
-                )
-            except Exception:
+                loop.call_soon_threadsafe(self._wake, fut)
+            except RuntimeError:
+                pass  # цикл уже закрыт
+
+    @staticmethod
+    def _wake(fut: asyncio.Future) -> None:
+        if not fut.done():
+            fut.set_result(None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"requests": len(self._waiters), "waiters": sum(len(w) for w in self._waiters.values())}
+
+REQUEST_WATCH = RequestWatch()
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float | None = None):
+        self.rate = max(0.001, float(rate))
+        self.burst = max(1.0, float(burst if burst is not None else rate))
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    async def take(self) -> None:
+        # один поток (event loop) — гонок нет, но между await состояние перечитываем
+        while True:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
                 continue
+            self._refill(now)
+            if self.tokens >= 1.0:
+                self.tokens -= 1.0
+                return
+            await asyncio.sleep((1.0 - self.tokens) / self.rate)
+
+    def block(self, seconds: float) -> None:
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+class SendLimiter:
+    # глобальное ведро + ведро на чат; idle-ведра чатов периодически выкидываем
+    def __init__(self, global_rps: float = TG_GLOBAL_RPS, chat_rps: float = TG_CHAT_RPS,
+                 concurrency: int = SEND_CONCURRENCY):
+        self.global_bucket = TokenBucket(global_rps)
+        self.chat_rps = chat_rps
+        self._chats: dict[int, TokenBucket] = {}
+        self._sem = asyncio.Semaphore(max(1, concurrency))
+        self.sent = 0
+        self.errors = 0
+
+    def _chat(self, chat_id: int) -> TokenBucket:
+        b = self._chats.get(chat_id)
+        if b is None:
+            if len(self._chats) > 10_000:
+                now = time.monotonic()
+                self._chats = {k: v for k, v in self._chats.items() if now - v.last < 60}
+            b = TokenBucket(self.chat_rps, burst=1)
+            self._chats[chat_id] = b
+        return b
+
+    async def send(self, bot: Bot, chat_id: int, text: str) -> str | None:
+        # None — отправлено, иначе текст ошибки. Токен чата — до слота семафора:
+        # ожидание медленного чата не должно занимать слот остальных
+        await self._chat(chat_id).take()
+        async with self._sem:
+            await self.global_bucket.take()
+            try:
+                await bot.send_message(chat_id=chat_id, text=text, parse_mode="HTML")
+                self.sent += 1
+                return None
+            except Exception as e:
+                self.errors += 1
+                # RetryAfter (flood control): притормозить всех, а не долбить дальше
+                retry_after = getattr(e, "retry_after", None)
+                if retry_after:
+                    secs = retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+                    self.global_bucket.block(secs)
+                return f"{type(e).__name__}: {e}"[:300]
+
+_LIMITER: SendLimiter | None = None
+
+def send_limiter() -> SendLimiter:
+    # Semaphore привязывается к loop при первом использовании — создаём лениво
+    global _LIMITER
+    if _LIMITER is None:
+        _LIMITER = SendLimiter()
+    return _LIMITER
+
+CODE_TITLES = {
+    "register": "Регистрация",
+    "login": "Вход",
+    "booking": "Бронирование",
+}
+
+def code_message(purpose: str, code: str) -> str:
+    title = CODE_TITLES.get(purpose, purpose)
+    return (
+        f"Код подтверждения: <b>{code}</b>\n"
+        f"Тип: <b>{title}</b>\n\n"
+        "Введи этот код в веб-приложении."
+    )
 
-            conn.execute("""
-                UPDATE tg_code_requests
-                SET code=?, status='sent', sent_at=?
-                WHERE request_id=?;
-            """, (code, now_utc_iso(), req_id))
-            conn.commit()
-    finally:
-        conn.close()
-
-async def process_pending_notifications(app: Application) -> None:
-    conn = db_connect()
-    try:
-        rows = conn.execute("""
-            SELECT notif_id, username, message
-            FROM tg_notifications
-            WHERE status='pending'
-            ORDER BY created_at
-            LIMIT 30;
-        """).fetchall()
+def chunks(seq: list, n: int):
+    for i in range(0, len(seq), max(1, n)):
+        yield seq[i:i + n]
+
+def backoff_seconds(attempts: int) -> float:
+    # attempts — сколько уже было неудачных, включая текущую; +-20% джиттера
+    delay = min(SEND_BACKOFF_MAX, SEND_BACKOFF_BASE * (2 ** max(0, attempts - 1)))
+    return delay * random.uniform(0.8, 1.2)
+
+def failure_row(key, attempts: int, error: str) -> tuple:
+    n = int(attempts) + 1
+    status = "failed" if n >= SEND_MAX_ATTEMPTS else "pending"
+    delay = backoff_seconds(n)
+    return (status, error, now_ts() + int(delay), key)
+
+def chat_ids(conn: sqlite3.Connection, usernames) -> dict[str, int]:
+    names = sorted({u for u in usernames if u})
+    out: dict[str, int] = {}
+    for part in chunks(names, 500):
+        for r in conn.execute(
+            f"SELECT username, chat_id FROM tg_users WHERE username IN ({','.join('?' * len(part))});",
+            part,
+        ):
+            out[r["username"]] = int(r["chat_id"])
+    return out
 
-        for r in rows:
-            notif_id = int(r["notif_id"])
-            username = norm_username(r["username"])
-            message = (r["message"] or "").strip()
-
-            user = conn.execute(
-                "SELECT chat_id FROM tg_users WHERE username=?;",
-                (username,)
-            ).fetchone()
-            if not user:
-                continue
+def expire_leases(conn: sqlite3.Connection, table: str, now: int) -> None:
+    # Строка с lease_until_ts, снова ставшая due, — отправитель её не вернул
+    # (упал или завис): это потерянная попытка. Исчерпавшие лимит — в 'failed',
+    # остальным попытку засчитывает захват (attempts + 1 в claim_*).
+    conn.execute(f"""
+        UPDATE {table}
+        SET status='failed', attempts=attempts+1, last_error='аренда истекла', lease_until_ts=NULL
+        WHERE status='pending' AND next_attempt_ts <= ? AND lease_until_ts IS NOT NULL AND attempts + 1 >= ?;
+    """, (now, SEND_MAX_ATTEMPTS))
+
+def extend_leases(table: str, key: str, keys: list) -> None:
+    # продление аренды ещё не отправленного: только своих строк и только живых
+    lease = now_ts() + int(SEND_LEASE_SECONDS)
+    with db_write() as conn:
+        for part in chunks(keys, 500):
+            conn.execute(f"""
+                UPDATE {table} SET lease_until_ts=?, next_attempt_ts=?
+                WHERE {key} IN ({','.join('?' * len(part))}) AND claimed_by=? AND status='pending';
+            """, (lease, lease, *part, WORKER_ID))
+        conn.commit()
 
-            try:
-                await app.bot.send_message(
-                    chat_id=int(user["chat_id"]),
-                    text=message,
-                    parse_mode=ParseMode.HTML
-                )
-            except Exception:
-                continue
+async def hold_leases(table: str, key: str, left: set) -> None:
+    # Под лимитером пачка может идти дольше SEND_LEASE_SECONDS — без продления её
+    # перехватит другой воркер и код уйдёт дважды. left — ещё не записанные строки.
+    while True:
+        await asyncio.sleep(SEND_LEASE_SECONDS / 3)
+        if left:
+            await asyncio.to_thread(extend_leases, table, key, list(left))
+
+def claim_codes(limit: int) -> tuple[list, dict[str, int]]:
+    # Атомарный захват: одна UPDATE ... RETURNING под write-lock SQLite.
+    # next_attempt_ts сдвигаем на конец аренды — due-скан других воркеров
+    # эти строки не видит, а после падения они сами станут due.
+    now = now_ts()
+    lease = now + int(SEND_LEASE_SECONDS)
+    with db_write() as conn:
+        expire_leases(conn, "tg_code_requests", now)
+        rows = conn.execute("""
+            UPDATE tg_code_requests
+            SET claimed_by=?, lease_until_ts=?, next_attempt_ts=?,
+                attempts = attempts + (lease_until_ts IS NOT NULL)
+            WHERE request_id IN (
+                SELECT request_id FROM tg_code_requests
+                WHERE status='pending' AND next_attempt_ts <= ?
+                ORDER BY next_attempt_ts
+                LIMIT ?
+            )
+            RETURNING request_id, username, purpose, attempts;
+        """, (WORKER_ID, lease, lease, now, limit)).fetchall()
+        conn.commit()
+        chats = chat_ids(conn, (r["username"] for r in rows))
+    return rows, chats
+
+def claim_notifications(limit: int) -> tuple[list, dict[str, int]]:
+    now = now_ts()
+    lease = now + int(SEND_LEASE_SECONDS)
+    with db_write() as conn:
+        expire_leases(conn, "tg_notifications", now)
+        rows = conn.execute("""
+            UPDATE tg_notifications
+            SET claimed_by=?, lease_until_ts=?, next_attempt_ts=?,
+                attempts = attempts + (lease_until_ts IS NOT NULL)
+            WHERE notif_id IN (
+                SELECT notif_id FROM tg_notifications
+                WHERE status='pending' AND next_attempt_ts <= ?
+                ORDER BY next_attempt_ts
+                LIMIT ?
+            )
+            RETURNING notif_id, username, message, attempts;
+        """, (WORKER_ID, lease, lease, now, limit)).fetchall()
+        conn.commit()
+        chats = chat_ids(conn, (r["username"] for r in rows))
+    return rows, chats
+
+def flush_codes(ok: list, bad: list) -> None:
+    # claimed_by в WHERE: если аренду уже перехватил другой воркер — наш апдейт не пройдёт;
+    # status='pending': строку, отменённую новым запросом (supersede), не воскрешаем
+    with db_write() as conn:
+        if ok:
+            conn.executemany("""
+                UPDATE tg_code_requests
+                SET code_hash=?, expires_ts=?, status='sent', sent_ts=?, lease_until_ts=NULL
+                WHERE request_id=? AND claimed_by=? AND status='pending';
+            """, ok)
+        if bad:
+            conn.executemany("""
+                UPDATE tg_code_requests
+                SET status=?, attempts=attempts+1, last_error=?, next_attempt_ts=?, lease_until_ts=NULL
+                WHERE request_id=? AND claimed_by=? AND status='pending';
+            """, bad)
+        conn.commit()
 
-            conn.execute("""
+def flush_notifications(ok: list, bad: list) -> None:
+    with db_write() as conn:
+        if ok:
+            conn.executemany("""
                 UPDATE tg_notifications
-                SET status='sent', sent_at=?
-                WHERE notif_id=?;
-            """, (now_utc_iso(), notif_id))
-            conn.commit()
+                SET status='sent', sent_ts=?, lease_until_ts=NULL
+                WHERE notif_id=? AND claimed_by=?;
+            """, ok)
+        if bad:
+            conn.executemany("""
+                UPDATE tg_notifications
+                SET status=?, attempts=attempts+1, last_error=?, next_attempt_ts=?, lease_until_ts=NULL
+                WHERE notif_id=? AND claimed_by=?;
+            """, bad)
+        conn.commit()
+
+async def process_pending_codes(bot: Bot) -> int:
+    # соединение не держим через await: захватили пачку, отпустили, шлём
+    rows, chats = await asyncio.to_thread(claim_codes, SEND_BATCH)
+    if not rows:
+        return 0
+    limiter = send_limiter()
+
+    async def send_one(r) -> tuple[bool, tuple]:
+        chat_id = chats.get(r["username"])
+        if chat_id is None:
+            return False, failure_row(r["request_id"], r["attempts"], "нет привязки tg_users")
+        code = gen_code()
+        msg = code_message((r["purpose"] or "").strip(), code)
+        err = await limiter.send(bot, chat_id, msg)
+        if err:
+            return False, failure_row(r["request_id"], r["attempts"], err)
+        return True, (otp_hash(r["request_id"], code), now_ts() + int(OTP_TTL), now_ts(), r["request_id"])
+
+    # статусы пишем после каждой пачки: код не должен долго висеть 'pending' после отправки
+    left = {r["request_id"] for r in rows}
+    keeper = asyncio.create_task(hold_leases("tg_code_requests", "request_id", left))
+    try:
+        for part in chunks(rows, SEND_FLUSH):
+            results = await asyncio.gather(*(send_one(r) for r in part))
+            ok = [(*x, WORKER_ID) for good, x in results if good]
+            bad = [(*x, WORKER_ID) for good, x in results if not good]
+            await asyncio.to_thread(flush_codes, ok, bad)
+            left.difference_update(r["request_id"] for r in part)
+            REQUEST_WATCH.notify([r["request_id"] for r in part])
     finally:
-        conn.close()
+        keeper.cancel()
+
+    return len(rows)
+
+async def process_pending_notifications(bot: Bot) -> int:
+    rows, chats = await asyncio.to_thread(claim_notifications, SEND_BATCH)
+    if not rows:
+        return 0
+    limiter = send_limiter()
+
+    async def send_one(r) -> tuple[bool, tuple]:
+        notif_id = int(r["notif_id"])
+        chat_id = chats.get(r["username"])
+        if chat_id is None:
+            return False, failure_row(notif_id, r["attempts"], "нет привязки tg_users")
+        message = (r["message"] or "").strip()
+        err = await limiter.send(bot, chat_id, message)
+        if err:
+            return False, failure_row(notif_id, r["attempts"], err)
+        return True, (now_ts(), notif_id)
+
+    left = {int(r["notif_id"]) for r in rows}
+    keeper = asyncio.create_task(hold_leases("tg_notifications", "notif_id", left))
+    try:
+        for part in chunks(rows, SEND_FLUSH):
+            results = await asyncio.gather(*(send_one(r) for r in part))
+            ok = [(*x, WORKER_ID) for good, x in results if good]
+            bad = [(*x, WORKER_ID) for good, x in results if not good]
+            await asyncio.to_thread(flush_notifications, ok, bad)
+            left.difference_update(int(r["notif_id"]) for r in part)
+    finally:
+        keeper.cancel()
 
-async def background_loop(app: Application) -> None:
+    return len(rows)
+
+async def drain_queues_once(bot: Bot) -> None:
+    # полная пачка — значит, в очереди есть ещё: крутимся, пока не выберем
+    while True:
+        n_codes = await process_pending_codes(bot)
+        n_notif = await process_pending_notifications(bot)
+        if n_codes < SEND_BATCH and n_notif < SEND_BATCH:
+            return
+
+async def background_loop(bot: Bot, sweep: float = SWEEP_SECONDS) -> None:
+    SENDER_WAKE.bind(asyncio.get_running_loop())
+    await SENDER_WAKE.listen()
     while True:
         try:
-            await process_pending_codes(app)
-            await process_pending_notifications(app)
+            await drain_queues_once(bot)
         except Exception:
             pass
-        await asyncio.sleep(POLL_SECONDS)
+        await SENDER_WAKE.wait(sweep)
+
+_SENDER_TASK: asyncio.Task | None = None
 
 async def post_init(app: Application) -> None:
-    app.create_task(background_loop(app))
+    # не app.create_task: Application.stop() ждёт такие задачи, а цикл вечный
+    global _SENDER_TASK
+    _SENDER_TASK = asyncio.create_task(background_loop(app.bot))
+
+async def post_stop(app: Application) -> None:
+    global _SENDER_TASK
+    task, _SENDER_TASK = _SENDER_TASK, None
+    if task is not None:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
 
 # =========================
 # FASTAPI
 # =========================
 
-api_app = FastAPI(title="airline-web-tg")
+# корутины старта/остановки, которые надо выполнить в цикле uvicorn (webhook-режим)
+STARTUP_HOOKS: list = []
+SHUTDOWN_HOOKS: list = []
+
+@asynccontextmanager
+async def api_lifespan(app: FastAPI):
+    # граф маршрутов живёт в памяти процесса: при --workers N у каждого воркера свой
+    routes_stop = start_maintenance(PROCESS_JOBS, "routes")
+    for hook in STARTUP_HOOKS:
+        await hook()
+    try:
+        yield
+    finally:
+        routes_stop.set()
+        for hook in reversed(SHUTDOWN_HOOKS):
+            await hook()
+
+api_app = FastAPI(title="airline-web-tg", lifespan=api_lifespan)
+
+# Application бота в webhook-режиме; None — webhook выключен
+TG_APP: Application | None = None
 
 api_app.add_middleware(
     CORSMiddleware,
@@ -507,8 +2719,23 @@ api_app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag"],  # фронт шлёт его обратно в If-None-Match
 )
 
+@api_app.exception_handler(PoolTimeout)
+async def on_pool_timeout(request, exc: PoolTimeout):
+    return JSONResponse({"detail": "Сервер перегружен, попробуй ещё раз"}, status_code=503)
+
+class PriceChanged(HTTPException):
+    def __init__(self, price_usd: float):
+        super().__init__(409, f"Цена изменилась: сейчас {price_usd:.2f} USD за место")
+        self.price_usd = price_usd
+
+# 409 с актуальной ценой: фронт подставляет её в форму без перезагрузки рейса
+@api_app.exception_handler(PriceChanged)
+async def on_price_changed(request, exc: PriceChanged):
+    return JSONResponse({"detail": exc.detail, "price_usd": round(exc.price_usd, 2)}, status_code=409)
+
 class ReqCode(BaseModel):
     username: str
     purpose: str  # register|login|booking (booking обычно через /booking/request)
@@ -527,41 +2754,244 @@ class ConfirmLogin(BaseModel):
     username: str
     code: str
 
+class Logout(BaseModel):
+    token: str
+    everywhere: bool = False  # закрыть все сессии пользователя
+
 class FlightSearch(BaseModel):
     dep: str | None = None
     arr: str | None = None
     date_from: str | None = None
     date_to: str | None = None
+    min_free: int = 0   # только рейсы, где свободно >= N мест
     limit: int = 120
+    cursor: str | None = None  # next_cursor из прошлой страницы
+
+class ItinerarySearch(BaseModel):
+    dep: str
+    arr: str
+    date_from: str | None = None  # по умолчанию сегодня
+    date_to: str | None = None    # по умолчанию date_from; окно не больше ROUTE_MAX_DAYS
+    max_stops: int = 2
+    min_free: int = 1
+    limit: int = 20
 
 class BookingReq(BaseModel):
     token: str
     flight_id: int
-    seat_no: str
-    price_usd: float
+    seat_no: str | None = None       # одно место
+    seats: list[str] | None = None   # групповая бронь: несколько мест одним кодом
+    price_usd: float                 # за одно место
 
 class BookingConfirm(BaseModel):
     token: str
     request_id: str
     code: str
 
+class SessionCache:
+    # token -> [username, expires_ts, cached_at]; LRU + TTL на запись кэша.
+    # expires_ts — реальный срок сессии из БД, его проверяем на каждом запросе.
+
+    def __init__(self, size: int = SESSION_CACHE_SIZE, ttl: float = SESSION_CACHE_TTL):
+        self.size = max(1, int(size))
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._items: OrderedDict[str, list] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token: str) -> tuple[str, float] | None:
+        now = time.monotonic()
+        with self._lock:
+            item = self._items.get(token)
+            if item is None or now - item[2] >= self.ttl:
+                self.misses += 1
+                return None
+            self._items.move_to_end(token)
+            self.hits += 1
+            return item[0], item[1]
+
+    def put(self, token: str, username: str, expires_ts: float) -> None:
+        with self._lock:
+            self._items[token] = [username, expires_ts, time.monotonic()]
+            self._items.move_to_end(token)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def expires(self, token: str) -> float | None:
+        # без учёта в hits/misses: это не чтение сессии, а проверка «пора ли продлить»
+        with self._lock:
+            item = self._items.get(token)
+            return None if item is None else item[1]
+
+    def touch(self, token: str, expires_ts: float) -> None:
+        with self._lock:
+            item = self._items.get(token)
+            if item is not None:
+                item[1] = expires_ts
+
+    def invalidate(self, token: str) -> None:
+        with self._lock:
+            self._items.pop(token, None)
+
+    def invalidate_user(self, username: str) -> None:
+        with self._lock:
+            for t in [t for t, it in self._items.items() if it[0] == username]:
+                del self._items[t]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._items), "hits": self.hits, "misses": self.misses}
+
+SESSIONS = SessionCache()
+
+class SearchCache:
+    # ключ нормализованного запроса -> [version, etag, body]; LRU.
+    # Запись годна, пока версия расписания не сменилась; версию читаем из БД
+    # не чаще раза в version_ttl, своя бронь сбрасывает её сразу (bump).
+
+    def __init__(self, size: int = SEARCH_CACHE_SIZE, version_ttl: float = SEARCH_VERSION_TTL):
+        self.size = max(1, int(size))
+        self.version_ttl = version_ttl
+        self._lock = threading.Lock()
+        self._items: OrderedDict[tuple, list] = OrderedDict()
+        self._version = -1
+        self._checked_at = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    def version(self) -> int:
+        now = time.monotonic()
+        with self._lock:
+            if now - self._checked_at < self.version_ttl:
+                return self._version
+        with db_read() as conn:
+            row = conn.execute("SELECT version FROM schedule_version WHERE id=1;").fetchone()
+        v = int(row["version"]) if row else 0
+        with self._lock:
+            self._version = v
+            self._checked_at = now
+        return v
+
+    def bump(self) -> None:
+        with self._lock:
+            self._checked_at = 0.0
+
+    def get(self, key: tuple, version: int) -> tuple[str, bytes] | None:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or item[0] != version:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[1], item[2]
+
+    def put(self, key: tuple, version: int, etag: str, body: bytes) -> None:
+        with self._lock:
+            self._items[key] = [version, etag, body]
+            self._items.move_to_end(key)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._items), "hits": self.hits, "misses": self.misses, "version": self._version}
+
+SEARCH_CACHE = SearchCache()
+
+def etag_matches(header: str | None, etag: str) -> bool:
+    if not header:
+        return False
+    tags = [t.strip() for t in header.split(",")]
+    return "*" in tags or etag in tags or ("W/" + etag) in tags
+
+def create_session(conn: sqlite3.Connection, username: str) -> str:
+    token = str(uuid.uuid4())
+    conn.execute("INSERT INTO sessions(token, username, created_at, expires_at) VALUES (?, ?, ?, ?);",
+                 (token, username, now_utc_iso(), utc_iso_in(SESSION_TTL)))
+    return token
+
+def renew_session(token: str) -> None:
+    # скользящее продление. Зовётся после with-блока эндпоинта, когда его соединение
+    # уже отдано в пул: write, ждущий read (SEATS.get), и read, ждущий write, клинят
+    # пулы до PoolTimeout
+    token = (token or "").strip()
+    expires_ts = SESSIONS.expires(token)
+    if expires_ts is None or expires_ts - time.time() >= SESSION_TTL - SESSION_RENEW_SECONDS:
+        return
+    expires_at = utc_iso_in(SESSION_TTL)
+    with db_write() as conn:
+        conn.execute("UPDATE sessions SET expires_at=? WHERE token=?;", (expires_at, token))
+        conn.commit()
+    SESSIONS.touch(token, iso_to_ts(expires_at))
+
 def must_session(conn: sqlite3.Connection, token: str) -> str:
     token = (token or "").strip()
     if not token:
         raise HTTPException(401, "Нет токена сессии")
-    row = conn.execute("SELECT username FROM sessions WHERE token=?;", (token,)).fetchone()
-    if not row:
-        raise HTTPException(401, "Сессия не найдена. Войди заново.")
-    return norm_username(row["username"])
+
+    now = time.time()
+    hit = SESSIONS.get(token)
+    if hit is None:
+        row = conn.execute("SELECT username, expires_at FROM sessions WHERE token=?;", (token,)).fetchone()
+        if not row:
+            raise HTTPException(401, "Сессия не найдена. Войди заново.")
+        username, expires_ts = norm_username(row["username"]), iso_to_ts(row["expires_at"])
+        SESSIONS.put(token, username, expires_ts)
+    else:
+        username, expires_ts = hit
+
+    if expires_ts <= now:
+        SESSIONS.invalidate(token)
+        raise HTTPException(401, "Сессия истекла. Войди заново.")
+    return username
 
 def ensure_tg_bound(conn: sqlite3.Connection, username: str) -> None:
     row = conn.execute("SELECT 1 FROM tg_users WHERE username=?;", (username,)).fetchone()
     if not row:
         raise HTTPException(400, "Открой бота и нажми /start — иначе я не могу прислать код.")
 
+def fare_stats() -> dict:
+    with db_read() as conn:
+        fv = conn.execute("SELECT version, priced_on, priced_at FROM fare_version WHERE id = 1;").fetchone()
+        dirty = conn.execute("SELECT COUNT(*) FROM fare_dirty;").fetchone()[0]
+    return {"version": fv["version"], "priced_on": fv["priced_on"], "priced_at": fv["priced_at"], "dirty": dirty}
+
+def schema_stats() -> dict:
+    with db_read() as conn:
+        row = conn.execute("SELECT top, done FROM schema_migration WHERE name = 'flights_v2';").fetchone()
+        return {"version": schema_version(conn), "target": SCHEMA_VERSION,
+                "migrated_upto": int(row["done"]) if row else None, "migrate_top": int(row["top"]) if row else None}
+
 @api_app.get("/api/health")
 def health():
-    return {"ok": True, "db": str(DB_PATH)}
+    return {"ok": True, "db": str(DB_PATH), "pool": db_pool_stats(), "seat_cache": SEATS.stats(), "session_cache": SESSIONS.stats(),
+            "search_cache": SEARCH_CACHE.stats(), "seat_feed": SEAT_FEED.stats(),
+            "request_watch": REQUEST_WATCH.stats(),
+            "route_graph": ROUTES.stats(), "fares": fare_stats(), "schema": schema_stats()}
+
+@api_app.post(TG_WEBHOOK_PATH)
+async def tg_webhook(request: Request):
+    app = TG_APP
+    if app is None:
+        raise HTTPException(404, "Webhook выключен")
+    # сравнение за постоянное время; байты — заголовок может быть не ASCII
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(token.encode(), TG_WEBHOOK_SECRET.encode()):
+        raise HTTPException(403, "Неверный secret token")
+
+    from telegram import Update
+
+    try:
+        data = await request.json()
+    except ValueError:
+        raise HTTPException(400, "Тело запроса — не JSON")
+    if not isinstance(data, dict):
+        raise HTTPException(400, "Ожидался объект Update")
+    # в очередь Application: обработчики крутятся в этом же цикле uvicorn
+    await app.update_queue.put(Update.de_json(data, app.bot))
+    return {"ok": True}
 
 @api_app.post("/api/auth/request-code")
 def api_auth_request_code(req: ReqCode):
@@ -573,47 +3003,196 @@ def api_auth_request_code(req: ReqCode):
     if purpose not in ("register", "login"):
         raise HTTPException(400, "purpose должен быть register или login")
 
-    conn = db_connect()
-    try:
+    with db_write() as conn:
         ensure_tg_bound(conn, username)
 
+        supersede_codes(conn, username, purpose)
         rid = str(uuid.uuid4())
+        ts = now_ts()
         conn.execute("""
-            INSERT INTO tg_code_requests(request_id, username, purpose, status, payload, created_at)
-            VALUES (?, ?, ?, 'pending', NULL, ?);
-        """, (rid, username, purpose, now_utc_iso()))
+            INSERT INTO tg_code_requests(request_id, username, purpose, status, payload, created_ts, next_attempt_ts)
+            VALUES (?, ?, ?, 'pending', NULL, ?, ?);
+        """, (rid, username, purpose, ts, ts))
         conn.commit()
+        SENDER_WAKE.notify()
         return {"request_id": rid}
-    finally:
-        conn.close()
 
-def consume_code(conn: sqlite3.Connection, username: str, purpose: str, code: str) -> None:
-    code = (code or "").strip()
-    if not re.fullmatch(r"\d{6}", code):
-        raise HTTPException(400, "Код — 6 цифр")
+def request_status_row(request_id: str) -> sqlite3.Row | None:
+    with db_read() as conn:
+        return conn.execute("""
+            SELECT request_id, purpose, status, attempts, last_error, sent_ts, expires_ts
+            FROM tg_code_requests
+            WHERE request_id=?;
+        """, (request_id,)).fetchone()
 
-    row = conn.execute("""
-        SELECT request_id, code AS real_code, status
+@api_app.get("/api/requests/{request_id}/status")
+async def api_request_status(request_id: str, wait: float = 25):
+    # long-poll: отвечаем, как только код ушёл ('sent') или не ушёл ('failed'),
+    # либо по истечении wait с текущим статусом — клиент просто повторяет запрос
+    rid = (request_id or "").strip()
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + max(0.0, min(float(wait), REQUEST_WAIT_MAX))
+
+    while True:
+        # подписываемся до чтения статуса — иначе можно проспать notify
+        fut = REQUEST_WATCH.add(rid)
+        try:
+            row = await asyncio.to_thread(request_status_row, rid)
+            if row is None:
+                raise HTTPException(404, "Запрос не найден")
+            left = deadline - loop.time()
+            if row["status"] != "pending" or left <= 0:
+                return {
+                    "request_id": row["request_id"],
+                    "purpose": row["purpose"],
+                    "status": row["status"],
+                    "attempts": int(row["attempts"] or 0),
+                    "error": row["last_error"] if row["status"] == "failed" else None,
+                    "sent_at": ts_iso(row["sent_ts"]),
+                    "expires_at": ts_iso(row["expires_ts"]),
+                }
+            try:
+                await asyncio.wait_for(fut, timeout=min(left, REQUEST_STATUS_POLL))
+            except asyncio.TimeoutError:
+                pass
+        finally:
+            REQUEST_WATCH.discard(rid, fut)
+
+class OtpCache:
+    # (username, purpose) -> активный отправленный код: request_id, хэш, срок, payload.
+    # Запись сверяется с БД не чаще раза в ttl (новый код мог выдать другой процесс).
+    # Счётчик неверных попыток — не здесь, а в строке кода (code_fails): он общий
+    # для всех воркеров и не сбрасывается рестартом или вытеснением из кэша.
+
+    def __init__(self, size: int = OTP_CACHE_SIZE, ttl: float = OTP_CACHE_TTL):
+        self.size = max(1, int(size))
+        self.ttl = float(ttl)
+        self._lock = threading.Lock()
+        self._items: OrderedDict[tuple[str, str], dict] = OrderedDict()
+
+    def get(self, key: tuple[str, str]) -> dict | None:
+        now = time.time()
+        with self._lock:
+            e = self._items.get(key)
+            if e is None:
+                return None
+            if e["expires_ts"] <= now:
+                del self._items[key]
+                return None
+            if now - e["loaded_ts"] > self.ttl:
+                del self._items[key]  # устарела — перечитать
+                return None
+            self._items.move_to_end(key)
+            return e
+
+    def put(self, key: tuple[str, str], row: sqlite3.Row) -> dict:
+        e = {
+            "request_id": row["request_id"],
+            "code_hash": row["code_hash"] or "",
+            "expires_ts": float(row["expires_ts"] or 0),
+            "loaded_ts": time.time(),
+            "payload": row["payload"],
+        }
+        with self._lock:
+            self._items[key] = e
+            self._items.move_to_end(key)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+        return e
+
+    def drop(self, key: tuple[str, str]) -> None:
+        with self._lock:
+            self._items.pop(key, None)
+
+OTP = OtpCache()
+
+def active_code_request(conn: sqlite3.Connection, username: str, purpose: str) -> sqlite3.Row | None:
+    # частичный idx_tg_code_active: активная строка на (username, purpose) одна
+    return conn.execute("""
+        SELECT request_id, status, code_hash, expires_ts, payload
         FROM tg_code_requests
-        WHERE username=? AND purpose=?
-        ORDER BY created_at DESC
+        WHERE username=? AND purpose=? AND status IN ('pending', 'sent', 'failed')
+        ORDER BY created_ts DESC
         LIMIT 1;
     """, (username, purpose)).fetchone()
 
+def supersede_codes(conn: sqlite3.Connection, username: str, purpose: str) -> None:
+    # новый запрос кода гасит все прежние того же типа
+    conn.execute("""
+        UPDATE tg_code_requests
+        SET status='cancelled'
+        WHERE username=? AND purpose=? AND status IN ('pending', 'sent', 'failed');
+    """, (username, purpose))
+    OTP.drop((username, purpose))
+
+def load_code_entry(conn: sqlite3.Connection, username: str, purpose: str) -> dict:
+    row = active_code_request(conn, username, purpose)
     if not row:
-        raise HTTPException(400, "Нет запроса на код")
+        raise HTTPException(400, "Нет активного запроса на код — запроси новый")
     if row["status"] == "pending":
         raise HTTPException(400, "Код ещё не отправлен ботом")
-    if row["status"] != "sent":
-        raise HTTPException(400, "Код уже использован/отменён")
-    if (row["real_code"] or "").strip() != code:
+    if row["status"] == "failed":
+        raise HTTPException(400, "Бот не смог отправить код — запроси новый")
+    return OTP.put((username, purpose), row)
+
+def fail_code(conn: sqlite3.Connection, request_id: str) -> sqlite3.Row | None:
+    # неверный ввод: +1 к общему счётчику одним UPDATE, на лимите код сгорает там же
+    # (в SET справа — старые значения строки, отсюда code_fails + 1 в CASE)
+    row = conn.execute("""
+        UPDATE tg_code_requests
+        SET code_fails = code_fails + 1,
+            status = CASE WHEN code_fails + 1 >= ? THEN 'cancelled' ELSE status END
+        WHERE request_id=? AND status='sent'
+        RETURNING code_fails, status;
+    """, (OTP_MAX_ATTEMPTS, request_id)).fetchone()
+    conn.commit()
+    return row
+
+def check_code(conn: sqlite3.Connection, username: str, purpose: str, code: str,
+               request_id: str | None = None) -> dict:
+    # Верный код проверяется без записи в БД, неверный — пишет счётчик и commit:
+    # звать до любых записей в транзакции вызывающего.
+    code = (code or "").strip()
+    if not re.fullmatch(r"\d{6}", code):
+        raise HTTPException(400, "Код — 6 цифр")
+
+    # БД читаем только без свежей записи в кэше: перебор кодов её не трогает
+    key = (username, purpose)
+    e = OTP.get(key)
+    if e is None:
+        e = load_code_entry(conn, username, purpose)
+
+    if request_id is not None and e["request_id"] != request_id:
+        raise HTTPException(400, "Запрос уже использован/отменён")
+    if e["expires_ts"] <= time.time():
+        OTP.drop(key)
+        raise HTTPException(400, "Код истёк — запроси новый")
+
+    if not hmac.compare_digest(e["code_hash"], otp_hash(e["request_id"], code)):
+        row = fail_code(conn, e["request_id"])
+        if row is None:
+            # код уже сгорел, использован или отменён — в том числе другим воркером
+            OTP.drop(key)
+            raise HTTPException(400, "Код уже использован/отменён — запроси новый")
+        if row["status"] == "cancelled":
+            OTP.drop(key)
+            raise HTTPException(429, "Слишком много неверных попыток — запроси новый код")
         raise HTTPException(400, "Неверный код")
+    return e
 
-    conn.execute("""
+def mark_code_used(conn: sqlite3.Connection, username: str, purpose: str, e: dict) -> None:
+    cur = conn.execute("""
         UPDATE tg_code_requests
-        SET status='used', used_at=?
-        WHERE request_id=?;
-    """, (now_utc_iso(), row["request_id"]))
+        SET status='used', used_ts=?
+        WHERE request_id=? AND status='sent';
+    """, (now_ts(), e["request_id"]))
+    OTP.drop((username, purpose))
+    if cur.rowcount == 0:
+        raise HTTPException(400, "Код уже использован/отменён")
+
+def consume_code(conn: sqlite3.Connection, username: str, purpose: str, code: str) -> None:
+    e = check_code(conn, username, purpose, code)
+    mark_code_used(conn, username, purpose, e)
 
 @api_app.post("/api/auth/confirm-register")
 def api_auth_confirm_register(req: ConfirmRegister):
@@ -633,8 +3212,7 @@ def api_auth_confirm_register(req: ConfirmRegister):
     if not last_name or not first_name or not passport_no or not phone or not email:
         raise HTTPException(400, "Заполни обязательные поля")
 
-    conn = db_connect()
-    try:
+    with db_write() as conn:
         ensure_tg_bound(conn, username)
         consume_code(conn, username, "register", req.code)
 
@@ -650,14 +3228,10 @@ def api_auth_confirm_register(req: ConfirmRegister):
                 email=excluded.email;
         """, (username, last_name, first_name, middle, passport_no, phone, email))
 
-        token = str(uuid.uuid4())
-        conn.execute("INSERT INTO sessions(token, username, created_at) VALUES (?, ?, ?);",
-                     (token, username, now_utc_iso()))
+        token = create_session(conn, username)
         conn.commit()
 
         return {"token": token}
-    finally:
-        conn.close()
 
 @api_app.post("/api/auth/confirm-login")
 def api_auth_confirm_login(req: ConfirmLogin):
@@ -665,8 +3239,7 @@ def api_auth_confirm_login(req: ConfirmLogin):
     if not username:
         raise HTTPException(400, "Нет @username")
 
-    conn = db_connect()
-    try:
+    with db_write() as conn:
         ensure_tg_bound(conn, username)
         consume_code(conn, username, "login", req.code)
 
@@ -674,20 +3247,60 @@ def api_auth_confirm_login(req: ConfirmLogin):
         if not p:
             raise HTTPException(404, "Пользователь не зарегистрирован")
 
-        token = str(uuid.uuid4())
-        conn.execute("INSERT INTO sessions(token, username, created_at) VALUES (?, ?, ?);",
-                     (token, username, now_utc_iso()))
+        token = create_session(conn, username)
         conn.commit()
         return {"token": token}
-    finally:
-        conn.close()
 
-@api_app.post("/api/flights/search")
-def api_flights_search(req: FlightSearch):
-    conn = db_connect()
-    try:
-        seed_flights_if_needed(conn, target=300)
+@api_app.post("/api/auth/logout")
+def api_auth_logout(req: Logout):
+    token = (req.token or "").strip()
+    if not token:
+        raise HTTPException(400, "Нет токена сессии")
+
+    with db_write() as conn:
+        row = conn.execute("SELECT username FROM sessions WHERE token=?;", (token,)).fetchone()
+        if row and req.everywhere:
+            username = norm_username(row["username"])
+            conn.execute("DELETE FROM sessions WHERE username=?;", (username,))
+            SESSIONS.invalidate_user(username)
+        else:
+            conn.execute("DELETE FROM sessions WHERE token=?;", (token,))
+        conn.commit()
+    SESSIONS.invalidate(token)
+    return {"ok": True}
+
+def search_key(req: FlightSearch) -> tuple:
+    return (
+        norm_text(req.dep or ""),
+        norm_text(req.arr or ""),
+        (req.date_from or "").strip(),
+        (req.date_to or "").strip(),
+        max(0, int(req.min_free or 0)),
+        max(1, min(int(req.limit or 120), 500)),
+        (req.cursor or "").strip(),
+    )
 
+@api_app.post("/api/flights/search")
+def api_flights_search(req: FlightSearch, request: Request):
+    # повтор популярного поиска — поиск в словаре; ETag = хэш тела,
+    # поэтому If-None-Match даёт 304, даже если версия сменилась, а выдача нет
+    key = search_key(req)
+    version = SEARCH_CACHE.version()
+    got = SEARCH_CACHE.get(key, version)
+    if got is None:
+        body = json.dumps(search_flights(req), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        etag = '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+        SEARCH_CACHE.put(key, version, etag, body)
+    else:
+        etag, body = got
+
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("If-None-Match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+def search_flights(req: FlightSearch) -> dict:
+    with db_read() as conn:
         dep = (req.dep or "").strip()
         arr = (req.arr or "").strip()
         df = (req.date_from or "").strip()
@@ -697,243 +3310,554 @@ def api_flights_search(req: FlightSearch):
         where = []
         args = []
 
-        if dep:
-            where.append("f.departure_city LIKE ?")
-            args.append(f"%{dep}%")
-        if arr:
-            where.append("f.arrival_city LIKE ?")
-            args.append(f"%{arr}%")
-        if df:
-            where.append("f.flight_date >= ?")
-            args.append(df)
-        if dt:
-            where.append("f.flight_date <= ?")
-            args.append(dt)
+        # город -> точные названия из словаря, дальше только IN по индексу
+        idx = city_index()
+        dep_cities = idx.resolve(dep) if dep else []
+        arr_cities = idx.resolve(arr) if arr else []
+        if (dep and not dep_cities) or (arr and not arr_cities):
+            return {"flights": [], "next_cursor": None, "matched": {"dep": dep_cities, "arr": arr_cities}}
+
+        # keyset: продолжаем строго после последней строки прошлой страницы —
+        # глубина страницы не важна, индекс (..., date, time, rowid) сразу встаёт на место
+        after = decode_cursor(req.cursor, str, str, int)
+        min_free = max(0, int(req.min_free or 0))
+
+        if schema_version(conn) >= SCHEMA_VERSION:
+            # v2: те же условия по целым ключам (город -> city_id, дата/время -> dep_ts);
+            # курсор прежний (date, time, id) — старые ссылки "ещё" не ломаются
+            try:
+                ts_from = sched_ts(df) if df else None
+                ts_to = sched_ts(dt) + 86400 if dt else None
+            except (ValueError, IndexError):
+                raise HTTPException(400, "Дата должна быть YYYY-MM-DD")
+            try:
+                ts_after = sched_ts(after[0], after[1]) if after else None
+            except (ValueError, IndexError):
+                raise HTTPException(400, "Битый cursor")
+            names = [*dep_cities, *arr_cities]
+            ids = {r[0]: r[1] for r in conn.execute(
+                f"SELECT name, city_id FROM cities WHERE name IN ({','.join('?' * len(names))});", names
+            )} if names else {}
+            for col, cities in (("f.dep_city_id", dep_cities), ("f.arr_city_id", arr_cities)):
+                if cities:
+                    cids = [ids[x] for x in cities if x in ids] or [0]
+                    where.append(f"{col} IN ({','.join('?' * len(cids))})")
+                    args.extend(cids)
+            if ts_from is not None:
+                where.append("f.dep_ts >= ?")
+                args.append(ts_from)
+            if ts_to is not None:
+                where.append("f.dep_ts < ?")
+                args.append(ts_to)
+            if after:
+                where.append("(f.dep_ts, f.flight_id) > (?, ?)")
+                args.extend([ts_after, after[2]])
+            order = "f.dep_ts, f.flight_id"
+        else:
+            if dep_cities:
+                where.append(f"f.departure_city IN ({','.join('?' * len(dep_cities))})")
+                args.extend(dep_cities)
+            if arr_cities:
+                where.append(f"f.arrival_city IN ({','.join('?' * len(arr_cities))})")
+                args.extend(arr_cities)
+            if df:
+                where.append("f.flight_date >= ?")
+                args.append(df)
+            if dt:
+                where.append("f.flight_date <= ?")
+                args.append(dt)
+            if after:
+                where.append("(f.flight_date, f.flight_time, f.flight_id) > (?, ?, ?)")
+                args.extend(after)
+            order = "f.flight_date, f.flight_time, f.flight_id"
+
+        if min_free:
+            where.append("p.seat_capacity - f.seats_booked - f.seats_held >= ?")
+            args.append(min_free)
 
         wsql = ("WHERE " + " AND ".join(where)) if where else ""
 
         rows = conn.execute(f"""
             SELECT f.flight_id, f.flight_number, f.departure_city, f.arrival_city, f.flight_date, f.flight_time,
-                   p.model AS plane_model, p.seat_capacity
-            FROM flights f
+                   f.seats_booked, f.seats_held, p.model AS plane_model, p.seat_capacity, fa.price_usd
+            FROM flights_text f
             JOIN planes p ON p.plane_id=f.plane_id
+            LEFT JOIN fares fa ON fa.flight_id=f.flight_id
             {wsql}
-            ORDER BY f.flight_date, f.flight_time
+            ORDER BY {order}
             LIMIT ?;
-        """, (*args, limit)).fetchall()
+        """, (*args, limit + 1)).fetchall()
+
+        more = len(rows) > limit
+        rows = rows[:limit]
+
+        flights = [flight_out(r) for r in rows]
+
+        next_cursor = None
+        if more:
+            last = rows[-1]
+            next_cursor = encode_cursor(last["flight_date"], last["flight_time"], int(last["flight_id"]))
+        return {"flights": flights, "next_cursor": next_cursor, "matched": {"dep": dep_cities, "arr": arr_cities}}
+
+def flight_out(r: sqlite3.Row) -> dict:
+    fid = int(r["flight_id"])
+    return {
+        "flight_id": fid,
+        "flight_number": r["flight_number"],
+        "dep": r["departure_city"],
+        "arr": r["arrival_city"],
+        "date": r["flight_date"],
+        "time": r["flight_time"],
+        "plane_model": r["plane_model"],
+        "seat_capacity": int(r["seat_capacity"]),
+        "seats_free": max(0, int(r["seat_capacity"]) - int(r["seats_booked"]) - int(r["seats_held"])),
+        "suggested_price": r["price_usd"]
+    }
+
+@api_app.post("/api/itineraries/search")
+def api_itineraries_search(req: ItinerarySearch):
+    # прямые рейсы и стыковки (до 2 пересадок) по графу расписания в памяти;
+    # из БД читаем только детали и свободные места найденных рейсов
+    idx = city_index()
+    dep_cities = idx.resolve((req.dep or "").strip())
+    arr_cities = idx.resolve((req.arr or "").strip())
+    matched = {"dep": dep_cities, "arr": arr_cities}
+    if not dep_cities or not arr_cities:
+        return {"itineraries": [], "matched": matched}
 
-        flights = []
-        for r in rows:
-            fid = int(r["flight_id"])
-            flights.append({
-                "flight_id": fid,
-                "flight_number": r["flight_number"],
-                "dep": r["departure_city"],
-                "arr": r["arrival_city"],
-                "date": r["flight_date"],
-                "time": r["flight_time"],
-                "plane_model": r["plane_model"],
-                "seat_capacity": int(r["seat_capacity"]),
-                "suggested_price": stable_price(fid)
-            })
+    try:
+        d0 = date.fromisoformat((req.date_from or "").strip()) if (req.date_from or "").strip() else datetime.now(timezone.utc).date()
+        d1 = date.fromisoformat((req.date_to or "").strip()) if (req.date_to or "").strip() else d0
+    except ValueError:
+        raise HTTPException(400, "Дата должна быть YYYY-MM-DD")
+    if d1 < d0:
+        raise HTTPException(400, "date_to раньше date_from")
+    d1 = min(d1, d0 + timedelta(days=ROUTE_MAX_DAYS - 1))
+
+    limit = max(1, min(int(req.limit or 20), 100))
+    min_free = max(0, int(req.min_free or 0))
+    max_stops = max(0, min(int(req.max_stops), 2))
+
+    # с запасом: часть вариантов отсеют занятые места
+    found = ROUTES.search(dep_cities, arr_cities, d0.toordinal() * 1440, (d1.toordinal() + 1) * 1440,
+                          max_stops, limit * 4)
+    fids = sorted({f for _, legs in found for f in legs})
+    if not fids:
+        return {"itineraries": [], "matched": matched}
+
+    with db_read() as conn:
+        rows = conn.execute(f"""
+            SELECT f.flight_id, f.flight_number, f.departure_city, f.arrival_city, f.flight_date, f.flight_time,
+                   f.seats_booked, f.seats_held, p.model AS plane_model, p.seat_capacity, fa.price_usd
+            FROM flights_text f
+            JOIN planes p ON p.plane_id=f.plane_id
+            LEFT JOIN fares fa ON fa.flight_id=f.flight_id
+            WHERE f.flight_id IN ({','.join('?' * len(fids))});
+        """, fids).fetchall()
+    info = {int(r["flight_id"]): flight_out(r) for r in rows}
 
-        return {"flights": flights}
-    finally:
-        conn.close()
+    out = []
+    for _, legs in found:
+        # рейс мог исчезнуть или поменяться после сборки графа — такие варианты пропускаем
+        if any(f not in info or info[f]["seats_free"] < min_free for f in legs):
+            continue
+        flights, times = [], []
+        for f in legs:
+            x = dict(info[f])
+            start = schedule_minutes(x["date"], x["time"])
+            x["duration_min"] = leg_minutes(x["dep"], x["arr"])
+            x["arrive"] = minutes_text(start + x["duration_min"])
+            flights.append(x)
+            times.append((start, start + x["duration_min"]))
+        layovers = [b[0] - a[1] for a, b in zip(times, times[1:])]
+        if any(a["arr"] != b["dep"] for a, b in zip(flights, flights[1:])) or any(
+            m < ROUTE_MCT_MINUTES for m in layovers
+        ):
+            continue
+        prices = [x["suggested_price"] for x in flights]
+        out.append({
+            "stops": len(legs) - 1,
+            "depart": f"{flights[0]['date']} {flights[0]['time']}",
+            "arrive": flights[-1]["arrive"],
+            "duration_min": times[-1][1] - times[0][0],
+            "layovers_min": layovers,
+            "price": round(sum(prices), 2) if None not in prices else None,
+            "legs": flights,
+        })
+    out.sort(key=lambda x: (x["duration_min"], x["price"] is None, x["price"] or 0))
+    # окно режется до ROUTE_MAX_DAYS — отдаём фактическое, чтобы клиент это видел
+    return {"itineraries": out[:limit], "matched": matched,
+            "date_from": d0.isoformat(), "date_to": d1.isoformat()}
+
+@api_app.get("/api/flights/calendar")
+def api_flights_calendar(dep: str, arr: str, date_from: str | None = None, days: int = 31):
+    # календарь низких цен: по дням маршрута из route_days — один диапазон по ключу
+    idx = city_index()
+    dep_cities = idx.resolve((dep or "").strip())
+    arr_cities = idx.resolve((arr or "").strip())
+    matched = {"dep": dep_cities, "arr": arr_cities}
+    if not dep_cities or not arr_cities:
+        return {"days": [], "cheapest": None, "matched": matched}
 
-@api_app.get("/api/flights/{flight_id}/seats")
-def api_flight_seats(flight_id: int):
-    conn = db_connect()
     try:
-        row = conn.execute("""
-            SELECT f.flight_id, p.seat_capacity
-            FROM flights f
-            JOIN planes p ON p.plane_id=f.plane_id
-            WHERE f.flight_id=?;
-        """, (int(flight_id),)).fetchone()
-        if not row:
-            raise HTTPException(404, "Рейс не найден")
+        d0 = date.fromisoformat(date_from.strip()) if (date_from or "").strip() else datetime.now(timezone.utc).date()
+    except ValueError:
+        raise HTTPException(400, "Дата должна быть YYYY-MM-DD")
+    days = max(1, min(int(days or 31), CALENDAR_MAX_DAYS))
+    d1 = d0 + timedelta(days=days - 1)
 
-        capacity = int(row["seat_capacity"])
-        all_seats = seats_for_capacity(capacity)
+    with db_read() as conn:
+        rows = conn.execute(f"""
+            SELECT flight_date, SUM(flights) AS flights, MIN(min_price) AS min_price,
+                   SUM(seats_free) AS seats_free, SUM(seats_total) AS seats_total
+            FROM route_days
+            WHERE departure_city IN ({','.join('?' * len(dep_cities))})
+              AND arrival_city IN ({','.join('?' * len(arr_cities))})
+              AND flight_date BETWEEN ? AND ?
+            GROUP BY flight_date
+            ORDER BY flight_date;
+        """, (*dep_cities, *arr_cities, d0.isoformat(), d1.isoformat())).fetchall()
+
+    out = [{
+        "date": r["flight_date"],
+        "flights": int(r["flights"]),
+        "min_price": r["min_price"],
+        "seats_free": max(0, int(r["seats_free"])),
+        "seats_total": int(r["seats_total"]),
+    } for r in rows]
+    priced = [x for x in out if x["min_price"] is not None]
+    cheapest = min(priced, key=lambda x: (x["min_price"], x["date"])) if priced else None
+    return {"date_from": d0.isoformat(), "date_to": d1.isoformat(), "days": out, "cheapest": cheapest, "matched": matched}
+
+@api_app.get("/api/cities")
+def api_cities(q: str = "", limit: int = 20):
+    idx = city_index()
+    found = idx.resolve(q) if q.strip() else idx.all()
+    limit = max(1, min(int(limit or 20), 100))
+    return {"cities": [
+        {"name": c, "iata": CITY_DIRECTORY.get(c, ("", ()))[0] or None}
+        for c in found[:limit]
+    ]}
+
+def seats_compact(flight_id: int, layout: SeatLayout, bits: bytes, held: bytes) -> dict:
+    return {
+        "flight_id": int(flight_id),
+        "layout": layout.layout_id,
+        "row_size": layout.row_size,
+        "capacity": layout.capacity,
+        "bitmap": bitmap_encode(bits),
+        "held": bitmap_encode(held),
+    }
 
-        booked = {
-            r["seat_no"] for r in conn.execute("""
-                SELECT seat_no
-                FROM tickets
-                WHERE flight_id=?;
-            """, (int(flight_id),)).fetchall()
-        }
+@api_app.get("/api/flights/{flight_id}/seats")
+def api_flight_seats(flight_id: int, format: str = "full"):
+    got = SEATS.get(int(flight_id))
+    if got is None:
+        raise HTTPException(404, "Рейс не найден")
+    layout, bits, held = got
+
+    if format == "compact":
+        return seats_compact(flight_id, layout, bits, held)
+
+    def status(i: int) -> str:
+        m = 0x80 >> (i & 7)
+        if bits[i >> 3] & m:
+            return "booked"
+        return "held" if held[i >> 3] & m else "free"
+
+    seats = [{"seat": s, "status": status(i)} for i, s in enumerate(layout.seats)]
+    return {"seats": seats, "capacity": layout.capacity}
+
+def sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, separators=(',', ':'))}\n\n"
+
+@api_app.get("/api/flights/{flight_id}/seats/stream")
+async def api_flight_seats_stream(flight_id: int, request: Request):
+    # SSE: сначала snapshot (compact), дальше только изменившиеся места
+    flight_id = int(flight_id)
+    got = await asyncio.to_thread(SEATS.get, flight_id)
+    if got is None:
+        raise HTTPException(404, "Рейс не найден")
+    if SEAT_FEED.full():
+        raise HTTPException(503, "Слишком много подписчиков, попробуй позже")
+    layout, bits, held = got
+
+    async def events():
+        nonlocal bits, held
+        # подписка — только внутри генератора: если ответ так и не начал отдаваться
+        # (клиент ушёл раньше), подписчика нет и отписывать некого
+        q = SEAT_FEED.subscribe(flight_id)
+        if q is None:
+            yield "retry: 3000\n\n"  # места кончились между проверкой и стартом — браузер переподключится
+            return
+        try:
+            yield "retry: 3000\n" + sse("snapshot", seats_compact(flight_id, layout, bits, held))
+            while True:
+                try:
+                    ev = await asyncio.wait_for(q.get(), timeout=SEAT_STREAM_POLL)
+                    new = seat_apply(layout, bits, ev["booked"], ev["freed"])
+                    new_held = seat_apply(layout, held, ev["held"], ev["released"])
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    cur = await asyncio.to_thread(SEATS.get, flight_id)
+                    new, new_held = (cur[1], cur[2]) if cur is not None else (bits, held)
+                booked, freed = seat_delta(layout, bits, new)
+                now_held, released = seat_delta(layout, held, new_held)
+                bits, held = new, new_held
+                if booked or freed or now_held or released:
+                    yield sse("seats", {"booked": booked, "freed": freed, "held": now_held, "released": released})
+                else:
+                    yield ": ping\n\n"
+        finally:
+            SEAT_FEED.unsubscribe(flight_id, q)
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def release_holds(conn: sqlite3.Connection, username: str) -> list[tuple[int, str]]:
+    return [(int(r["flight_id"]), r["seat_no"]) for r in conn.execute("""
+        DELETE FROM seat_holds WHERE username=? RETURNING flight_id, seat_no;
+    """, (username,))]
+
+def take_hold(conn: sqlite3.Connection, flight_id: int, seat_no: str, username: str,
+              request_id: str, until: str) -> bool:
+    # своё или истёкшее удержание перезаписываем, живое чужое — нет
+    cur = conn.execute("""
+        INSERT INTO seat_holds(flight_id, seat_no, username, request_id, expires_at)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(flight_id, seat_no) DO UPDATE
+        SET username=excluded.username, request_id=excluded.request_id, expires_at=excluded.expires_at
+        WHERE seat_holds.expires_at <= ?;
+    """, (flight_id, seat_no, username, request_id, until, now_utc_iso()))
+    return cur.rowcount > 0
+
+def publish_released(released: list[tuple[int, str]]) -> None:
+    by_flight: dict[int, list[str]] = {}
+    for fid, seat in released:
+        by_flight.setdefault(fid, []).append(seat)
+    for fid, seats in by_flight.items():
+        SEATS.hold(fid, seats, False)
+        SEAT_FEED.publish(fid, released=seats)
+
+def booking_seats(seats) -> list[str]:
+    # нормализуем и убираем повторы, порядок сохраняем
+    out = []
+    for x in seats or []:
+        x = str(x or "").strip().upper()
+        if x and x not in out:
+            out.append(x)
+    return out
 
-        seats = [{"seat": s, "status": ("booked" if s in booked else "free")} for s in all_seats]
-        return {"seats": seats, "capacity": capacity}
-    finally:
-        conn.close()
+def seats_msg(seats: list[str], one: str, many: str) -> str:
+    return one if len(seats) == 1 else f"{many}: {', '.join(seats)}"
 
 @api_app.post("/api/booking/request")
 def api_booking_request(req: BookingReq):
-    conn = db_connect()
-    try:
+    with db_write() as conn:
         username = must_session(conn, req.token)
         ensure_tg_bound(conn, username)
 
         flight_id = int(req.flight_id)
-        seat_no = (req.seat_no or "").strip().upper()
-        price = float(req.price_usd)
+        seats = booking_seats(req.seats if req.seats else [req.seat_no])
+        price = round(float(req.price_usd), 2)
 
-        if not seat_no:
+        if not seats:
             raise HTTPException(400, "Нет места")
+        if len(seats) > BOOKING_MAX_SEATS:
+            raise HTTPException(400, f"Не больше {BOOKING_MAX_SEATS} мест в одной брони")
         if not (price > 0):
             raise HTTPException(400, "Цена должна быть > 0")
 
-        frow = conn.execute("""
-            SELECT p.seat_capacity
-            FROM flights f
-            JOIN planes p ON p.plane_id=f.plane_id
-            WHERE f.flight_id=?;
-        """, (flight_id,)).fetchone()
-        if not frow:
+        got = SEATS.get(flight_id)
+        if got is None:
             raise HTTPException(404, "Рейс не найден")
 
-        capacity = int(frow["seat_capacity"])
-        valid = set(seats_for_capacity(capacity))
-        if seat_no not in valid:
-            raise HTTPException(400, "Некорректное место для этого самолёта")
-
-        exists = conn.execute("""
-            SELECT 1 FROM tickets WHERE flight_id=? AND seat_no=? LIMIT 1;
-        """, (flight_id, seat_no)).fetchone()
-        if exists:
-            raise HTTPException(409, "Это место уже занято")
+        # цену задаёт сервер: клиент присылает ту, что видел, — сверяем с fares
+        fare = conn.execute("SELECT price_usd, version FROM fares WHERE flight_id=?;", (flight_id,)).fetchone()
+        if fare is None:
+            raise HTTPException(409, "Для рейса ещё нет тарифа — попробуй через минуту")
+        if abs(price - float(fare["price_usd"])) >= 0.005:
+            raise PriceChanged(float(fare["price_usd"]))
+
+        layout, _, _ = got
+        bad = [x for x in seats if x not in layout.index]
+        if bad:
+            raise HTTPException(400, seats_msg(bad, "Некорректное место для этого самолёта",
+                                               "Некорректные места для этого самолёта"))
+
+        # сначала дешёвые проверки: кэш, потом индекс билетов — код зря не шлём
+        marks = ",".join("?" * len(seats))
+        taken = {x for x in seats if SEATS.is_booked(flight_id, x)}
+        taken.update(r["seat_no"] for r in conn.execute(
+            f"SELECT seat_no FROM tickets WHERE flight_id=? AND seat_no IN ({marks});", (flight_id, *seats)
+        ))
+        if taken:
+            raise HTTPException(409, seats_msg([x for x in seats if x in taken], "Это место уже занято", "Уже заняты"))
 
         rid = str(uuid.uuid4())
-        payload = json.dumps({"flight_id": flight_id, "seat_no": seat_no, "price_usd": price}, ensure_ascii=False)
-
+        payload = json.dumps({"flight_id": flight_id, "seats": seats, "price_usd": price,
+                              "fare_version": int(fare["version"])}, ensure_ascii=False)
+
+        # удержание: все места запроса или ни одного; прежние удержания пользователя отпускаем
+        released = release_holds(conn, username)
+        until = utc_iso_in(SEAT_HOLD_SECONDS)
+        blocked = [x for x in seats if not take_hold(conn, flight_id, x, username, rid, until)]
+        if blocked:
+            conn.rollback()
+            raise HTTPException(409, seats_msg(
+                blocked,
+                "Место сейчас удерживает другой пассажир — попробуй через пару минут",
+                "Сейчас удерживают другие пассажиры",
+            ))
+
+        supersede_codes(conn, username, "booking")
+        ts = now_ts()
         conn.execute("""
-            INSERT INTO tg_code_requests(request_id, username, purpose, status, payload, created_at)
-            VALUES (?, ?, 'booking', 'pending', ?, ?);
-        """, (rid, username, payload, now_utc_iso()))
+            INSERT INTO tg_code_requests(request_id, username, purpose, status, payload, created_ts, next_attempt_ts)
+            VALUES (?, ?, 'booking', 'pending', ?, ?, ?);
+        """, (rid, username, payload, ts, ts))
+        bump_schedule_version(conn)
         conn.commit()
+    SENDER_WAKE.notify()
 
-        return {"request_id": rid}
-    finally:
-        conn.close()
+    publish_released([x for x in released if x[0] != flight_id or x[1] not in seats])
+    SEATS.hold(flight_id, seats)
+    SEAT_FEED.publish(flight_id, held=seats)
+    SEARCH_CACHE.bump()
+    renew_session(req.token)
+
+    return {"request_id": rid, "seats": seats, "hold_expires_at": until, "price_usd": price}
 
 @api_app.post("/api/booking/confirm")
 def api_booking_confirm(req: BookingConfirm):
-    conn = db_connect()
-    try:
-        username = must_session(conn, req.token)
-
-        rid = (req.request_id or "").strip()
-        code = (req.code or "").strip()
-        if not rid:
-            raise HTTPException(400, "Нет request_id")
-        if not re.fullmatch(r"\d{6}", code):
-            raise HTTPException(400, "Код — 6 цифр")
-
-        row = conn.execute("""
-            SELECT request_id, code AS real_code, status, payload
-            FROM tg_code_requests
-            WHERE request_id=? AND username=? AND purpose='booking'
-            LIMIT 1;
-        """, (rid, username)).fetchone()
-
-        if not row:
-            raise HTTPException(404, "Запрос бронирования не найден")
-        if row["status"] == "pending":
-            raise HTTPException(400, "Код ещё не отправлен ботом")
-        if row["status"] != "sent":
-            raise HTTPException(400, "Запрос уже использован/отменён")
-        if (row["real_code"] or "").strip() != code:
-            raise HTTPException(400, "Неверный код")
-
+    flight_id, seats = 0, []
+    with db_write() as conn:
         try:
-            payload = json.loads(row["payload"] or "{}")
-        except Exception:
-            payload = {}
-
-        flight_id = int(payload.get("flight_id", 0))
-        seat_no = str(payload.get("seat_no", "")).strip().upper()
-        price = float(payload.get("price_usd", 0.0))
-
-        if not flight_id or not seat_no or not (price > 0):
-            raise HTTPException(400, "Битый payload брони")
+            username = must_session(conn, req.token)
 
-        status_id = get_status_id(conn, "BOOKED")
-
-        # транзакция: ещё раз проверяем место и вставляем
-        conn.execute("BEGIN;")
-        exists = conn.execute("""
-            SELECT 1 FROM tickets WHERE flight_id=? AND seat_no=? LIMIT 1;
-        """, (flight_id, seat_no)).fetchone()
-        if exists:
-            conn.execute("ROLLBACK;")
-            raise HTTPException(409, "Это место уже занято")
-
-        conn.execute("""
-            INSERT INTO tickets(flight_id, passenger_id, status_id, seat_no, price_usd)
-            VALUES (?, ?, ?, ?, ?);
-        """, (flight_id, username, status_id, seat_no, price))
+            rid = (req.request_id or "").strip()
+            if not rid:
+                raise HTTPException(400, "Нет request_id")
 
-        conn.execute("""
-            UPDATE tg_code_requests
-            SET status='used', used_at=?
-            WHERE request_id=?;
-        """, (now_utc_iso(), rid))
-
-        # уведомление в TG (приятно же)
-        f = conn.execute("""
-            SELECT f.flight_number, f.departure_city, f.arrival_city, f.flight_date, f.flight_time,
-                   p.model AS plane_model
-            FROM flights f
-            JOIN planes p ON p.plane_id=f.plane_id
-            WHERE f.flight_id=?;
-        """, (flight_id,)).fetchone()
-
-        if f:
-            msg = (
-                "✅ <b>Бронь подтверждена</b>\n\n"
-                f"Рейс: <b>{f['flight_number']}</b>\n"
-                f"{f['departure_city']} → {f['arrival_city']}\n"
-                f"{f['flight_date']} {f['flight_time']} · {f['plane_model']}\n"
-                f"Место: <b>{seat_no}</b>\n"
-                f"Цена: <b>${price:.2f}</b>"
-            )
-            conn.execute("""
-                INSERT INTO tg_notifications(username, message, status, created_at)
-                VALUES (?, ?, 'pending', ?);
-            """, (username, msg, now_utc_iso()))
+            entry = check_code(conn, username, "booking", req.code, request_id=rid)
 
-        conn.execute("COMMIT;")
-        return {"ok": True}
-    except HTTPException:
-        raise
-    except sqlite3.IntegrityError:
-        try:
-            conn.execute("ROLLBACK;")
-        except Exception:
-            pass
-        raise HTTPException(409, "Это место уже занято")
-    finally:
-        conn.close()
+            try:
+                payload = json.loads(entry["payload"] or "{}")
+            except Exception:
+                payload = {}
+
+            flight_id = int(payload.get("flight_id", 0))
+            # старые запросы кода — с одним seat_no
+            seats = booking_seats(payload.get("seats") or [payload.get("seat_no")])
+            price = float(payload.get("price_usd", 0.0))
+
+            if not flight_id or not seats or not (price > 0):
+                raise HTTPException(400, "Битый payload брони")
+
+            status_id = get_status_id(conn, "BOOKED")
+            marks = ",".join("?" * len(seats))
+
+            # одна транзакция на всю группу: ещё раз проверяем места и вставляем все билеты
+            conn.execute("BEGIN;")
+            taken = [r["seat_no"] for r in conn.execute(f"""
+                SELECT seat_no FROM tickets WHERE flight_id=? AND seat_no IN ({marks});
+            """, (flight_id, *seats))]
+            if taken:
+                conn.execute("ROLLBACK;")
+                SEATS.invalidate(flight_id)
+                SEAT_FEED.publish(flight_id, booked=taken)
+                raise HTTPException(409, seats_msg(taken, "Это место уже занято", "Уже заняты"))
+
+            # наше удержание могло истечь — тогда место мог перехватить другой
+            foreign = [r["seat_no"] for r in conn.execute(f"""
+                SELECT seat_no FROM seat_holds
+                WHERE flight_id=? AND seat_no IN ({marks}) AND username<>? AND expires_at>?;
+            """, (flight_id, *seats, username, now_utc_iso()))]
+            if foreign:
+                conn.execute("ROLLBACK;")
+                raise HTTPException(409, seats_msg(foreign, "Место сейчас удерживает другой пассажир",
+                                                   "Сейчас удерживают другие пассажиры"))
+
+            conn.executemany("""
+                INSERT INTO tickets(flight_id, passenger_id, status_id, seat_no, price_usd)
+                VALUES (?, ?, ?, ?, ?);
+            """, [(flight_id, username, status_id, x, price) for x in seats])
+            conn.execute(f"DELETE FROM seat_holds WHERE flight_id=? AND seat_no IN ({marks});", (flight_id, *seats))
+
+            mark_code_used(conn, username, "booking", entry)
+
+            # уведомление в TG (приятно же) — одно на всю группу
+            f = conn.execute("""
+                SELECT f.flight_number, f.departure_city, f.arrival_city, f.flight_date, f.flight_time,
+                       p.model AS plane_model
+                FROM flights_text f
+                JOIN planes p ON p.plane_id=f.plane_id
+                WHERE f.flight_id=?;
+            """, (flight_id,)).fetchone()
+
+            if f:
+                if len(seats) == 1:
+                    seat_line = f"Место: <b>{seats[0]}</b>\n"
+                    price_line = f"Цена: <b>${price:.2f}</b>"
+                else:
+                    seat_line = f"Места ({len(seats)}): <b>{', '.join(seats)}</b>\n"
+                    price_line = f"Цена: ${price:.2f} × {len(seats)} = <b>${price * len(seats):.2f}</b>"
+                msg = (
+                    "✅ <b>Бронь подтверждена</b>\n\n"
+                    f"Рейс: <b>{f['flight_number']}</b>\n"
+                    f"{f['departure_city']} → {f['arrival_city']}\n"
+                    f"{f['flight_date']} {f['flight_time']} · {f['plane_model']}\n"
+                    + seat_line + price_line
+                )
+                ts = now_ts()
+                conn.execute("""
+                    INSERT INTO tg_notifications(username, message, status, created_ts, next_attempt_ts)
+                    VALUES (?, ?, 'pending', ?, ?);
+                """, (username, msg, ts, ts))
+
+            bump_schedule_version(conn)
+            conn.execute("COMMIT;")
+        except HTTPException:
+            raise
+        except sqlite3.IntegrityError:
+            try:
+                conn.execute("ROLLBACK;")
+            except Exception:
+                pass
+            # какое именно место — не знаем: кэш перечитается, потоки догонят сверкой
+            SEATS.invalidate(flight_id)
+            raise HTTPException(409, seats_msg(seats, "Это место уже занято", "Одно из мест уже занято"))
+
+    SEATS.mark(flight_id, seats)
+    SEATS.hold(flight_id, seats, False)
+    SEAT_FEED.publish(flight_id, booked=seats, released=seats)
+    SEARCH_CACHE.bump()
+    SENDER_WAKE.notify()
+    renew_session(req.token)
+    return {"ok": True, "seats": seats}
 
 @api_app.get("/api/me/flights")
-def api_me_flights(token: str):
-    conn = db_connect()
-    try:
+def api_me_flights(token: str, cursor: str | None = None, limit: int = 50):
+    with db_read() as conn:
         username = must_session(conn, token)
 
+        limit = max(1, min(int(limit or 50), 200))
+        after = decode_cursor(cursor, int)
+        after_id = after[0] if after else 0
+
+        # порядок — порядок покупки: страница = диапазон первичного ключа itineraries
         rows = conn.execute("""
-            SELECT t.ticket_id, t.seat_no, t.price_usd,
-                   f.flight_id, f.flight_number, f.departure_city, f.arrival_city, f.flight_date, f.flight_time,
-                   p.model AS plane_model, p.seat_capacity
-            FROM tickets t
-            JOIN flights f ON f.flight_id=t.flight_id
-            JOIN planes p ON p.plane_id=f.plane_id
-            WHERE t.passenger_id=?
-            ORDER BY f.flight_date, f.flight_time;
-        """, (username,)).fetchall()
+            SELECT ticket_id, seat_no, price_usd, flight_id, flight_number, departure_city, arrival_city,
+                   flight_date, flight_time, plane_model, seat_capacity
+            FROM itineraries
+            WHERE passenger_id=? AND ticket_id > ?
+            ORDER BY ticket_id
+            LIMIT ?;
+        """, (username, after_id, limit + 1)).fetchall()
+
+        more = len(rows) > limit
+        rows = rows[:limit]
 
         out = []
         for r in rows:
@@ -950,20 +3874,357 @@ def api_me_flights(token: str):
                 "plane_model": r["plane_model"],
                 "seat_capacity": int(r["seat_capacity"]),
             })
-        return {"flights": out}
+    renew_session(token)
+    next_cursor = encode_cursor(out[-1]["ticket_id"]) if more else None
+    return {"flights": out, "next_cursor": next_cursor}
+
+# =========================
+# MAINTENANCE
+# =========================
+
+def delete_in_batches(sql: str, args: tuple = (), bump: bool = False) -> int:
+    # sql: DELETE ... WHERE rowid IN (SELECT ... LIMIT ?) — последний параметр батч.
+    # Короткие транзакции с паузой между ними, чтобы не держать write-lock.
+    # bump — удаление меняет выдачу поиска: версия расписания раз на пачку
+    total = 0
+    for _ in range(GC_MAX_BATCHES):
+        with db_write() as conn:
+            n = conn.execute(sql, (*args, GC_BATCH)).rowcount
+            if n and bump:
+                bump_schedule_version(conn)
+            conn.commit()
+        total += n
+        if n < GC_BATCH:
+            break
+        time.sleep(GC_PAUSE)
+    return total
+
+def gc_sessions() -> int:
+    return delete_in_batches("""
+        DELETE FROM sessions
+        WHERE rowid IN (
+            SELECT rowid FROM sessions WHERE expires_at < ? LIMIT ?
+        );
+    """, (now_utc_iso(),))
+
+def gc_seat_holds() -> int:
+    return delete_in_batches("""
+        DELETE FROM seat_holds
+        WHERE rowid IN (
+            SELECT rowid FROM seat_holds WHERE expires_at <= ? LIMIT ?
+        );
+    """, (now_utc_iso(),), bump=True)
+
+# завершённые статусы: 'sent' у кодов тоже — старый неиспользованный код уже никому не нужен
+RETENTION_TABLES = [
+    ("tg_code_requests", "tg_code_requests_archive", ("sent", "used", "cancelled", "failed")),
+    ("tg_notifications", "tg_notifications_archive", ("sent", "failed")),
+]
+
+def retention_batch(table: str, archive: str, statuses: tuple, cutoff: int) -> int:
+    with db_write() as conn:
+        rowids = [r[0] for r in conn.execute(f"""
+            SELECT rowid FROM {table}
+            WHERE created_ts < ? AND status IN ({','.join('?' * len(statuses))})
+            LIMIT ?;
+        """, (cutoff, *statuses, GC_BATCH))]
+        if not rowids:
+            return 0
+        marks = ",".join("?" * len(rowids))
+        if RETENTION_MODE == "archive":
+            cols = ", ".join(table_cols(conn, table))
+            conn.execute(f"""
+                INSERT INTO {archive}({cols}, archived_ts)
+                SELECT {cols}, ? FROM {table} WHERE rowid IN ({marks});
+            """, (now_ts(), *rowids))
+        conn.execute(f"DELETE FROM {table} WHERE rowid IN ({marks});", rowids)
+        conn.commit()
+    return len(rowids)
+
+def retention_queues() -> int:
+    cutoff = now_ts() - int(RETENTION_DAYS * 86400)
+    total = 0
+    for table, archive, statuses in RETENTION_TABLES:
+        for _ in range(GC_MAX_BATCHES):
+            n = retention_batch(table, archive, statuses, cutoff)
+            total += n
+            if n < GC_BATCH:
+                break
+            time.sleep(GC_PAUSE)
+    if total:
+        # WAL не должен расти от наших же удалений
+        with db_write() as conn:
+            conn.execute("PRAGMA wal_checkpoint(PASSIVE);")
+    return total
+
+def create_mirror_triggers(conn: sqlite3.Connection) -> None:
+    # пока идёт копия, любая правка flights сразу повторяется в flights_v2:
+    # пачкам остаётся пройти только строки, что были до старта (flight_id <= top)
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_flights_mirror_ins
+    AFTER INSERT ON flights
+    BEGIN
+        INSERT OR IGNORE INTO cities(name) VALUES (NEW.departure_city), (NEW.arrival_city);
+        INSERT OR REPLACE INTO flights_v2({FLIGHT_V2_COLS}) {FLIGHT_V2_SELECT} WHERE flight_id = NEW.flight_id;
+    END;
+    """)
+    # бронь и удержания — дёшево, только счётчики (строки ещё нет — её принесёт пачка)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_flights_mirror_seats
+    AFTER UPDATE OF seats_booked, seats_held ON flights
+    BEGIN
+        UPDATE flights_v2 SET seats_booked = NEW.seats_booked, seats_held = NEW.seats_held
+        WHERE flight_id = NEW.flight_id;
+    END;
+    """)
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_flights_mirror_upd
+    AFTER UPDATE OF flight_id, plane_id, flight_number, departure_city, arrival_city, flight_date, flight_time ON flights
+    BEGIN
+        INSERT OR IGNORE INTO cities(name) VALUES (NEW.departure_city), (NEW.arrival_city);
+        DELETE FROM flights_v2 WHERE flight_id = OLD.flight_id;
+        INSERT OR REPLACE INTO flights_v2({FLIGHT_V2_COLS}) {FLIGHT_V2_SELECT} WHERE flight_id = NEW.flight_id;
+    END;
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_flights_mirror_del
+    AFTER DELETE ON flights
+    BEGIN
+        DELETE FROM flights_v2 WHERE flight_id = OLD.flight_id;
+    END;
+    """)
+
+def swap_flights_v2(conn: sqlite3.Connection) -> bool:
+    # Подмена одной транзакцией под write-lock: старая flights (с текстом и его
+    # индексами) уходит, flights_v2 встаёт на её место, триггеры и вид — под v2.
+    # Число строк не сошлось (правка в обход триггеров) — копия идёт заново.
+    conn.commit()
+    conn.execute("PRAGMA legacy_alter_table = ON;")
+    try:
+        conn.execute("BEGIN IMMEDIATE;")
+        seq = table_sequence(conn, "flights")
+        n_old = conn.execute("SELECT COUNT(*) FROM flights;").fetchone()[0]
+        n_new = conn.execute("SELECT COUNT(*) FROM flights_v2;").fetchone()[0]
+        if n_old != n_new:
+            conn.execute("""
+                UPDATE schema_migration SET done = 0, top = (SELECT COALESCE(MAX(flight_id), 0) FROM flights)
+                WHERE name = 'flights_v2';
+            """)
+            conn.execute("COMMIT;")
+            return False
+        conn.execute("DROP TABLE flights;")
+        conn.execute("ALTER TABLE flights_v2 RENAME TO flights;")
+        keep_sequence(conn, "flights", max(seq, table_sequence(conn, "flights")))
+        create_flights_view(conn, True)
+        create_flight_triggers(conn, True)
+        conn.execute("DELETE FROM schema_migration WHERE name = 'flights_v2';")
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION};")
+        conn.execute("COMMIT;")
+        return True
+    except Exception:
+        conn.rollback()
+        raise
     finally:
-        conn.close()
+        conn.execute("PRAGMA legacy_alter_table = OFF;")
+
+def migrate_archives_v1() -> int:
+    # архивы очередей старой схемы ({archive}_v1, см. migrate_queue_v1) — пачками
+    # по rowid в новый архив; перенесённое удаляем, пустую таблицу — тоже
+    total = 0
+    for table, archive, _ in RETENTION_TABLES:
+        old = f"{archive}_v1"
+        while True:
+            with db_write() as conn:
+                if not table_exists(conn, old):
+                    break
+                hi = conn.execute(
+                    f"SELECT MAX(rowid) FROM (SELECT rowid FROM {old} ORDER BY rowid LIMIT ?);", (MIGRATE_BATCH,)
+                ).fetchone()[0]
+                if hi is None:
+                    conn.execute(f"DROP TABLE {old};")
+                    conn.commit()
+                    break
+                total += conn.execute(f"""
+                    INSERT INTO {archive}({queue_cols(table)}, archived_ts)
+                    SELECT {QUEUE_V1_SELECT[table]}, {epoch_sql("archived_at")} FROM {old} WHERE rowid <= ?;
+                """, (hi,)).rowcount
+                conn.execute(f"DELETE FROM {old} WHERE rowid <= ?;", (hi,))
+                conn.commit()
+            time.sleep(GC_PAUSE)
+    return total
+
+def migrate_schema_v2() -> int:
+    # Онлайн-переезд flights на v2 короткими транзакциями с паузой между ними —
+    # API пишет между пачками. Старт: пустая flights_v2 + триггеры-зеркала;
+    # пачки по MIGRATE_BATCH рейсов (диапазон flight_id до top) копируют строки,
+    # докуда дошли — в schema_migration (рестарт продолжает с того же места);
+    # в конце — подмена таблиц (swap_flights_v2).
+    total = migrate_archives_v1()
+    with db_read() as conn:
+        if schema_version(conn) >= SCHEMA_VERSION:
+            return total
+
+    with db_write() as conn:
+        state = conn.execute("SELECT top, done FROM schema_migration WHERE name = 'flights_v2';").fetchone()
+        if state is None:
+            conn.execute("BEGIN IMMEDIATE;")
+            conn.execute("DROP TABLE IF EXISTS flights_v2;")
+            create_flights_v2(conn, "flights_v2")
+            create_mirror_triggers(conn)
+            top = int(conn.execute("SELECT COALESCE(MAX(flight_id), 0) FROM flights;").fetchone()[0])
+            conn.execute("INSERT INTO schema_migration(name, top, done) VALUES ('flights_v2', ?, 0);", (top,))
+            conn.execute("COMMIT;")
+            state = {"top": top, "done": 0}
+    top, done = int(state["top"]), int(state["done"])
+
+    while True:
+        with db_write() as conn:
+            hi = conn.execute("""
+                SELECT MAX(flight_id) FROM (
+                    SELECT flight_id FROM flights WHERE flight_id > ? AND flight_id <= ? ORDER BY flight_id LIMIT ?
+                );
+            """, (done, top, MIGRATE_BATCH)).fetchone()[0]
+            if hi is None:
+                if not swap_flights_v2(conn):
+                    return total    # копия разошлась — следующий прогон начнёт сначала
+                # таблица переписана целиком — WAL не должен так и остаться большим
+                conn.execute("PRAGMA wal_checkpoint(PASSIVE);")
+                return total
+            conn.execute("""
+                INSERT OR IGNORE INTO cities(name)
+                SELECT departure_city FROM flights WHERE flight_id > ? AND flight_id <= ?
+                UNION
+                SELECT arrival_city FROM flights WHERE flight_id > ? AND flight_id <= ?;
+            """, (done, hi, done, hi))
+            total += conn.execute(f"""
+                INSERT OR REPLACE INTO flights_v2({FLIGHT_V2_COLS})
+                {FLIGHT_V2_SELECT} WHERE flight_id > ? AND flight_id <= ?;
+            """, (done, hi)).rowcount
+            conn.execute("UPDATE schema_migration SET done = ? WHERE name = 'flights_v2';", (hi,))
+            conn.commit()
+        done = hi
+        time.sleep(GC_PAUSE)
+
+def reprice_fares(full: bool = False) -> int:
+    # тарифы одним INSERT ... SELECT, пишутся лишь изменившиеся цены. Что пересчитать:
+    # рейсы из fare_dirty (менялась загрузка); с наступлением нового дня — ещё дни,
+    # где рейсы перешли на другую ступень FARE_DAY_STEPS; всё расписание — при
+    # первом прогоне, после смены базы маршрутов или долгого простоя
+    today = datetime.now(timezone.utc).date()
+    with db_write() as conn:
+        fv = conn.execute("SELECT version, priced_on FROM fare_version WHERE id = 1;").fetchone()
+        gap = (today - date.fromisoformat(fv["priced_on"])).days if fv["priced_on"] else None
+        full = full or gap is None or gap > FARE_FULL_GAP_DAYS
+        if not full and not gap and not conn.execute("SELECT 1 FROM fare_dirty LIMIT 1;").fetchone():
+            return 0
+
+        version = int(fv["version"]) + 1
+        v2 = schema_version(conn) >= SCHEMA_VERSION
+        t0 = sched_ts(today.isoformat())
+
+        def days_between(a: int, b: int) -> str:
+            # дни [a, b] от сегодня; в v2 — диапазон dep_ts по idx_flights_v2_ts
+            if v2:
+                return f"f.dep_ts BETWEEN {t0 + a * 86400} AND {t0 + (b + 1) * 86400 - 1}"
+            return f"f.flight_date BETWEEN date('now', '+{a} day') AND date('now', '+{b} day')"
+
+        scope = "f.flight_id IN (SELECT flight_id FROM fare_dirty)"
+        if full:
+            scope = f"f.dep_ts >= {t0}" if v2 else "f.flight_date >= date('now')"
+        elif gap:
+            scope += "".join(
+                f" OR {days_between(max(0, days - gap), days - 1)}"
+                for days, _ in FARE_DAY_STEPS
+            )
+        changed = [r[0] for r in conn.execute(f"""
+            INSERT INTO fares(flight_id, price_usd, version)
+            SELECT f.flight_id, {fare_sql()}, ?
+            {FARE_FROM}
+            WHERE {scope}
+            ON CONFLICT(flight_id) DO UPDATE SET price_usd = excluded.price_usd, version = excluded.version
+            WHERE price_usd <> excluded.price_usd
+            RETURNING flight_id;
+        """, (version,))]
+        conn.execute("DELETE FROM fare_dirty;")
+        if changed:
+            refresh_route_day_prices(conn, None if full else changed)
+            # цены — часть выдачи поиска: кэш по версии расписания должен сброситься
+            bump_schedule_version(conn)
+        conn.execute("UPDATE fare_version SET version = ?, priced_on = ?, priced_at = ? WHERE id = 1;", (
+            version if changed else int(fv["version"]),
+            today.isoformat(),
+            now_utc_iso(),
+        ))
+        conn.commit()
+
+    if changed:
+        SEARCH_CACHE.bump()
+    return len(changed)
+
+def rebuild_routes() -> int:
+    # полная пересборка графа — здесь, не в запросе; первый прогон заодно прогревает
+    if ROUTES.g is not None and time.monotonic() - ROUTES.built_at < ROUTE_REBUILD_SECONDS:
+        return 0
+    return ROUTES.rebuild()
+
+# общие для БД задачи — один поток на весь запуск; задачи над памятью процесса
+# (граф маршрутов) — свой поток в каждом процессе API, стартует из api_lifespan
+MAINTENANCE_JOBS = [gc_sessions, gc_seat_holds, retention_queues, migrate_schema_v2, reprice_fares]
+PROCESS_JOBS = [rebuild_routes]
+
+def run_maintenance_once(jobs: list = MAINTENANCE_JOBS) -> dict:
+    out = {}
+    for job in jobs:
+        try:
+            out[job.__name__] = job()
+        except Exception as e:
+            out[job.__name__] = f"error: {e}"
+    return out
+
+def maintenance_loop(stop: threading.Event, jobs: list = MAINTENANCE_JOBS) -> None:
+    # первый прогон сразу: прогрев графа маршрутов, хвосты с прошлого запуска
+    run_maintenance_once(jobs)
+    while not stop.wait(MAINT_SECONDS):
+        run_maintenance_once(jobs)
+
+def start_maintenance(jobs: list = MAINTENANCE_JOBS, name: str = "maintenance") -> threading.Event:
+    stop = threading.Event()
+    threading.Thread(target=maintenance_loop, args=(stop, jobs), daemon=True, name=name).start()
+    return stop
 
 # =========================
 # RUNNERS
 # =========================
 
-def run_api() -> None:
+def run_api(workers: int = 1) -> None:
+    if workers > 1:
+        # несколько процессов uvicorn — только по import string, модуль грузится в каждом заново
+        uvicorn.run(
+            "botinok:api_app",
+            app_dir=str(Path(__file__).resolve().parent),
+            host=API_HOST, port=API_PORT,
+            workers=workers, log_level="info",
+        )
+        return
     cfg = uvicorn.Config(api_app, host=API_HOST, port=API_PORT, log_level="info")
     server = uvicorn.Server(cfg)
     server.run()
 
-def main() -> None:
+def build_bot_app(webhook: bool = False) -> Application:
+    from telegram.ext import Application, CommandHandler, MessageHandler, filters
+
+    builder = Application.builder().token(BOT_TOKEN).post_init(post_init).post_stop(post_stop)
+    if webhook:
+        # апдейты приходят через api_app, своего Updater'а (getUpdates) не нужно
+        builder = builder.updater(None)
+    app = builder.build()
+
+    app.add_handler(CommandHandler("start", cmd_start))
+    app.add_handler(CommandHandler("help", cmd_help))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_text))
+    return app
+
+def require_token() -> None:
     if not BOT_TOKEN:
         raise SystemExit(
             "BOT_TOKEN пустой.\n"
@@ -971,27 +4232,162 @@ def main() -> None:
             "  set BOT_TOKEN=... && py -3 bot\\botinok.py"
         )
 
+def require_config() -> None:
+    # опечатка в режиме не должна молча превращаться в удаление или в ничего
+    if RETENTION_MODE not in RETENTION_MODES:
+        raise SystemExit(
+            f"RETENTION_MODE={RETENTION_MODE!r} не поддерживается.\n"
+            f"Допустимо: {' | '.join(RETENTION_MODES)}"
+        )
+
+def run_bot() -> None:
+    app = build_bot_app()
+    app.run_polling(allowed_updates=ALLOWED_UPDATES)
+
+def run_webhook() -> None:
+    global TG_APP
+    require_token()
+    if not TG_WEBHOOK_URL:
+        raise SystemExit("TG_WEBHOOK_URL пустой (нужен публичный https://.../tg/webhook).")
+
+    db_init()
+    app = build_bot_app(webhook=True)
+
+    # post_init/post_stop зовут только run_polling/run_webhook — тут зовём сами
+    async def start_bot() -> None:
+        await app.initialize()
+        await app.start()
+        await post_init(app)
+        await app.bot.set_webhook(
+            url=TG_WEBHOOK_URL,
+            allowed_updates=ALLOWED_UPDATES,
+            secret_token=TG_WEBHOOK_SECRET,
+        )
+
+    async def stop_bot() -> None:
+        await post_stop(app)
+        await app.stop()
+        await app.shutdown()
+
+    STARTUP_HOOKS.append(start_bot)
+    SHUTDOWN_HOOKS.append(stop_bot)
+    TG_APP = app
+
+    print(f"[bot] DB: {DB_PATH}")
+    print(f"[api] http://{API_HOST}:{API_PORT} · webhook {TG_WEBHOOK_URL}")
+    start_maintenance()
+    run_api()
+
+def run_all() -> None:
+    require_token()
+
     db_init()
     print(f"[bot] DB: {DB_PATH}")
     print(f"[api] http://{API_HOST}:{API_PORT}")
 
+    start_maintenance()
+
     # API in background thread
     th = threading.Thread(target=run_api, daemon=True)
     th.start()
 
-    # Telegram bot
-    app = (
-        Application.builder()
-        .token(BOT_TOKEN)
-        .post_init(post_init)
-        .build()
-    )
+    run_bot()
 
-    app.add_handler(CommandHandler("start", cmd_start))
-    app.add_handler(CommandHandler("help", cmd_help))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_text))
+def run_api_only(workers: int) -> None:
+    db_init()
+    print(f"[api] DB: {DB_PATH}")
+    print(f"[api] http://{API_HOST}:{API_PORT} · workers={workers}")
+    # один поток обслуживания на весь набор воркеров — в родительском процессе
+    start_maintenance()
+    run_api(workers)
+
+def run_bot_only() -> None:
+    require_token()
+    db_init()
+    print(f"[bot] DB: {DB_PATH} · wake={SENDER_WAKE_ADDR or 'off'}")
+    run_bot()
+
+async def run_sender_worker(sweep: float) -> None:
+    # отдельный отправитель без getUpdates: polling у бота может быть только один
+    from telegram import Bot
+
+    async with Bot(BOT_TOKEN) as bot:
+        await background_loop(bot, sweep=sweep)
+
+def cli_sender(args) -> None:
+    require_token()
+    db_init()
+    print(f"[sender] {WORKER_ID} · DB: {DB_PATH}")
+    asyncio.run(run_sender_worker(args.sweep))
+
+def cli_seed(args) -> None:
+    db_init()
+    conn = db_connect()
+    try:
+        if args.reset:
+            with conn:
+                conn.execute("DELETE FROM seat_holds;")
+                conn.execute("DELETE FROM tickets;")
+                conn.execute("DELETE FROM flights;")
+
+        t0 = time.perf_counter()
+
+        def progress(done: int, total: int) -> None:
+            dt = time.perf_counter() - t0
+            print(f"[seed] {done}/{total} · {done / dt if dt else 0:.0f} rows/s", flush=True)
+
+        n = bulk_generate_flights(
+            conn, args.flights,
+            seed=args.seed, days=args.days, chunk=args.chunk,
+            progress=progress,
+        )
+        conn.execute("PRAGMA optimize;")
+        print(f"[seed] +{n} flights за {time.perf_counter() - t0:.1f}s → {DB_PATH}")
+    finally:
+        conn.close()
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(prog="botinok", description="airline-web-tg: API + Telegram-бот")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--all", dest="mode", action="store_const", const="all",
+                      help="API и бот в одном процессе (по умолчанию)")
+    mode.add_argument("--api-only", dest="mode", action="store_const", const="api",
+                      help="только API, без telegram; можно несколько воркеров")
+    mode.add_argument("--bot-only", dest="mode", action="store_const", const="bot",
+                      help="только бот: /start и отправка кодов/уведомлений")
+    mode.add_argument("--webhook", dest="mode", action="store_const", const="webhook",
+                      help="API и бот в одном цикле uvicorn, апдейты через webhook (TG_WEBHOOK_URL)")
+    parser.add_argument("--workers", type=int, default=API_WORKERS,
+                        help="процессов uvicorn в режиме --api-only")
+    sub = parser.add_subparsers(dest="cmd")
+
+    sp = sub.add_parser("seed", help="сгенерировать расписание для нагрузочных тестов")
+    sp.add_argument("--flights", type=int, default=100_000, help="сколько рейсов вставить")
+    sp.add_argument("--seed", type=int, default=1337, help="seed генератора (детерминированно)")
+    sp.add_argument("--days", type=int, default=365, help="горизонт расписания в днях")
+    sp.add_argument("--chunk", type=int, default=50_000, help="строк на одну транзакцию")
+    sp.add_argument("--reset", action="store_true", help="удалить все рейсы, билеты и удержания мест перед генерацией")
+
+    sp = sub.add_parser("sender", help="дополнительный воркер отправки кодов/уведомлений")
+    sp.add_argument("--sweep", type=float, default=1.0, help="интервал скана очереди, сек")
+
+    args = parser.parse_args(argv)
+    require_config()
+    if args.cmd == "seed":
+        cli_seed(args)
+        return
+    if args.cmd == "sender":
+        cli_sender(args)
+        return
 
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    if args.mode == "api":
+        run_api_only(max(1, args.workers))
+    elif args.mode == "bot":
+        run_bot_only()
+    elif args.mode == "webhook":
+        run_webhook()
+    else:
+        run_all()
 
 if __name__ == "__main__":
-    main()
+    main(sys.argv[1:])
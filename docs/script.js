@@ -25,8 +25,8 @@ function toast(msg, ok = false) {
   window.__toastTimer = setTimeout(() => t.classList.add("hidden"), 2600);
 }
 
-async function api(path, method = "GET", body = null) {
-  const opts = { method, headers: { "Content-Type": "application/json" } };
+async function api(path, method = "GET", body = null, headers = null, meta = null) {
+  const opts = { method, headers: { "Content-Type": "application/json", ...(headers || {}) } };
   if (body) opts.body = JSON.stringify(body);
 
   const url = API_BASE + path;
@@ -38,6 +38,10 @@ async function api(path, method = "GET", body = null) {
     throw new Error("Failed to fetch");
   }
 
+  // 304 на If-None-Match: у вызывающего уже есть актуальная копия
+  if (res.status === 304) return null;
+  if (meta) meta.etag = res.headers.get("etag") || "";
+
   const ct = (res.headers.get("content-type") || "").toLowerCase();
 
   if (!ct.includes("application/json")) {
@@ -55,7 +59,10 @@ async function api(path, method = "GET", body = null) {
 
   if (!res.ok) {
     const msg = (data && (data.detail || data.message)) ? (data.detail || data.message) : ("HTTP " + res.status);
-    throw new Error(msg);
+    const err = new Error(msg);
+    err.status = res.status;
+    err.data = data;  // доп. поля ошибки (например, актуальная цена на 409)
+    throw err;
   }
 
   if (data === null) {
@@ -65,6 +72,17 @@ async function api(path, method = "GET", body = null) {
   return data;
 }
 
+// long-poll статуса: сервер отвечает, как только бот отправил код (или не смог)
+async function waitCodeSent(requestId, okMsg) {
+  for (let i = 0; i < 10; i++) {
+    const st = await api(`/api/requests/${encodeURIComponent(requestId)}/status?wait=25`, "GET");
+    if (st.status === "sent") return toast(okMsg, true);
+    if (st.status === "failed") throw new Error("Бот не смог отправить код: " + (st.error || "ошибка"));
+    if (st.status !== "pending") return;
+  }
+  toast("Бот пока не отправил код — попробуй запросить ещё раз");
+}
+
 function normU(u) {
   u = (u || "").trim();
   if (!u) return "";
@@ -107,8 +125,9 @@ $("btnRegCode").addEventListener("click", async () => {
   if (!username) return toast("Введи Telegram @username");
 
   try {
-    await api("/api/auth/request-code", "POST", { username, purpose: "register" });
-    toast("Код отправлен в Telegram ✅", true);
+    const data = await api("/api/auth/request-code", "POST", { username, purpose: "register" });
+    toast("Запросил код, жду бота...", true);
+    await waitCodeSent(data.request_id, "Код отправлен в Telegram ✅");
   } catch (e) {
     toast(e.message);
   }
@@ -152,8 +171,9 @@ $("btnLoginCode").addEventListener("click", async () => {
   if (!username) return toast("Введи Telegram @username");
 
   try {
-    await api("/api/auth/request-code", "POST", { username, purpose: "login" });
-    toast("Код отправлен в Telegram ✅", true);
+    const data = await api("/api/auth/request-code", "POST", { username, purpose: "login" });
+    toast("Запросил код, жду бота...", true);
+    await waitCodeSent(data.request_id, "Код отправлен в Telegram ✅");
   } catch (e) {
     toast(e.message);
   }
@@ -179,6 +199,8 @@ $("btnLoginConfirm").addEventListener("click", async () => {
 
 // ===== App =====
 $("btnLogout").addEventListener("click", () => {
+  const token = getToken();
+  if (token) api("/api/auth/logout", "POST", { token }).catch(() => {});
   clearToken();
   showAuth();
   toast("Вышел.");
@@ -188,37 +210,90 @@ $("btnSearch").addEventListener("click", async () => {
   await searchFlights();
 });
 
-async function searchFlights() {
+async function searchFlights(cursor) {
   const dep = ($("fDep").value || "").trim();
   const arr = ($("fArr").value || "").trim();
   const date_from = $("fDateFrom").value || "";
   const date_to = $("fDateTo").value || "";
 
   const list = $("flightsList");
-  list.innerHTML = `<div class="muted">Ищу рейсы...</div>`;
+  if (!cursor) list.innerHTML = `<div class="muted">Ищу рейсы...</div>`;
+
+  // задан маршрут и дата — сначала варианты с пересадками (окно у сервера ограничено,
+  // страниц нет), под ними всегда полный постраничный список рейсов
+  let shown = false;
+  if (!cursor && dep && arr && date_from) {
+    try {
+      const data = await api("/api/itineraries/search", "POST", {
+        dep, arr,
+        date_from,
+        date_to: date_to || null,
+        limit: 20
+      });
+      const its = (data && Array.isArray(data.itineraries)) ? data.itineraries : [];
+      if (its.length) {
+        list.innerHTML = `<div class="muted">Варианты с пересадками · ${escapeHtml(data.date_from)} — ${escapeHtml(data.date_to)}</div>`;
+        its.forEach(it => list.appendChild(itineraryCard(it)));
+        list.insertAdjacentHTML("beforeend", `<div class="muted">Все рейсы</div>`);
+        shown = true;
+      }
+    } catch (e) {
+      // не страшно: ниже обычный поиск
+    }
+  }
 
   try {
-    const data = await api("/api/flights/search", "POST", {
+    const body = {
       dep: dep || null,
       arr: arr || null,
       date_from: date_from || null,
       date_to: date_to || null,
-      limit: 120
-    });
+      limit: 120,
+      cursor: cursor || null
+    };
+    const data = await cachedSearch(body);
 
     const flights = (data && Array.isArray(data.flights)) ? data.flights : [];
-    if (!flights.length) {
-      list.innerHTML = `<div class="muted">Ничего не найдено. Попробуй другие фильтры.</div>`;
+    if (!cursor && !flights.length) {
+      if (shown) list.lastElementChild.remove();
+      else list.innerHTML = `<div class="muted">Ничего не найдено. Попробуй другие фильтры.</div>`;
       return;
     }
 
-    list.innerHTML = "";
+    if (!cursor && !shown) list.innerHTML = "";
     flights.forEach(f => list.appendChild(flightCard(f)));
+    if (data.next_cursor) list.appendChild(moreButton(() => searchFlights(data.next_cursor)));
   } catch (e) {
-    list.innerHTML = `<div class="muted">Ошибка: ${escapeHtml(e.message)}</div>`;
+    if (!cursor && !shown) list.innerHTML = `<div class="muted">Ошибка: ${escapeHtml(e.message)}</div>`;
+    else toast(e.message);
   }
 }
 
+// повторный поиск с If-None-Match: на 304 берём ответ из памяти
+const searchCache = new Map();
+
+async function cachedSearch(body) {
+  const key = JSON.stringify(body);
+  const hit = searchCache.get(key);
+  const meta = {};
+  const data = await api("/api/flights/search", "POST", body, hit ? { "If-None-Match": hit.etag } : null, meta);
+  if (data === null && hit) return hit.data;
+  if (meta.etag) searchCache.set(key, { etag: meta.etag, data });
+  return data;
+}
+
+// кнопка "Показать ещё" — убирает себя и грузит следующую страницу
+function moreButton(load) {
+  const el = document.createElement("div");
+  el.className = "row end";
+  el.innerHTML = `<button class="btn">Показать ещё</button>`;
+  el.querySelector("button").addEventListener("click", async () => {
+    el.remove();
+    await load();
+  });
+  return el;
+}
+
 function flightCard(f) {
   const el = document.createElement("div");
   el.className = "flight";
@@ -237,12 +312,12 @@ function flightCard(f) {
       <div class="arrow">→</div>
       <div>
         <div class="city">${escapeHtml(f.arr)}</div>
-        <div class="dt">${escapeHtml(f.plane_model)} · ${Number(f.seat_capacity)} мест</div>
+        <div class="dt">${escapeHtml(f.plane_model)} · свободно ${Number(f.seats_free)} из ${Number(f.seat_capacity)}</div>
       </div>
     </div>
 
     <div class="row end">
-      <button class="btn primary">Выбрать</button>
+      <button class="btn primary" ${Number(f.seats_free) > 0 ? "" : "disabled"}>${Number(f.seats_free) > 0 ? "Выбрать" : "Мест нет"}</button>
     </div>
   `;
 
@@ -250,6 +325,40 @@ function flightCard(f) {
   return el;
 }
 
+function fmtDuration(min) {
+  min = Number(min) || 0;
+  const h = Math.floor(min / 60), m = min % 60;
+  return h ? `${h} ч ${m} мин` : `${m} мин`;
+}
+
+// вариант маршрута: итог сверху, дальше плечи — каждое бронируется отдельно
+function itineraryCard(it) {
+  const el = document.createElement("div");
+  el.className = "flight";
+
+  const stops = Number(it.stops) === 0 ? "прямой" : `пересадок: ${Number(it.stops)}`;
+  // цены может не быть (тариф ещё не посчитан) — не "$0.00" и не NaN
+  const price = it.price == null ? "—" : `$${Number(it.price).toFixed(2)}`;
+  el.innerHTML = `
+    <div class="flightTop">
+      <div class="fn">${escapeHtml(it.depart)} → ${escapeHtml(it.arrive)}</div>
+      <div class="price">${price}</div>
+    </div>
+    <div class="dt">${escapeHtml(stops)} · в пути ${escapeHtml(fmtDuration(it.duration_min))}</div>
+  `;
+
+  (it.legs || []).forEach((f, i) => {
+    if (i > 0) {
+      const lay = document.createElement("div");
+      lay.className = "dt";
+      lay.textContent = `пересадка в ${f.dep}: ${fmtDuration((it.layovers_min || [])[i - 1])}`;
+      el.appendChild(lay);
+    }
+    el.appendChild(flightCard(f));
+  });
+  return el;
+}
+
 function escapeHtml(s) {
   return String(s || "")
     .replaceAll("&", "&amp;")
@@ -260,15 +369,28 @@ function escapeHtml(s) {
 
 // ===== Seat Modal =====
 let currentFlight = null;
-let selectedSeat = "";
+let selectedSeats = [];  // групповая бронь: несколько мест одним кодом
 let lastBookingRequestId = "";
+const MAX_SEATS = 9;
+
+let seatStream = null;
+let mySeats = [];  // своё удержание/бронь тоже прилетит дельтой — не пугаем тостом
+
+function showPicked() {
+  $("mSeat").textContent = selectedSeats.length ? selectedSeats.join(", ") : "—";
+}
+
+function closeSeatModal() {
+  if (seatStream) { seatStream.close(); seatStream = null; }
+  showModal(false);
+}
 
-$("mClose").addEventListener("click", () => showModal(false));
-$("modal").addEventListener("click", (e) => { if (e.target.id === "modal") showModal(false); });
+$("mClose").addEventListener("click", () => closeSeatModal());
+$("modal").addEventListener("click", (e) => { if (e.target.id === "modal") closeSeatModal(); });
 
 $("btnBookCode").addEventListener("click", async () => {
   if (!currentFlight) return toast("Нет рейса");
-  if (!selectedSeat) return toast("Выбери место");
+  if (!selectedSeats.length) return toast("Выбери место");
 
   const token = getToken();
   if (!token) return toast("Сессии нет. Выйди и зайди заново.");
@@ -276,16 +398,24 @@ $("btnBookCode").addEventListener("click", async () => {
   const price = Number($("mPrice").value || "0");
   if (!(price > 0)) return toast("Цена должна быть > 0");
 
+  mySeats = selectedSeats.slice();
   try {
     const data = await api("/api/booking/request", "POST", {
       token,
       flight_id: currentFlight.flight_id,
-      seat_no: selectedSeat,
+      seats: selectedSeats,
       price_usd: price
     });
     lastBookingRequestId = data.request_id;
-    toast("Код бронирования отправлен в Telegram ✅", true);
+    $("mPrice").value = Number(data.price_usd).toFixed(2);
+    toast("Запросил код, жду бота...", true);
+    await waitCodeSent(data.request_id, "Код бронирования отправлен в Telegram ✅");
   } catch (e) {
+    if (!lastBookingRequestId) mySeats = [];
+    // цена сменилась: подставляем текущую, следующий клик уйдёт уже с ней
+    if (e.status === 409 && e.data && e.data.price_usd != null) {
+      $("mPrice").value = Number(e.data.price_usd).toFixed(2);
+    }
     toast(e.message);
   }
 });
@@ -306,7 +436,7 @@ $("btnBookConfirm").addEventListener("click", async () => {
     });
 
     toast("Бронь подтверждена ✅", true);
-    showModal(false);
+    closeSeatModal();
     await searchFlights();
   } catch (e) {
     toast(e.message);
@@ -315,7 +445,8 @@ $("btnBookConfirm").addEventListener("click", async () => {
 
 async function openSeatModal(f) {
   currentFlight = f;
-  selectedSeat = "";
+  selectedSeats = [];
+  mySeats = [];
   lastBookingRequestId = "";
   $("bookCode").value = "";
 
@@ -329,15 +460,61 @@ async function openSeatModal(f) {
 
   showModal(true);
 
+  // live-карта: snapshot, потом только изменившиеся места; без SSE — разовый снимок
+  if (window.EventSource) {
+    if (seatStream) seatStream.close();
+    seatStream = new EventSource(API_BASE + `/api/flights/${f.flight_id}/seats/stream`);
+    seatStream.addEventListener("snapshot", (ev) => renderSeats(decodeSeatMap(JSON.parse(ev.data))));
+    seatStream.addEventListener("seats", (ev) => {
+      const d = JSON.parse(ev.data);
+      (d.freed || []).forEach(seat => setSeatStatus(seat, "free"));
+      (d.released || []).forEach(seat => setSeatStatus(seat, "free", true));
+      (d.held || []).forEach(seat => setSeatStatus(seat, "held"));
+      (d.booked || []).forEach(seat => setSeatStatus(seat, "booked"));
+    });
+    return;
+  }
+
   try {
-    const data = await api(`/api/flights/${f.flight_id}/seats`, "GET");
-    const seats = (data && Array.isArray(data.seats)) ? data.seats : [];
-    renderSeats(seats);
+    const data = await api(`/api/flights/${f.flight_id}/seats?format=compact`, "GET");
+    renderSeats(decodeSeatMap(data));
   } catch (e) {
     grid.innerHTML = `<div class="muted">Ошибка: ${escapeHtml(e.message)}</div>`;
   }
 }
 
+// 0->A, 25->Z, 26->AA... (как excel_letters на сервере)
+function excelLetters(n) {
+  let s = "";
+  while (true) {
+    s = String.fromCharCode(65 + (n % 26)) + s;
+    n = Math.floor(n / 26);
+    if (n === 0) break;
+    n -= 1;
+  }
+  return s;
+}
+
+// compact: bitmap base64, бит i = место i по порядку раскладки (ряд буквой, 1..row_size);
+// held — такой же битмап удержанных мест
+function decodeSeatMap(data) {
+  if (!data || !data.bitmap) return [];
+  const bin = atob(data.bitmap);
+  const held = data.held ? atob(data.held) : "";
+  const rowSize = Number(data.row_size) || 6;
+  const cap = Number(data.capacity) || 0;
+  const seats = [];
+  for (let i = 0; i < cap; i++) {
+    const booked = (bin.charCodeAt(i >> 3) & (0x80 >> (i & 7))) !== 0;
+    const isHeld = held && (held.charCodeAt(i >> 3) & (0x80 >> (i & 7))) !== 0;
+    seats.push({
+      seat: excelLetters(Math.floor(i / rowSize)) + String((i % rowSize) + 1),
+      status: booked ? "booked" : (isHeld ? "held" : "free")
+    });
+  }
+  return seats;
+}
+
 function renderSeats(seats) {
   const grid = $("seatGrid");
   grid.innerHTML = "";
@@ -352,24 +529,46 @@ function renderSeats(seats) {
     const status = String(x.status || "free");
 
     const b = document.createElement("button");
-    b.className = "seat " + (status === "booked" ? "booked" : "free");
+    b.className = "seat " + (status === "booked" || status === "held" ? status : "free");
     b.textContent = seat;
-
-    if (status === "booked") {
-      b.disabled = true;
-    } else {
-      b.addEventListener("click", () => {
-        grid.querySelectorAll(".seat.pick").forEach(s => s.classList.remove("pick"));
+    b.dataset.seat = seat;
+    b.disabled = status !== "free";
+
+    // клик переключает место в группе
+    b.addEventListener("click", () => {
+      if (selectedSeats.includes(seat)) {
+        selectedSeats = selectedSeats.filter(s => s !== seat);
+        b.classList.remove("pick");
+      } else {
+        if (selectedSeats.length >= MAX_SEATS) return toast(`Не больше ${MAX_SEATS} мест в одной брони`);
+        selectedSeats.push(seat);
         b.classList.add("pick");
-        selectedSeat = seat;
-        $("mSeat").textContent = selectedSeat;
-      });
-    }
+      }
+      showPicked();
+    });
 
     grid.appendChild(b);
   });
 }
 
+// дельта из SSE: место заняли/удержали/освободили, пока модалка открыта;
+// onlyHeld — снять удержание, но не трогать уже проданное место
+function setSeatStatus(seat, status, onlyHeld = false) {
+  const b = $("seatGrid").querySelector(`.seat[data-seat="${seat}"]`);
+  if (!b) return;
+  if (onlyHeld && !b.classList.contains("held")) return;
+  b.classList.toggle("booked", status === "booked");
+  b.classList.toggle("held", status === "held");
+  b.classList.toggle("free", status === "free");
+  b.disabled = status !== "free";
+  if (status !== "free" && selectedSeats.includes(seat) && !mySeats.includes(seat)) {
+    b.classList.remove("pick");
+    selectedSeats = selectedSeats.filter(s => s !== seat);
+    showPicked();
+    toast(`Место ${seat} только что заняли — выбери другое`);
+  }
+}
+
 // ===== My flights =====
 $("btnMyFlights").addEventListener("click", async () => {
   const token = getToken();
@@ -377,17 +576,23 @@ $("btnMyFlights").addEventListener("click", async () => {
 
   $("myFlightsList").innerHTML = `<div class="muted">Загружаю...</div>`;
   showModal2(true);
+  await loadMyFlights(token);
+});
 
+async function loadMyFlights(token, cursor) {
+  const list = $("myFlightsList");
   try {
-    const data = await api(`/api/me/flights?token=${encodeURIComponent(token)}`, "GET");
+    let url = `/api/me/flights?token=${encodeURIComponent(token)}`;
+    if (cursor) url += `&cursor=${encodeURIComponent(cursor)}`;
+    const data = await api(url, "GET");
     const flights = (data && Array.isArray(data.flights)) ? data.flights : [];
 
-    if (!flights.length) {
-      $("myFlightsList").innerHTML = `<div class="muted">Пока пусто. Забронируй что-нибудь.</div>`;
+    if (!cursor && !flights.length) {
+      list.innerHTML = `<div class="muted">Пока пусто. Забронируй что-нибудь.</div>`;
       return;
     }
 
-    $("myFlightsList").innerHTML = "";
+    if (!cursor) list.innerHTML = "";
     flights.forEach(t => {
       const el = document.createElement("div");
       el.className = "flight";
@@ -408,12 +613,14 @@ $("btnMyFlights").addEventListener("click", async () => {
           </div>
         </div>
       `;
-      $("myFlightsList").appendChild(el);
+      list.appendChild(el);
     });
+    if (data.next_cursor) list.appendChild(moreButton(() => loadMyFlights(token, data.next_cursor)));
   } catch (e) {
-    $("myFlightsList").innerHTML = `<div class="muted">Ошибка: ${escapeHtml(e.message)}</div>`;
+    if (!cursor) list.innerHTML = `<div class="muted">Ошибка: ${escapeHtml(e.message)}</div>`;
+    else toast(e.message);
   }
-});
+}
 
 $("m2Close").addEventListener("click", () => showModal2(false));
 $("modal2").addEventListener("click", (e) => { if (e.target.id === "modal2") showModal2(false); });